@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class NoteConfig(AppConfig):
     name = 'note'
+
+    def ready(self):
+        import note.signals  # noqa
+        from note.cache import check_shared_cache
+        checks.register(check_shared_cache, 'caches')
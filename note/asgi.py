@@ -0,0 +1,172 @@
+"""
+ASGI serving of the Django application.
+
+Django 1.9 has no async views nor an async database driver, so AsgiHandler keeps the network I/O
+in the event loop and runs the views in bounded thread pools: the request body is received
+into a spooled file before a thread is taken, and the response is produced by the thread and sent
+after the thread is released, so slow uploads and slow clients wait in the event loop instead of a worker.
+Streaming responses, e.g. the export, are spooled too, downloads should use NOTES_SENDFILE_BACKEND.
+
+The hot read endpoints in READ_PATHS run in a pool of their own, so uploads and writes cannot take
+all threads of the reads. ASGI_THREADS + ASGI_READ_THREADS is also the most database connections of a process.
+"""
+import asyncio
+import logging
+import re
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ASGI_THREADS = getattr(settings, 'NOTES_ASGI_THREADS', 10)
+ASGI_READ_THREADS = getattr(settings, 'NOTES_ASGI_READ_THREADS', 10)
+# bodies above it are spooled to disk
+ASGI_SPOOL_SIZE = getattr(settings, 'NOTES_ASGI_SPOOL_SIZE', 1024 * 1024)
+CHUNK_SIZE = 64 * 1024
+# public notes list and detail, my_notes list and the sync feed
+READ_PATHS = re.compile(r'^/(notes/(\d+/)?|my_notes/(sync/)?)$')
+READ_METHODS = ('GET', 'HEAD')
+ERROR_HEADERS = [(b'content-type', b'text/plain; charset=utf-8')]
+ERROR_BODY = b'Internal Server Error'
+
+
+def build_environ(scope, body):
+    """
+    WSGI environ of an ASGI http scope, body is a file with the request body
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI strings are bytes decoded as latin-1
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        environ[key] = '%s,%s' % (environ[key], value) if key in environ else value
+    return environ
+
+
+class AsgiHandler(object):
+    """
+    ASGI 3 application serving a WSGI application from thread pools
+    """
+
+    def __init__(self, wsgi_application, executor=None, read_executor=None):
+        self.wsgi_application = wsgi_application
+        self.executor = executor or ThreadPoolExecutor(ASGI_THREADS)
+        self.read_executor = read_executor or ThreadPoolExecutor(ASGI_READ_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported scope type %s' % scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                self.read_executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_SIZE)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body', False):
+                    break
+            size = body.tell()
+            body.seek(0)
+            environ = build_environ(scope, body)
+            # chunked requests have no Content-Length, Django reads only that many bytes
+            environ.setdefault('CONTENT_LENGTH', str(size))
+            executor = self.read_executor if (
+                scope['method'] in READ_METHODS and READ_PATHS.match(scope['path'])) else self.executor
+            loop = asyncio.get_event_loop()
+            try:
+                status, headers, content = await loop.run_in_executor(executor, self.run, environ)
+            except Exception:
+                # the application failed before the response started, e.g. in a streamed body
+                logger.exception('Internal Server Error: %s', scope['path'])
+                status, headers, content = 500, ERROR_HEADERS, ERROR_BODY
+        finally:
+            body.close()
+        try:
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            if isinstance(content, bytes):
+                await send({'type': 'http.response.body', 'body': content})
+                return
+            while True:
+                chunk = content.read(CHUNK_SIZE)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': len(chunk) == CHUNK_SIZE})
+                if len(chunk) < CHUNK_SIZE:
+                    return
+        finally:
+            if not isinstance(content, bytes):
+                content.close()
+
+    def run(self, environ):
+        """
+        runs the WSGI application in a thread, returns (status, headers, bytes or a spooled file of the body)
+        """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]),
+                          [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+
+        response = self.wsgi_application(environ, start_response)
+        try:
+            if not getattr(response, 'streaming', False) and hasattr(response, 'content'):
+                content = response.content
+            else:
+                # the thread is released before the client reads it
+                content = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_SIZE)
+                try:
+                    for chunk in response:
+                        content.write(chunk)
+                except Exception:
+                    content.close()
+                    raise
+                content.seek(0)
+        finally:
+            # sends request_finished, which closes the database connections of this thread
+            if hasattr(response, 'close'):
+                response.close()
+        if not started:
+            if not isinstance(content, bytes):
+                content.close()
+            raise RuntimeError('The application did not call start_response')
+        return started[0], started[1], content
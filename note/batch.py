@@ -0,0 +1,208 @@
+"""
+Batch of note operations in one request.
+
+All operations are validated first: related ids by one IN query per relation
+and target notes with the delegations of the user by two queries.
+Valid operations are written in one transaction with bulk statements,
+invalid ones are reported in the per-item results and skipped.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction, connections
+from django.db.models import Case, When, Value, F, CharField, TextField, IntegerField
+from django.utils import timezone
+from rest_framework import status
+from note import sync
+from note.models import Note, Colors, Categories, Labels, Attachments, NoteTombstone
+from note.permissions import NoteAccess
+from note.reference import REFERENCES
+from note.serializers import NoteBatchOperationSerializer
+from note.signals import notes_bulk_saved
+
+BATCH_MAX_OPERATIONS = 500
+
+RELATED_MODELS = (
+    ('color', Colors),
+    ('category', Categories),
+    ('label', Labels),
+    ('delegated', User),
+    ('file', Attachments),
+)
+MANY_TO_MANY_FIELDS = ('category', 'label', 'delegated', 'file')
+OPERATION_METHODS = {'create': 'POST', 'update': 'PUT', 'relabel': 'PUT', 'delete': 'DELETE'}
+
+
+class NoteBatch(object):
+
+    def __init__(self, user, operations, using='default'):
+        self.user = user
+        self.operations = operations
+        self.using = using
+        self.results = [None] * len(operations)
+
+    def error(self, index, code, errors):
+        self.results[index] = {'status': code, 'errors': errors}
+
+    def run(self):
+        """
+        returns a list of results in the order of operations
+        """
+        items = self.validate()
+        items = self.check_related(items)
+        items = self.check_permissions(items)
+        with transaction.atomic(using=self.using):
+            self.write(items)
+        return self.results
+
+    def validate(self):
+        items = []
+        for index, operation in enumerate(self.operations):
+            # errors of a serializer of a non-object fail to build
+            if not isinstance(operation, dict):
+                self.error(index, status.HTTP_400_BAD_REQUEST, {'non_field_errors': ['Expected an object.']})
+                continue
+            serializer = NoteBatchOperationSerializer(data=operation)
+            if not serializer.is_valid():
+                self.error(index, status.HTTP_400_BAD_REQUEST, serializer.errors)
+                continue
+            data = serializer.validated_data
+            if data['op'] == 'relabel':
+                data = {'op': 'relabel', 'id': data['id'], 'label': data['label']}
+            items.append((index, data))
+        return items
+
+    def check_related(self, items):
+        """
+        one query per relation for all ids of the batch, colors and labels are checked by the reference cache
+        """
+        for field_name, model in RELATED_MODELS:
+            requested = set()
+            for index, data in items:
+                value = data.get(field_name)
+                if field_name in MANY_TO_MANY_FIELDS:
+                    requested.update(value or ())
+                elif value is not None:
+                    requested.add(value)
+            if not requested:
+                continue
+            if model in REFERENCES:
+                existing = REFERENCES[model].existing(requested)
+            else:
+                existing = set(model.objects.using(self.using).filter(pk__in=requested).values_list('pk', flat=True))
+            valid = []
+            for index, data in items:
+                value = data.get(field_name)
+                if field_name not in MANY_TO_MANY_FIELDS:
+                    value = [] if value is None else [value]
+                missing = [i for i in value or () if i not in existing]
+                if missing:
+                    self.error(index, status.HTTP_400_BAD_REQUEST, {
+                        field_name: ['Invalid pk "%s" - object does not exist.' % i for i in missing]
+                    })
+                else:
+                    valid.append((index, data))
+            items = valid
+        return items
+
+    def check_permissions(self, items):
+        """
+        the same rules as CustomNotesPermissions, target notes and delegations are loaded by two queries
+        """
+        access = NoteAccess(self.user, self.using)
+        owners = access.load(data['id'] for index, data in items if data['op'] != 'create')
+        valid = []
+        seen = set()
+        for index, data in items:
+            if data['op'] == 'create':
+                valid.append((index, data))
+                continue
+            note_id = data['id']
+            if note_id not in owners:
+                self.error(index, status.HTTP_404_NOT_FOUND, {'detail': 'Not found.'})
+            elif note_id in seen:
+                self.error(index, status.HTTP_400_BAD_REQUEST, {'id': ['The note is already changed by this batch.']})
+            elif access.has_permission(note_id, owners[note_id], OPERATION_METHODS[data['op']]):
+                seen.add(note_id)
+                valid.append((index, data))
+            else:
+                self.error(index, status.HTTP_403_FORBIDDEN,
+                           {'detail': 'You do not have permission to perform this action.'})
+        return valid
+
+    def write(self, items):
+        creates = [(index, data) for index, data in items if data['op'] == 'create']
+        updates = [(index, data) for index, data in items if data['op'] in ('update', 'relabel')]
+        deletes = [(index, data) for index, data in items if data['op'] == 'delete']
+
+        notes = self.create_notes(creates)
+        self.update_notes(updates)
+        relations = [(note.pk, data) for note, (index, data) in zip(notes, creates)]
+        relations += [(data['id'], data) for index, data in updates]
+        self.set_relations(relations)
+        if deletes:
+            Note.objects.using(self.using).filter(pk__in=[data['id'] for index, data in deletes]).delete()
+
+        for note, (index, data) in zip(notes, creates):
+            self.results[index] = {'status': status.HTTP_201_CREATED, 'id': note.pk}
+        for index, data in updates:
+            self.results[index] = {'status': status.HTTP_200_OK, 'id': data['id']}
+        for index, data in deletes:
+            self.results[index] = {'status': status.HTTP_204_NO_CONTENT, 'id': data['id']}
+
+        saved = [note_id for note_id, data in relations]
+        if saved:
+            notes_bulk_saved.send(sender=Note, note_ids=saved, using=self.using)
+
+    def create_notes(self, creates):
+        notes = [Note(owner=self.user, title=data.get('title'), content=data['content'], color_id=data.get('color'))
+                 for index, data in creates]
+        if getattr(connections[self.using].features, 'can_return_ids_from_bulk_insert', False):
+            Note.objects.using(self.using).bulk_create(notes)
+        else:
+            # ids of bulk inserted rows are needed for the relations
+            for note in notes:
+                note.save(using=self.using)
+        return notes
+
+    def update_notes(self, updates):
+        """
+        one UPDATE for all changed notes, every column is a CASE over note ids
+        """
+        if not updates:
+            return
+        values = {}
+        for field_name, output_field in (('title', CharField()), ('content', TextField()), ('color', IntegerField())):
+            whens = [When(pk=data['id'], then=Value(data[field_name])) for index, data in updates if field_name in data]
+            if whens:
+                values[field_name] = Case(*whens, default=F(field_name), output_field=output_field)
+        Note.objects.using(self.using).filter(pk__in=[data['id'] for index, data in updates]).update(
+            date_editing=timezone.now(), **values
+        )
+
+    def set_relations(self, relations):
+        """
+        replaces the through table rows of every passed many to many field by one DELETE and one INSERT
+        """
+        for field_name in MANY_TO_MANY_FIELDS:
+            changed = [(note_id, data[field_name]) for note_id, data in relations if field_name in data]
+            if not changed:
+                continue
+            field = Note._meta.get_field(field_name)
+            through = field.remote_field.through
+            target_column = field.m2m_reverse_field_name() + '_id'
+            rows = through.objects.using(self.using).filter(note_id__in=[note_id for note_id, ids in changed])
+            if field_name == 'delegated':
+                self.sync_delegations(rows, changed)
+            rows.delete()
+            through.objects.using(self.using).bulk_create([
+                through(note_id=note_id, **{target_column: related_id})
+                for note_id, ids in changed for related_id in set(ids)
+            ])
+
+    def sync_delegations(self, rows, changed):
+        """
+        tombstones for revoked delegations, the through table is changed without m2m_changed signals
+        """
+        old = set(rows.values_list('note_id', 'user_id'))
+        new = set((note_id, user_id) for note_id, ids in changed for user_id in ids)
+        sync.bury(old - new, NoteTombstone.REVOKED)
+        sync.resurrect(new - old)
@@ -0,0 +1,251 @@
+"""
+Latency, throughput and query counts of the API on synthetic datasets.
+
+seed() creates a reproducible dataset of a scale from SCALES, run() requests every GET endpoint of note/urls.py
+as the first seeded user and returns results which are stored as a JSON baseline by the benchmark_api command.
+Lists are also requested with page sizes of PAGE_SIZES, a list whose queries grow with the page size
+is reported by compare() like a query count above the baseline or a latency above the baseline by the threshold.
+"""
+import json
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.pagination import PageNumberPagination
+from note import reference
+from note.cache import bump_generation
+from note.models import Note, Colors, Labels, Categories, Attachments, UploadSession
+from note.signals import notes_bulk_saved
+
+SCALES = {
+    'small': {'users': 25, 'notes': 200, 'labels': 30, 'category_depth': 3, 'delegations': 200, 'attachments': 50},
+    'medium': {'users': 200, 'notes': 5000, 'labels': 100, 'category_depth': 4, 'delegations': 5000,
+               'attachments': 1000},
+    'large': {'users': 2000, 'notes': 100000, 'labels': 300, 'category_depth': 5, 'delegations': 100000,
+              'attachments': 20000},
+}
+# sub categories of every category
+CATEGORY_BRANCHING = 3
+COLORS = 8
+PAGE_SIZES = (2, 20)
+BATCH_SIZE = 500
+# latency differences below it are noise
+LATENCY_NOISE_MS = 2.0
+
+# name, path and whether the number of rows of the response is the page size
+ENDPOINTS = (
+    ('labels.list', '/labels/', True),
+    ('labels.retrieve', '/labels/{label}/', False),
+    ('categories.list', '/categories/', False),
+    ('categories.retrieve', '/categories/{category}/', False),
+    ('users.list', '/users/', True),
+    ('users.retrieve', '/users/{user}/', False),
+    ('notes.list', '/notes/', True),
+    ('notes.list_cursor', '/notes/?paginate=cursor&page_size={page_size}', True),
+    ('notes.retrieve', '/notes/{note}/', False),
+    ('notes.search', '/notes/search/?q=content', True),
+    ('my_notes.list', '/my_notes/', True),
+    ('my_notes.list_cursor', '/my_notes/?paginate=cursor&page_size={page_size}', True),
+    ('my_notes.retrieve', '/my_notes/{note}/', False),
+    ('my_notes.search', '/my_notes/search/?q=content', True),
+    ('my_notes.sync', '/my_notes/sync/', False),
+    ('my_notes.export', '/my_notes/export/', False),
+    ('attachments.list', '/attachments/', True),
+    ('attachments.list_cursor', '/attachments/?paginate=cursor&page_size={page_size}', True),
+    ('attachments.retrieve', '/attachments/{attachment}/', False),
+    ('uploads.retrieve', '/uploads/{upload}/', False),
+    ('metrics.list', '/metrics/', False),
+)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def seed(scale, seed=0):
+    """
+    creates the dataset, returns the ids used in paths of ENDPOINTS, the first user is the user of requests
+    """
+    rng = random.Random(seed)
+    prefix = 'bench_%s_%s_' % (seed, int(time.time() * 1000))
+    User.objects.bulk_create([User(username='%s%s' % (prefix, i)) for i in range(scale['users'])],
+                             batch_size=BATCH_SIZE)
+    user_ids = list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+    subject = user_ids[0]
+    # reads /metrics/ too
+    User.objects.filter(pk=subject).update(is_staff=True)
+
+    Colors.objects.bulk_create([Colors(color='#%06X' % rng.randrange(0x1000000)) for _ in range(COLORS)])
+    color_ids = list(Colors.objects.order_by('-id').values_list('id', flat=True)[:COLORS])
+    Labels.objects.bulk_create([Labels(title='%slabel %s' % (prefix, i)) for i in range(scale['labels'])],
+                               batch_size=BATCH_SIZE)
+    label_ids = list(Labels.objects.filter(title__startswith=prefix).values_list('id', flat=True))
+    # categories are saved one by one for their materialized paths
+    category_ids = []
+    parents = [None]
+    for depth in range(scale['category_depth']):
+        level = []
+        for parent in parents:
+            for i in range(CATEGORY_BRANCHING):
+                level.append(Categories.objects.create(title='%s%s.%s' % (prefix, depth, i), parent_id=parent).pk)
+        category_ids += level
+        parents = level
+
+    # half of the notes belong to the user of requests
+    owners = [subject if rng.random() < 0.5 else rng.choice(user_ids) for _ in range(scale['notes'])]
+    Note.objects.bulk_create(
+        [Note(title='%snote %s' % (prefix, i), content='content %s' % rng.random(), owner_id=owner,
+              color_id=rng.choice(color_ids)) for i, owner in enumerate(owners)],
+        batch_size=BATCH_SIZE
+    )
+    owner_of = dict(Note.objects.filter(title__startswith=prefix).values_list('id', 'owner_id'))
+    note_ids = sorted(owner_of)
+    relations = (
+        (Note.label.through, 'labels_id', label_ids),
+        (Note.category.through, 'categories_id', category_ids),
+    )
+    for through, column, ids in relations:
+        through.objects.bulk_create(
+            [through(note_id=note_id, **{column: related})
+             for note_id in note_ids for related in rng.sample(ids, min(3, len(ids)))],
+            batch_size=BATCH_SIZE
+        )
+    pairs = set()
+    while len(pairs) < min(scale['delegations'], len(note_ids) * (len(user_ids) - 1)):
+        note_id, user_id = rng.choice(note_ids), rng.choice(user_ids)
+        if owner_of[note_id] != user_id:
+            pairs.add((note_id, user_id))
+    through = Note.delegated.through
+    through.objects.bulk_create([through(note_id=n, user_id=u) for n, u in sorted(pairs)], batch_size=BATCH_SIZE)
+
+    Attachments.objects.bulk_create(
+        [Attachments(title='%sattachment %s' % (prefix, i), file='attachments/bench/%s.txt' % i,
+                     owner_id=subject if rng.random() < 0.5 else rng.choice(user_ids))
+         for i in range(scale['attachments'])],
+        batch_size=BATCH_SIZE
+    )
+    attachment_ids = list(Attachments.objects.filter(title__startswith=prefix).values_list('id', flat=True))
+    through = Note.file.through
+    through.objects.bulk_create(
+        [through(note_id=rng.choice(note_ids), attachments_id=i) for i in attachment_ids], batch_size=BATCH_SIZE
+    )
+    upload = UploadSession.objects.create(owner_id=subject, title='%supload' % prefix, file='uploads/bench', size=100)
+    # indexes the notes for search like other bulk writes
+    notes_bulk_saved.send(sender=Note, note_ids=note_ids, using=connection.alias)
+    return {
+        'user': subject,
+        'note': Note.objects.filter(owner_id=subject, pk__in=note_ids).values_list('id', flat=True).first(),
+        'label': label_ids[0],
+        'category': category_ids[-1],
+        'attachment': Attachments.objects.filter(owner_id=subject, pk__in=attachment_ids)
+                                         .values_list('id', flat=True).first(),
+        'upload': upload.pk,
+    }
+
+
+def reset_caches(user_id):
+    """
+    makes cached responses and reference tables cold, also to drop the rows of a rolled back dataset
+    """
+    for name in ('labels', 'categories', 'users', 'colors', 'notes', 'attachments', 'attachments:%s' % user_id):
+        bump_generation(name)
+    for cache in reference.REFERENCES.values():
+        cache.clear()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def measure(client, path, repeat):
+    """
+    requests the path repeat times, the first request runs with cold caches
+    """
+    latencies = []
+    queries = []
+    started = time.time()
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            start = time.time()
+            response = client.get(path, HTTP_ACCEPT='application/json')
+            if response.streaming:
+                b''.join(response.streaming_content)
+            latencies.append((time.time() - start) * 1000)
+        if response.status_code != 200:
+            raise BenchmarkError('%s returned status %s' % (path, response.status_code))
+        queries.append(len(context))
+    elapsed = time.time() - started
+    return {
+        'path': path,
+        'cold_queries': queries[0],
+        'queries': queries[-1],
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'requests_per_second': round(repeat / elapsed, 1) if elapsed else None,
+    }
+
+
+def run(ids, repeat=20, endpoints=ENDPOINTS):
+    """
+    results of all endpoints for the page size of settings and the query counts of lists for PAGE_SIZES
+    """
+    client = Client(SERVER_NAME='localhost')
+    client.force_login(User.objects.get(pk=ids['user']))
+    results = {'endpoints': {}, 'growth': {}}
+    default_page_size = PageNumberPagination.page_size
+    for name, path, paged in endpoints:
+        reset_caches(ids['user'])
+        results['endpoints'][name] = measure(client, path.format(page_size=default_page_size, **ids), repeat)
+        if not paged:
+            continue
+        counts = []
+        for page_size in PAGE_SIZES:
+            reset_caches(ids['user'])
+            PageNumberPagination.page_size = page_size
+            try:
+                counts.append(measure(client, path.format(page_size=page_size, **ids), 1)['cold_queries'])
+            finally:
+                PageNumberPagination.page_size = default_page_size
+        results['growth'][name] = counts
+    reset_caches(ids['user'])
+    return results
+
+
+def compare(results, baseline=None, threshold=0.25):
+    """
+    descriptions of regressions: queries growing with the page size, more queries than the baseline
+    or latency above the baseline by more than threshold
+    """
+    regressions = []
+    for name, counts in sorted(results['growth'].items()):
+        if len(set(counts)) > 1:
+            regressions.append('%s: queries grow with the page size %s' % (
+                name, ', '.join('%s: %s' % pair for pair in zip(PAGE_SIZES, counts))))
+    if baseline is None:
+        return regressions
+    for name, result in sorted(results['endpoints'].items()):
+        base = baseline['endpoints'].get(name)
+        if base is None:
+            continue
+        for key in ('cold_queries', 'queries'):
+            if result[key] > base[key]:
+                regressions.append('%s: %s %s, baseline %s' % (name, key, result[key], base[key]))
+        limit = base['p50_ms'] * (1 + threshold)
+        if result['p50_ms'] > limit and result['p50_ms'] - base['p50_ms'] > LATENCY_NOISE_MS:
+            regressions.append('%s: p50 %.3f ms, baseline %.3f ms' % (name, result['p50_ms'], base['p50_ms']))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as baseline:
+        return json.load(baseline)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as baseline:
+        json.dump(results, baseline, indent=2, sort_keys=True)
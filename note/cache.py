@@ -0,0 +1,119 @@
+"""
+Cached responses and values invalidated by generation counters.
+
+A value is cached under the generations of the tables it reads and invalidate() of note/signals.py bumps
+the generation of a table, so every process has to read the counters from one shared cache:
+the default cache of CACHES must be memcached, redis or another cache shared by the processes.
+A cache in the memory of a process, e.g. LocMemCache, is only correct with one process like in tests,
+with several workers a bump is not seen by the others and they serve stale values until CACHE_TIMEOUT.
+The note.W001 system check warns about such a default cache.
+"""
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from note.routers import replica_may_be_stale, reading_from_replica
+
+# backends whose values are not seen by other processes
+PROCESS_CACHES = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+# cached values are also invalidated by generations, the timeout only limits the memory
+CACHE_TIMEOUT = 60 * 60
+# a miss is built by one request, others wait for its value up to COALESCE_WAIT seconds
+COALESCE_LOCK_TIMEOUT = 10
+COALESCE_WAIT = 2.0
+COALESCE_POLL_INTERVAL = 0.02
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """
+    system check of the default cache, generations bumped by a process have to be seen by the others
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_CACHES:
+        return []
+    return [checks.Warning(
+        'The default cache %s is not shared by processes, cached responses and reference tables '
+        'of other workers are not invalidated.' % backend,
+        hint='Use memcached or redis in CACHES, silence note.W001 only for a single process.',
+        id='note.W001',
+    )]
+
+
+def generation_key(name):
+    return 'note:generation:%s' % name
+
+
+def generation_time_key(name):
+    return 'note:generation-time:%s' % name
+
+
+def get_generations(names):
+    """
+    returns a list of current generation counters for the names
+    """
+    keys = [generation_key(name) for name in names]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            # start from the current time, so an evicted counter never repeats an old generation
+            cache.add(key, int(time.time() * 1000), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def bump_generation(name):
+    """
+    invalidates all values cached with the generation
+    """
+    key = generation_key(name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000), None)
+    cache.set(generation_time_key(name), time.time(), None)
+
+
+def get_generations_time(names):
+    """
+    returns the unix time of the last bump of any of the generations
+    """
+    keys = [generation_time_key(name) for name in names]
+    times = cache.get_many(keys)
+    for key in keys:
+        if key not in times:
+            # unknown (evicted) time must not make a client copy look fresh
+            times[key] = time.time()
+            cache.add(key, times[key], None)
+    return max(times.values())
+
+
+def get_or_build(name, generations, builder):
+    """
+    returns the value cached for the current generations or builds and caches it,
+    concurrent misses of a key wait for the first one instead of building the value again
+    """
+    versions = ':'.join(str(i) for i in get_generations(generations))
+    key = 'note:%s:%s' % (name, versions)
+    value = cache.get(key)
+    if value is not None:
+        return value
+    lock_key = key + ':building'
+    locked = cache.add(lock_key, 1, COALESCE_LOCK_TIMEOUT)
+    if not locked:
+        deadline = time.time() + COALESCE_WAIT
+        while time.time() < deadline:
+            time.sleep(COALESCE_POLL_INTERVAL)
+            value = cache.get(key)
+            if value is not None:
+                return value
+        # the builder is too slow or died, build it here too
+    try:
+        value = builder()
+        # a replica may not have the changes of a recent bump yet, such a value must not be cached for it
+        if not (reading_from_replica() and replica_may_be_stale(get_generations_time(generations))):
+            cache.set(key, value, CACHE_TIMEOUT)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
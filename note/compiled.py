@@ -0,0 +1,236 @@
+"""
+Compiled read-only serializers.
+
+compile_serializer() turns the fields of a ModelSerializer into a plan: the columns of one values_list() query
+of the model, one values_list() query of the through table per nested many to many serializer and a generated
+flat function which builds the OrderedDict of a row from one list of pairs, so notes are rendered without model
+instances and field calls. The output is the output of the serializer with its keys in the order of the fields,
+supported are plain model fields, reference fields, nested many to many serializers of plain and file fields
+and StringRelatedField of models in STRING_COLUMNS.
+
+A CompiledSerializer subclass replaces its serializer_class in views with NOTES_COMPILED_SERIALIZERS,
+its instances only need the primary key.
+"""
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import fields as drf_fields, serializers, relations
+from note.models import Colors, Labels, Categories
+
+COMPILED_ENABLED = getattr(settings, 'NOTES_COMPILED_SERIALIZERS', False)
+# models rendered by str() and the column str() returns
+STRING_COLUMNS = {User: User.USERNAME_FIELD, Colors: 'color', Labels: 'title', Categories: 'title'}
+# fields whose representation of a database value is the value
+PLAIN_FIELDS = (drf_fields.CharField, drf_fields.IntegerField, drf_fields.BooleanField, drf_fields.ReadOnlyField)
+
+_plans = {}
+
+
+class NotCompilable(Exception):
+    pass
+
+
+class Plan(object):
+
+    def __init__(self, model, columns, relations, converters, function):
+        self.model = model
+        # values_list() lookups of the model, the first is the primary key
+        self.columns = columns
+        # (through model, column of the model, lookups of the related rows, function of a related row,
+        #  makers of its converters)
+        self.relations = relations
+        # (make(context) -> convert(value)) passed to function after the relations
+        self.converters = converters
+        self.function = function
+
+    def render(self, pks, context=None, using=None):
+        """
+        representations of the existing rows of pks in the order of pks
+        """
+        context = context or {}
+        queryset = self.model._default_manager.using(using) if using else self.model._default_manager
+        rows = {row[0]: row for row in queryset.filter(pk__in=pks).values_list(*self.columns)}
+        groups = []
+        for through, column, lookups, function, makers in self.relations:
+            related_converters = [make(context) for make in makers]
+            group = defaultdict(list)
+            # related rows by id like the prefetch of EagerLoadingMixin
+            related = through.objects.filter(**{column + '__in': list(rows)}).order_by(*lookups[:2])
+            for row in related.values_list(*lookups):
+                group[row[0]].append(function(row, *related_converters))
+            groups.append(group)
+        converters = [make(context) for make in self.converters]
+        function = self.function
+        return [function(rows[pk], *(groups + converters)) for pk in pks if pk in rows]
+
+
+def reference_converter(field):
+    def make(context):
+        cache = {}
+
+        def convert(value):
+            if value not in cache:
+                cache[value] = field.to_representation(value) if value is not None else None
+            return cache[value]
+        return convert
+    return make
+
+
+def file_converter(model_field):
+    storage = model_field.storage
+
+    def make(context):
+        request = context.get('request')
+
+        def convert(name):
+            if not name:
+                return None
+            url = storage.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+        return convert
+    return make
+
+
+def generate(name, items, arguments):
+    """
+    a function of a row, items are (key, expression of the row)
+    """
+    source = 'def %s(%s):\n    return OrderedDict([%s])\n' % (
+        name, ', '.join(['row'] + arguments), ', '.join('(%r, %s)' % item for item in items))
+    namespace = {'OrderedDict': OrderedDict}
+    exec(compile(source, '<compiled %s>' % name, 'exec'), namespace)
+    return namespace[name]
+
+
+def readable_fields(serializer):
+    return [field for field in serializer.fields.values() if not field.write_only]
+
+
+def compile_serializer(serializer_class):
+    """
+    the Plan of a ModelSerializer, NotCompilable for unsupported fields
+    """
+    if serializer_class not in _plans:
+        _plans[serializer_class] = build_plan(serializer_class)
+    return _plans[serializer_class]
+
+
+def build_plan(serializer_class):
+    model = serializer_class.Meta.model
+    opts = model._meta
+    columns = [opts.pk.attname]
+    items = []
+    relation_plans = []
+    converters = []
+    # arguments of the function: rows of relations first, converters after them
+    converter_items = []
+    fields = readable_fields(serializer_class())
+    for field in fields:
+        if len(field.source_attrs) != 1:
+            raise NotCompilable('%s.%s has a dotted source' % (serializer_class.__name__, field.field_name))
+        source = field.source_attrs[0]
+        if isinstance(field, serializers.ListSerializer):
+            relation_plans.append((field.field_name, source, field.child))
+        elif hasattr(field, 'reference'):
+            converter_items.append((field.field_name, len(columns), reference_converter(field)))
+            columns.append(source)
+        elif isinstance(field, relations.StringRelatedField):
+            related_model = opts.get_field(source).related_model
+            if related_model not in STRING_COLUMNS:
+                raise NotCompilable('str() of %s is unknown' % related_model.__name__)
+            items.append((field.field_name, 'row[%s]' % len(columns)))
+            columns.append('%s__%s' % (source, STRING_COLUMNS[related_model]))
+        elif isinstance(field, PLAIN_FIELDS) and not is_relation(opts, source):
+            items.append((field.field_name, 'row[%s]' % len(columns)))
+            columns.append(source)
+        else:
+            raise NotCompilable('%s.%s is a %s' % (serializer_class.__name__, field.field_name,
+                                                   type(field).__name__))
+
+    for index, (field_name, source, child) in enumerate(relation_plans):
+        relation_plans[index] = build_relation(model, source, child)
+        items.append((field_name, 'relation_%s.get(row[0]) or []' % index))
+    for field_name, column, make in converter_items:
+        items.append((field_name, 'converter_%s(row[%s])' % (len(converters), column)))
+        converters.append(make)
+    # keys in the order of the serializer fields
+    order = [field.field_name for field in fields]
+    items.sort(key=lambda item: order.index(item[0]))
+    arguments = ['relation_%s' % i for i in range(len(relation_plans))] + \
+                ['converter_%s' % i for i in range(len(converters))]
+    function = generate('render_%s' % serializer_class.__name__.lower(), items, arguments)
+    return Plan(model, columns, relation_plans, converters, function)
+
+
+def is_relation(opts, name):
+    try:
+        return opts.get_field(name).is_relation
+    except FieldDoesNotExist:
+        raise NotCompilable('%s is not a field of %s' % (name, opts.model.__name__))
+
+
+def build_relation(model, source, child):
+    """
+    (through model, column of the model, lookups, function of a related row, makers of its converters)
+    of a nested many to many serializer
+    """
+    field = model._meta.get_field(source)
+    if not field.many_to_many or field.model is not model:
+        raise NotCompilable('%s is not a many to many field of %s' % (source, model.__name__))
+    through = field.remote_field.through
+    column = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    related_opts = field.related_model._meta
+    lookups = [column, '%s__%s' % (target, related_opts.pk.attname)]
+    items = []
+    make_converters = []
+    for nested in readable_fields(child):
+        nested_source = nested.source_attrs[0] if len(nested.source_attrs) == 1 else None
+        if nested_source is None:
+            raise NotCompilable('%s.%s has a dotted source' % (source, nested.field_name))
+        if isinstance(nested, drf_fields.FileField):
+            items.append((nested.field_name, 'converter_%s(row[%s])' % (len(make_converters), len(lookups))))
+            make_converters.append(file_converter(related_opts.get_field(nested_source)))
+        elif isinstance(nested, PLAIN_FIELDS) and not is_relation(related_opts, nested_source):
+            items.append((nested.field_name, 'row[%s]' % len(lookups)))
+        else:
+            raise NotCompilable('%s.%s is a %s' % (source, nested.field_name, type(nested).__name__))
+        lookups.append('%s__%s' % (target, nested_source))
+    function = generate('render_%s' % source, items, ['converter_%s' % i for i in range(len(make_converters))])
+    return through, column, lookups, function, make_converters
+
+
+class CompiledSerializer(serializers.BaseSerializer):
+    """
+    Read-only serializer rendering instances by the compiled plan of serializer_class
+    """
+    serializer_class = None
+    # loaded by views for the lookup and pagination, the rest is read by the plan
+    load_fields = ('id',)
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        return queryset.select_related(None).prefetch_related(None).only(*cls.load_fields)
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        serializer = CompiledListSerializer(*args, **kwargs)
+        serializer.compiled_class = cls
+        return serializer
+
+    def to_representation(self, instance):
+        plan = compile_serializer(self.serializer_class)
+        return plan.render([instance.pk], self.context, instance._state.db)[0]
+
+
+class CompiledListSerializer(serializers.BaseSerializer):
+    compiled_class = None
+
+    def to_representation(self, instances):
+        instances = list(instances)
+        if not instances:
+            return []
+        plan = compile_serializer(self.compiled_class.serializer_class)
+        return plan.render([instance.pk for instance in instances], self.context, instances[0]._state.db)
@@ -0,0 +1,76 @@
+"""
+Conditional GET for viewset actions.
+
+The state of a response is a weak ETag and an optional Last-Modified computed from cheap sources:
+date_editing of notes, aggregates over the visible notes and generation counters of the tables,
+so 304 responses are returned without serializing the body.
+"""
+import hashlib
+from functools import wraps
+
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+from note.cache import get_generations, get_generations_time
+from note.routers import replica_may_be_stale
+
+
+def make_etag(*parts):
+    """
+    weak ETag from the parts of the state, the request path and the media type must be passed for collections
+    """
+    return 'W/"%s"' % hashlib.md5(':'.join(str(i) for i in parts).encode('utf-8')).hexdigest()
+
+
+def strip_weak(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def not_modified(request, etag, last_modified):
+    """
+    If-None-Match takes precedence over If-Modified-Since, the weak comparison is used for both
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        return strip_weak(etag) in [strip_weak(i) for i in if_none_match.split(',')]
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return last_modified is not None and if_modified_since is not None and int(last_modified) <= if_modified_since
+
+
+def conditional(state_func):
+    """
+    Decorator of a viewset action,
+    state_func(view, request, *args, **kwargs) returns (etag, last modified unix time or None)
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            etag, last_modified = state_func(self, request, *args, **kwargs)
+            if not_modified(request, etag, last_modified):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                response = method(self, request, *args, **kwargs)
+            # a body read from a lagging replica must not be cached by the client under the new ETag
+            if last_modified is not None and response.status_code == status.HTTP_200_OK and \
+                    replica_may_be_stale(last_modified):
+                return response
+            if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+                response['ETag'] = etag
+                if last_modified is not None:
+                    response['Last-Modified'] = http_date(last_modified)
+            return response
+        return wrapper
+    return decorator
+
+
+def generations_state(*names):
+    """
+    state of a resource which changes only with the generation counters
+    """
+    def state(view, request, *args, **kwargs):
+        etag = make_etag(request.accepted_media_type, request.get_full_path(), *get_generations(names))
+        return etag, get_generations_time(names)
+    return state
@@ -0,0 +1,159 @@
+"""
+A bounded pool of database connections shared by the threads of a process.
+
+Connections are checked out by the pooled backend instead of opening them and returned instead of closing them.
+A returned connection is reset and kept until MAX_LIFETIME, an idle one is pinged by check()
+before it is reused after HEALTH_CHECK_INTERVAL. A pool inherited by a forked process drops
+the connections of the parent without closing them, since their sockets are shared.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+POOL_DEFAULTS = {
+    'MAX_SIZE': 10,
+    # seconds to wait for a free connection when MAX_SIZE are checked out
+    'TIMEOUT': 5.0,
+    'MAX_LIFETIME': 30 * 60,
+    'HEALTH_CHECK_INTERVAL': 30,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = self.returned = time.time()
+
+
+class ConnectionPool(object):
+    """
+    connect() opens a connection, check(connection) returns whether it works,
+    reset(connection) prepares a returned connection for the next checkout and close(connection) closes it
+    """
+
+    def __init__(self, connect, check, reset, close, max_size, timeout, max_lifetime, health_check_interval):
+        self.connect = connect
+        self.check = check
+        self.reset = reset
+        self.close = close
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.condition = threading.Condition()
+        self.idle = deque()
+        # raw connection id -> PooledConnection
+        self.in_use = {}
+        self.pid = os.getpid()
+        self.stats = dict.fromkeys(('checkouts', 'hits', 'misses', 'waits', 'timeouts', 'discarded'), 0)
+        self.stats['wait_time'] = 0.0
+
+    def after_fork(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle.clear()
+            self.in_use.clear()
+            self.stats = dict.fromkeys(self.stats, 0)
+
+    def checkout(self):
+        with self.condition:
+            self.after_fork()
+            self.stats['checkouts'] += 1
+            started = None
+            while True:
+                while self.idle:
+                    pooled = self.idle.pop()
+                    if self.usable(pooled):
+                        self.stats['hits'] += 1
+                        self.in_use[id(pooled.connection)] = pooled
+                        return pooled.connection
+                    self.discard(pooled)
+                if len(self.in_use) < self.max_size:
+                    break
+                if started is None:
+                    started = time.time()
+                    self.stats['waits'] += 1
+                remaining = started + self.timeout - time.time()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    self.stats['wait_time'] += time.time() - started
+                    raise PoolTimeout('no free connection in %s seconds' % self.timeout)
+                self.condition.wait(remaining)
+            if started is not None:
+                self.stats['wait_time'] += time.time() - started
+            self.stats['misses'] += 1
+            # reserve the slot, the connection is opened outside the lock
+            placeholder = object()
+            self.in_use[id(placeholder)] = placeholder
+        try:
+            connection = self.connect()
+        except Exception:
+            with self.condition:
+                del self.in_use[id(placeholder)]
+                self.condition.notify()
+            raise
+        with self.condition:
+            del self.in_use[id(placeholder)]
+            self.in_use[id(connection)] = PooledConnection(connection)
+        return connection
+
+    def checkin(self, connection, discard=False):
+        with self.condition:
+            self.after_fork()
+            pooled = self.in_use.pop(id(connection), None)
+            self.condition.notify()
+        if pooled is None:
+            # opened before a fork or by another pool
+            return
+        if discard or time.time() - pooled.created > self.max_lifetime or not self.reset(connection):
+            self.discard(pooled)
+            return
+        pooled.returned = time.time()
+        with self.condition:
+            self.idle.append(pooled)
+            self.condition.notify()
+
+    def usable(self, pooled):
+        now = time.time()
+        if now - pooled.created > self.max_lifetime:
+            return False
+        return now - pooled.returned < self.health_check_interval or self.check(pooled.connection)
+
+    def discard(self, pooled):
+        with self.condition:
+            self.stats['discarded'] += 1
+        try:
+            self.close(pooled.connection)
+        except Exception:
+            pass
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats, size=self.max_size, in_use=len(self.in_use), idle=len(self.idle))
+        return stats
+
+
+def get_pool(alias, factory):
+    """
+    the pool of the database alias in this process, factory() creates it
+    """
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = factory()
+        return _pools[alias]
+
+
+def pool_stats():
+    """
+    {alias: counters} of pools of this process
+    """
+    return {alias: pool.get_stats() for alias, pool in list(_pools.items())}
@@ -0,0 +1,81 @@
+"""
+PostgreSQL backend which takes connections from a ConnectionPool of the process.
+
+    DATABASES['default'] = {
+        'ENGINE': 'note.db.pooled_postgresql',
+        ...
+        'POOL': {'MAX_SIZE': 10, 'TIMEOUT': 5, 'MAX_LIFETIME': 1800, 'HEALTH_CHECK_INTERVAL': 30},
+    }
+
+CONN_MAX_AGE should stay 0, the connection of a request then goes back to the pool at its end
+and is reused by any thread of the process. MAX_SIZE bounds the connections of a process,
+so PostgreSQL max_connections must cover MAX_SIZE times the number of processes.
+"""
+from django.db.backends.postgresql import base
+from note.db.pool import ConnectionPool, POOL_DEFAULTS, get_pool
+
+Database = base.Database
+
+
+def check(connection):
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        # the check must not leave a transaction open
+        connection.rollback()
+    except Database.Error:
+        return False
+    return True
+
+
+def reset(connection):
+    """
+    returns the connection to the state of a new one, session settings like the time zone are kept
+    """
+    if connection.closed:
+        return False
+    try:
+        if connection.get_transaction_status() != Database.extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+        # a new connection is not in autocommit, get_new_connection() reads its isolation level
+        connection.autocommit = False
+    except Database.Error:
+        return False
+    return True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_pool(self, conn_params):
+        def factory():
+            options = dict(POOL_DEFAULTS, **self.settings_dict.get('POOL', {}))
+            return ConnectionPool(
+                lambda: Database.connect(**conn_params), check, reset, lambda connection: connection.close(),
+                max_size=options['MAX_SIZE'], timeout=options['TIMEOUT'], max_lifetime=options['MAX_LIFETIME'],
+                health_check_interval=options['HEALTH_CHECK_INTERVAL']
+            )
+        # the test runner and _nodb_connection use other databases of the same alias
+        return get_pool('%s:%s' % (self.alias, conn_params['database']), factory)
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        connection = self.pool.checkout()
+        # the same as the base backend, which opens the connection itself
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        # a connection closed in an atomic block stays referenced by the wrapper, so it must not be reused
+        broken = self.in_atomic_block or self.errors_occurred and not self.is_usable()
+        self.pool.checkin(self.connection, discard=broken)
@@ -0,0 +1,121 @@
+"""
+Downloads of attachment files without copying them through Python.
+
+With NOTES_SENDFILE_BACKEND the response only names the file and the front-end server sends it:
+"x-accel-redirect" for nginx with an internal location NOTES_SENDFILE_URL aliased to MEDIA_ROOT,
+"x-sendfile" for Apache mod_xsendfile or lighttpd. Without it FileResponse passes the open file
+to wsgi.file_wrapper, which sends it by os.sendfile under gunicorn and uWSGI; single byte ranges
+are served by seeking the file, so the same path is used for them.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import HttpResponse, FileResponse
+from django.utils.http import http_date, urlquote
+from note.conditional import not_modified
+
+SENDFILE_BACKEND = getattr(settings, 'NOTES_SENDFILE_BACKEND', None)
+SENDFILE_URL = getattr(settings, 'NOTES_SENDFILE_URL', '/protected-media/')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeFile(object):
+    """
+    the part of an open file from its current position, fileno() lets the server send it by sendfile
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def file_etag(name, size, mtime):
+    return '"%s"' % hashlib.md5(('%s:%s:%s' % (name, size, mtime)).encode('utf-8')).hexdigest()
+
+
+def parse_range(value, size):
+    """
+    returns (first, last) of a single satisfiable range, None to send the whole file
+    or raises ValueError for an unsatisfiable one
+    """
+    match = RANGE.match(value.strip()) if value else None
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # the last bytes of the file
+        length = int(last)
+        if not length:
+            raise ValueError(value)
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise ValueError(value)
+    return first, last
+
+
+def serve_file(request, storage, name, filename):
+    """
+    response with the file of the storage, filename is sent to the client
+    """
+    path = storage.path(name)
+    stat = os.stat(path)
+    etag = file_etag(name, stat.st_size, int(stat.st_mtime))
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if not_modified(request, etag, int(stat.st_mtime)):
+        response = HttpResponse(status=304)
+    elif SENDFILE_BACKEND == 'x-accel-redirect':
+        # nginx handles ranges and conditional requests of the file itself
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = urlquote(SENDFILE_URL + name)
+    elif SENDFILE_BACKEND == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    else:
+        response = file_response(request, path, stat.st_size, etag, content_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    if response.status_code != 304:
+        response['Content-Disposition'] = "attachment; filename*=UTF-8''%s" % urlquote(filename)
+    return response
+
+
+def file_response(request, path, size, etag, content_type):
+    byte_range = None
+    # If-Range with another version of the file asks for all of it
+    if request.META.get('HTTP_IF_RANGE', etag) == etag:
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+    f = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        first, last = byte_range
+        f.seek(first)
+        response = FileResponse(RangeFile(f, last - first + 1), status=206, content_type=content_type)
+        response['Content-Length'] = last - first + 1
+        response['Content-Range'] = 'bytes %s-%s/%s' % (first, last, size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,41 @@
+"""
+Streaming export of notes.
+
+Notes are read in chunks by id (keyset, no OFFSET), relations are prefetched per chunk
+and every chunk is serialized and encoded before the next one is read,
+so memory does not depend on the number of notes.
+"""
+from rest_framework.utils.encoders import JSONEncoder
+
+EXPORT_CHUNK_SIZE = 500
+
+
+def iterate_notes(queryset, serializer_class, chunk_size=None):
+    """
+    yields serialized notes of the queryset ordered by id
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    last_id = 0
+    while True:
+        chunk = list(serializer_class.setup_eager_loading(queryset.filter(id__gt=last_id).order_by('id'))[:chunk_size])
+        if not chunk:
+            return
+        for item in serializer_class(chunk, many=True).data:
+            yield item
+        last_id = chunk[-1].id
+
+
+def ndjson_lines(items):
+    encoder = JSONEncoder()
+    for item in items:
+        yield encoder.encode(item) + '\n'
+
+
+def json_array(items):
+    encoder = JSONEncoder()
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + encoder.encode(item)
+        separator = ','
+    yield ']'
@@ -0,0 +1,276 @@
+"""
+Query and latency metrics of every view action.
+
+With NOTES_INSTRUMENTATION on, InstrumentationMiddleware wraps the cursors of all database connections
+and records for each action, e.g. "NoteViewSet.list", histograms of the request time, the time in the database,
+the time of the view outside the database (mostly serializers), the rendering time and the number of queries.
+A request which runs the same statement, with literals and IN lists normalized, NPLUSONE_THRESHOLD times
+or more is counted and logged as an N+1 pattern. Responses carry a Server-Timing header.
+
+Metrics are aggregated in the memory of the process and served by /metrics/ to staff users or collectors
+with METRICS_TOKEN, so with several workers every worker reports its own requests.
+The cost is two clock reads per query and a few per request, off it is one attribute lookup per request.
+"""
+import bisect
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENTATION_ENABLED = getattr(settings, 'NOTES_INSTRUMENTATION', False)
+NPLUSONE_THRESHOLD = getattr(settings, 'NOTES_NPLUSONE_THRESHOLD', 10)
+# /metrics/ is served to staff users, to requests with "Authorization: Bearer <NOTES_METRICS_TOKEN>"
+# and to REMOTE_ADDR in NOTES_METRICS_ADDRESSES, which must not list the address of a proxy in front of the workers
+METRICS_TOKEN = getattr(settings, 'NOTES_METRICS_TOKEN', None)
+METRICS_ADDRESSES = getattr(settings, 'NOTES_METRICS_ADDRESSES', ())
+# seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# statements of N+1 patterns kept per action
+NPLUSONE_STATEMENTS = 5
+
+IN_LIST = re.compile(r'\((?:%s, )+%s\)')
+NUMBER = re.compile(r'\b\d+\b')
+STRING = re.compile(r"'(?:[^']|'')*'")
+NORMALIZED_CACHE_SIZE = 1000
+
+_state = threading.local()
+_metrics = {}
+_metrics_lock = threading.Lock()
+_normalized = {}
+
+
+def normalize(sql):
+    """
+    the statement without literals, IN lists of any length are the same
+    """
+    normalized = _normalized.get(sql)
+    if normalized is None:
+        normalized = NUMBER.sub('?', STRING.sub('?', IN_LIST.sub('(%s...)', sql)))
+        if len(_normalized) >= NORMALIZED_CACHE_SIZE:
+            _normalized.clear()
+        _normalized[sql] = normalized
+    return normalized
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last one counts values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'count': self.count, 'sum': round(self.sum, 6), 'buckets': buckets}
+
+
+class ActionMetrics(object):
+
+    def __init__(self):
+        self.total = Histogram(TIME_BUCKETS)
+        self.db = Histogram(TIME_BUCKETS)
+        self.serialize = Histogram(TIME_BUCKETS)
+        self.render = Histogram(TIME_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.nplusone = 0
+        # normalized statement -> the most repetitions in one request
+        self.nplusone_statements = {}
+
+    def as_dict(self):
+        return {
+            'requests': self.total.count,
+            'total': self.total.as_dict(),
+            'db': self.db.as_dict(),
+            'serialize': self.serialize.as_dict(),
+            'render': self.render.as_dict(),
+            'queries': self.queries.as_dict(),
+            'nplusone': self.nplusone,
+            'nplusone_statements': self.nplusone_statements,
+        }
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.view = 'unresolved'
+        self.queries = 0
+        self.db_time = 0
+        self.statements = Counter()
+        self.view_start = self.view_end = self.render_end = None
+        self.view_db_start = self.view_db_end = 0
+
+    def query(self, sql, duration):
+        self.queries += 1
+        self.db_time += duration
+        self.statements[sql] += 1
+
+    def repeated(self):
+        counts = Counter()
+        for sql, count in self.statements.items():
+            counts[normalize(sql)] += count
+        return [(normalized, count) for normalized, count in counts.items() if count >= NPLUSONE_THRESHOLD]
+
+    def timings(self):
+        end = time.time()
+        serialize = render = 0
+        if self.view_start is not None:
+            # responses which are not rendered, e.g. files, end with the request
+            view_end, view_db_end = (self.view_end, self.view_db_end) if self.view_end else (end, self.db_time)
+            serialize = max(view_end - self.view_start - (view_db_end - self.view_db_start), 0)
+            if self.render_end is not None:
+                render = self.render_end - self.view_end
+        return {'total': end - self.start, 'db': self.db_time, 'serialize': serialize, 'render': render}
+
+
+class InstrumentedCursorWrapper(CursorWrapper):
+    """
+    times statements of the wrapped cursor for the request of the thread
+    """
+
+    def execute(self, sql, params=None):
+        stats = getattr(_state, 'stats', None)
+        if stats is None:
+            return self.cursor.execute(sql, params)
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            stats.query(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        stats = getattr(_state, 'stats', None)
+        if stats is None:
+            return self.cursor.executemany(sql, param_list)
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            stats.query(sql, time.time() - start)
+
+
+def install(connection):
+    """
+    wraps cursors of the connection, also the debug cursors used with DEBUG
+    """
+    if getattr(connection, 'instrumented', False):
+        return
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: InstrumentedCursorWrapper(make_cursor(cursor), connection)
+    connection.make_debug_cursor = lambda cursor: InstrumentedCursorWrapper(make_debug_cursor(cursor), connection)
+    connection.instrumented = True
+
+
+def view_name(view_func, request):
+    """
+    the class and method of the view, the action is known when the view returns
+    """
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return '%s.%s' % (view_func.__module__, view_func.__name__)
+    return '%s.%s' % (view_class.__name__, request.method.lower())
+
+
+def action_name(response):
+    """
+    the class and action of a viewset of DRF response, e.g. "NoteViewSet.list", or None
+    """
+    view = getattr(response, 'renderer_context', {}).get('view')
+    action = getattr(view, 'action', None)
+    if action:
+        return '%s.%s' % (type(view).__name__, action)
+
+
+def record(view, timings, queries, repeated):
+    with _metrics_lock:
+        metrics = _metrics.get(view)
+        if metrics is None:
+            metrics = _metrics[view] = ActionMetrics()
+        for name, value in timings.items():
+            getattr(metrics, name).observe(value)
+        metrics.queries.observe(queries)
+        if repeated:
+            metrics.nplusone += 1
+            for normalized, count in repeated:
+                if (normalized in metrics.nplusone_statements or
+                        len(metrics.nplusone_statements) < NPLUSONE_STATEMENTS):
+                    metrics.nplusone_statements[normalized] = max(
+                        count, metrics.nplusone_statements.get(normalized, 0))
+
+
+def get_metrics():
+    """
+    {action: histograms and N+1 counters} of this process
+    """
+    with _metrics_lock:
+        return {view: metrics.as_dict() for view, metrics in _metrics.items()}
+
+
+def reset():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+class InstrumentationMiddleware(object):
+    """
+    goes first in MIDDLEWARE_CLASSES, so the request time includes the other middleware
+    """
+
+    def process_request(self, request):
+        _state.stats = None
+        if not INSTRUMENTATION_ENABLED:
+            return
+        for connection in connections.all():
+            install(connection)
+        _state.stats = RequestStats()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = getattr(_state, 'stats', None)
+        if stats is not None:
+            stats.view = view_name(view_func, request)
+            stats.view_start = time.time()
+            stats.view_db_start = stats.db_time
+
+    def process_template_response(self, request, response):
+        stats = getattr(_state, 'stats', None)
+        if stats is not None:
+            # DRF responses are rendered after this hook
+            stats.view_end = time.time()
+            stats.view_db_end = stats.db_time
+            stats.view = action_name(response) or stats.view
+            response.add_post_render_callback(lambda response: setattr(stats, 'render_end', time.time()))
+        return response
+
+    def process_response(self, request, response):
+        stats = getattr(_state, 'stats', None)
+        if stats is None:
+            return response
+        _state.stats = None
+        timings = stats.timings()
+        repeated = stats.repeated()
+        for normalized, count in repeated:
+            logger.warning('N+1 queries in %s: %s times %s', stats.view, count, normalized)
+        record(stats.view, timings, stats.queries, repeated)
+        response['Server-Timing'] = ', '.join(
+            '%s;dur=%.1f' % (name, timings[name] * 1000) for name in ('total', 'db', 'serialize', 'render'))
+        return response
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from note import benchmark
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Measures latency, throughput and queries of every GET endpoint on a synthetic dataset, ' \
+           'stores the results as a JSON baseline and fails on regressions against a baseline. ' \
+           'The dataset is created inside a transaction and rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(benchmark.SCALES), default='small')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--baseline', help='Compare the results with this JSON file.')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed latency increase over the baseline, 0.25 is 25%%.')
+
+    def handle(self, *args, **options):
+        scale = benchmark.SCALES[options['scale']]
+        try:
+            with transaction.atomic():
+                self.stdout.write('seeding %s dataset' % options['scale'])
+                ids = benchmark.seed(scale, options['seed'])
+                results = benchmark.run(ids, options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+        results.update(scale=options['scale'], dataset=scale, repeat=options['repeat'], seed=options['seed'])
+
+        self.stdout.write('%-26s %8s %8s %8s %8s %8s' % ('endpoint', 'queries', 'cold', 'p50 ms', 'p95 ms', 'req/s'))
+        for name, result in sorted(results['endpoints'].items()):
+            self.stdout.write('%-26s %8s %8s %8.2f %8.2f %8s' % (
+                name, result['queries'], result['cold_queries'], result['p50_ms'], result['p95_ms'],
+                result['requests_per_second']))
+        if options['output']:
+            benchmark.save_baseline(options['output'], results)
+
+        baseline = benchmark.load_baseline(options['baseline']) if options['baseline'] else None
+        regressions = benchmark.compare(results, baseline, options['threshold'])
+        for regression in regressions:
+            self.stderr.write(regression)
+        if regressions:
+            raise CommandError('%s regressions' % len(regressions))
@@ -0,0 +1,79 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from note.models import Note
+from note.permissions import NoteAccess, filter_permitted
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares permission checks of a delegated user on notes with many delegates. ' \
+           'The dataset is created inside a transaction and rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--notes', type=int, default=100)
+        parser.add_argument('--delegates', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                user, notes = self.seed(options)
+                self.compare(user, notes, options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, options):
+        prefix = 'bench_%s_' % int(time.time())
+        User.objects.bulk_create(
+            [User(username='%s%s' % (prefix, i)) for i in range(options['delegates'] + 1)],
+            batch_size=options['batch_size']
+        )
+        users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+        owner, delegates = users[0], users[1:]
+        Note.objects.bulk_create([Note(content='content', owner=owner) for _ in range(options['notes'])])
+        notes = list(Note.objects.filter(owner=owner))
+        through = Note.delegated.through
+        through.objects.bulk_create(
+            [through(note_id=note.id, user_id=user.id) for note in notes for user in delegates],
+            batch_size=options['batch_size']
+        )
+        # the last delegate is the slowest case of the old check
+        return delegates[-1], notes
+
+    def compare(self, user, notes, repeat):
+        def delegated_all():
+            for note in notes:
+                user in note.delegated.all()
+
+        def exists():
+            for note in notes:
+                NoteAccess(user).has_permission(note.pk, note.owner_id, 'PUT')
+
+        def memoized():
+            access = NoteAccess(user)
+            for _ in range(repeat):
+                for note in notes:
+                    access.has_permission(note.pk, note.owner_id, 'PUT')
+
+        def batched():
+            filter_permitted(user, 'PUT', [note.pk for note in notes])
+
+        checks = [
+            ('user in delegated.all()', delegated_all, 1),
+            ('EXISTS per check', exists, 1),
+            ('memo per request x%s' % repeat, memoized, repeat),
+            ('filter_permitted', batched, 1),
+        ]
+        for name, check, count in checks:
+            started = time.time()
+            check()
+            elapsed = (time.time() - started) * 1000 / (len(notes) * count)
+            self.stdout.write('%-30s %8.3f ms per note' % (name, elapsed))
@@ -0,0 +1,60 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from note import benchmark
+from note.compiled import compile_serializer
+from note.models import Note
+from note.serializers import NotePublicListSerializer, NotePublicSingleSerializer, NoteUserListSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares DRF serializers with compiled serializers on a page of notes, rendered to JSON. ' \
+           'The dataset is created inside a transaction and rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--notes', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        scale = dict(benchmark.SCALES['small'], notes=options['notes'], attachments=options['notes'] // 10)
+        try:
+            with transaction.atomic():
+                ids = benchmark.seed(scale)
+                self.compare(User.objects.get(pk=ids['user']), options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def compare(self, user, repeat):
+        renderer = JSONRenderer()
+        note_ids = list(Note.objects.filter(owner=user).order_by('-id').values_list('id', flat=True))
+        self.stdout.write('%-28s %10s %11s %8s' % (
+            'page of %s notes' % len(note_ids), 'DRF ms', 'compiled ms', 'speedup'))
+        for serializer_class in (NotePublicListSerializer, NoteUserListSerializer, NotePublicSingleSerializer):
+            plan = compile_serializer(serializer_class)
+
+            def drf():
+                notes = serializer_class.setup_eager_loading(Note.objects.filter(pk__in=note_ids).order_by('-id'))
+                return renderer.render(serializer_class(notes, many=True).data)
+
+            def fast():
+                return renderer.render(plan.render(note_ids))
+
+            timings = []
+            for function in (drf, fast):
+                started = time.time()
+                for _ in range(repeat):
+                    content = function()
+                timings.append(((time.time() - started) * 1000 / repeat, content))
+            (drf_ms, drf_content), (fast_ms, fast_content) = timings
+            if drf_content != fast_content:
+                raise CommandError('%s: the compiled output differs' % serializer_class.__name__)
+            self.stdout.write('%-28s %10.1f %11.1f %7.1fx' % (
+                serializer_class.__name__, drf_ms, fast_ms, drf_ms / fast_ms))
@@ -0,0 +1,68 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from note.models import Note
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares the owner-or-delegated notes query with Note.objects.visible_to() on a synthetic dataset. ' \
+           'The dataset is created inside a transaction and rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--notes', type=int, default=1000000)
+        parser.add_argument('--delegations', type=int, default=100000)
+        parser.add_argument('--samples', type=int, default=50)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                users = self.seed(options)
+                self.compare(random.sample(users, min(options['samples'], len(users))))
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, options):
+        batch_size = options['batch_size']
+        prefix = 'bench_%s_' % int(time.time())
+        User.objects.bulk_create(
+            [User(username='%s%s' % (prefix, i)) for i in range(options['users'])], batch_size=batch_size
+        )
+        users = list(User.objects.filter(username__startswith=prefix))
+        user_ids = [i.id for i in users]
+        self.stdout.write('seeding %s notes' % options['notes'])
+        for start in range(0, options['notes'], batch_size):
+            count = min(batch_size, options['notes'] - start)
+            Note.objects.bulk_create([Note(content='content', owner_id=random.choice(user_ids)) for _ in range(count)])
+        note_ids = list(Note.objects.filter(owner_id__in=user_ids).values_list('id', flat=True))
+        self.stdout.write('seeding %s delegations' % options['delegations'])
+        through = Note.delegated.through
+        pairs = set()
+        while len(pairs) < options['delegations']:
+            pairs.add((random.choice(note_ids), random.choice(user_ids)))
+        through.objects.bulk_create([through(note_id=n, user_id=u) for n, u in pairs], batch_size=batch_size)
+        return users
+
+    def compare(self, users):
+        queries = [
+            ('owner OR delegated username', lambda user: Note.objects.filter(
+                Q(owner=user) | Q(delegated__username__exact=user.get_username()))),
+            ('visible_to union', lambda user: Note.objects.visible_to(user)),
+        ]
+        for name, query in queries:
+            rows = 0
+            started = time.time()
+            for user in users:
+                rows += len(list(query(user).values_list('id', flat=True)[:1000]))
+            elapsed = (time.time() - started) * 1000 / len(users)
+            self.stdout.write('%-30s %8.2f ms per user, %s rows' % (name, elapsed, rows))
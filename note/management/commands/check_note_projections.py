@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from note.models import NoteProjection
+from note.projection import compare, PROJECTION_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Compares the list projections with the notes, reports missing and stale projections.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PROJECTION_BATCH_SIZE)
+        parser.add_argument('--fix', action='store_true', default=False, help='Rewrite missing and stale projections.')
+
+    def handle(self, *args, **options):
+        missing = stale = 0
+        for note_id, stored, expected in compare(options['batch_size']):
+            if stored == expected:
+                continue
+            if stored is None:
+                missing += 1
+                self.stdout.write('missing: note %s' % note_id)
+            else:
+                stale += 1
+                self.stdout.write('stale: note %s' % note_id)
+            if options['fix']:
+                NoteProjection.objects.update_or_create(note_id=note_id, defaults={'data': expected})
+        self.stdout.write('%s missing, %s stale' % (missing, stale))
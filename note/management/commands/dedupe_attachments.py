@@ -0,0 +1,73 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from note.models import Attachments, ContentBlob
+from note.storage import content_storage, hash_file
+
+
+def remove_unreferenced(names):
+    """
+    removes legacy files which no row refers to anymore
+    """
+    for name in names:
+        if not Attachments.objects.filter(Q(file=name) | Q(preview=name)).exists():
+            try:
+                os.remove(content_storage.path(name))
+            except FileNotFoundError:
+                pass
+
+
+class Command(BaseCommand):
+    help = 'Moves attachment files and previews stored by name into the content-addressed storage, ' \
+           'equal files are stored once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        self.migrated = self.duplicates = self.saved = 0
+        self.blobs = set(ContentBlob.objects.values_list('name', flat=True))
+        # legacy name -> blob name, for rows sharing a file
+        self.moved = {}
+        for attachment in Attachments.objects.order_by('id').iterator():
+            # blobs and the row are changed together and legacy files are removed after the commit,
+            # so an interrupted run leaves rows with existing files and is resumed by running it again
+            with transaction.atomic():
+                self.migrate(attachment, options['dry_run'])
+        self.stdout.write('%s files migrated, %s duplicates, %s bytes saved' % (
+            self.migrated, self.duplicates, self.saved))
+
+    def migrate(self, attachment, dry_run):
+        changed = []
+        for field_name in ('file', 'preview'):
+            field_file = getattr(attachment, field_name)
+            if not field_file or field_file.name.startswith('blobs/'):
+                continue
+            if field_file.name in self.moved:
+                if not dry_run:
+                    content_storage.retain(ContentBlob.objects.get(name=self.moved[field_file.name]))
+                    changed.append((field_name, field_file.name, self.moved[field_file.name]))
+                continue
+            path = content_storage.path(field_file.name)
+            if not os.path.exists(path):
+                self.stderr.write('missing file of attachment %s: %s' % (attachment.pk, field_file.name))
+                continue
+            sha256 = hash_file(path)
+            blob_name = content_storage.blob_name(sha256, field_file.name)
+            if blob_name in self.blobs:
+                self.duplicates += 1
+                self.saved += os.path.getsize(path)
+            self.moved[field_file.name] = blob_name
+            if not dry_run:
+                changed.append((field_name, field_file.name, content_storage.ingest(
+                    path, sha256, field_file.name, keep=True)))
+            self.blobs.add(blob_name)
+            self.migrated += 1
+        if changed:
+            Attachments.objects.filter(pk=attachment.pk).update(
+                **{field_name: blob_name for field_name, legacy, blob_name in changed}
+            )
+            legacy_names = [legacy for field_name, legacy, blob_name in changed]
+            transaction.on_commit(lambda: remove_unreferenced(legacy_names))
@@ -0,0 +1,83 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from note.models import Attachments, AttachmentPreview, ContentBlob, UploadSession
+from note.storage import content_storage
+
+MEDIA_DIRECTORIES = ('blobs', 'attachments')
+REFERENCES = (
+    (ContentBlob, 'name'),
+    (Attachments, 'file'),
+    (Attachments, 'preview'),
+    (AttachmentPreview, 'file'),
+    (UploadSession, 'file'),
+)
+
+
+def walk_files(root, directory):
+    """
+    yields (storage name, modification time) of files, directories are read lazily by scandir
+    """
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, current)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            name = '%s/%s' % (current, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(name)
+            elif entry.is_file(follow_symlinks=False):
+                yield name, entry.stat().st_mtime
+
+
+class Command(BaseCommand):
+    help = 'Removes files of MEDIA_ROOT attachments which are not referenced by any row.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--min-age', type=int, default=24,
+                            help='hours, newer files may belong to a transaction which is not committed yet')
+        parser.add_argument('--dry-run', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.removed = self.size = 0
+        deadline = time.time() - options['min_age'] * 3600
+        batch = []
+        for directory in MEDIA_DIRECTORIES:
+            for name, mtime in walk_files(content_storage.location, directory):
+                if mtime > deadline:
+                    continue
+                batch.append(name)
+                if len(batch) >= options['batch_size']:
+                    self.collect(batch)
+                    batch = []
+        self.collect(batch)
+        if not options['dry_run']:
+            content_storage.reap()
+        self.stdout.write('%s orphaned files removed, %s bytes' % (self.removed, self.size))
+
+    def collect(self, names):
+        """
+        one query per reference for the batch of names
+        """
+        orphans = set(names)
+        for model, field_name in REFERENCES:
+            if not orphans:
+                return
+            orphans -= set(model.objects.filter(**{field_name + '__in': orphans}).values_list(field_name, flat=True))
+        for name in sorted(orphans):
+            path = content_storage.path(name)
+            self.size += os.path.getsize(path)
+            self.removed += 1
+            if self.options['dry_run']:
+                self.stdout.write(name)
+            elif name.startswith('blobs/'):
+                # the same content may be stored again meanwhile, the reaper removes the file under the blob lock
+                ContentBlob.objects.get_or_create(name=name, defaults={'size': 0, 'refcount': 0})
+            else:
+                os.remove(path)
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from note.sync import purge_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Removes sync tombstones older than NOTES_TOMBSTONE_RETENTION_DAYS (30 by default).'
+
+    def handle(self, *args, **options):
+        self.stdout.write('%s tombstones removed' % purge_tombstones())
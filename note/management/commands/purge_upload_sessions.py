@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from note.models import UploadSession
+from note.uploads import abort
+
+
+class Command(BaseCommand):
+    help = 'Aborts resumable uploads which did not receive a chunk for the given hours and removes their files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        sessions = UploadSession.objects.filter(date_editing__lt=timezone.now() - timedelta(hours=options['hours']))
+        count = 0
+        for session in sessions.iterator():
+            abort(session)
+            count += 1
+        self.stdout.write('%s uploads aborted' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from note.storage import content_storage
+
+
+class Command(BaseCommand):
+    help = 'Removes files of attachments and previews which have no references, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        count = content_storage.reap(batch_size=options['batch_size'])
+        self.stdout.write('%s files removed' % count)
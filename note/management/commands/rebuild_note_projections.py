@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from note.models import Note, NoteProjection
+from note.projection import render, PROJECTION_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Writes the list projections of all notes in batches, needed before NOTES_LIST_PROJECTION is turned on.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PROJECTION_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        count = 0
+        last_id = 0
+        while True:
+            note_ids = list(Note.objects.filter(pk__gt=last_id).order_by('pk')
+                            .values_list('pk', flat=True)[:options['batch_size']])
+            if not note_ids:
+                break
+            # written directly, so the projection is ready before the setting is turned on
+            rendered = render(note_ids)
+            NoteProjection.objects.filter(note_id__in=note_ids).delete()
+            NoteProjection.objects.bulk_create(
+                [NoteProjection(note_id=note_id, data=data) for note_id, data in rendered.items()]
+            )
+            count += len(rendered)
+            last_id = note_ids[-1]
+        self.stdout.write('%s notes projected' % count)
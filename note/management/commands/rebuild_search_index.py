@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from note.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of notes in batches by id range.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        with transaction.atomic(using=options['database']):
+            get_backend(options['database']).rebuild(options['batch_size'])
+        self.stdout.write('search index rebuilt')
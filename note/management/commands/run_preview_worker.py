@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from note.previews import PreviewWorker
+
+
+class Command(BaseCommand):
+    help = 'Generates previews of attachments in a pool of processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='0 renders previews in this process')
+        parser.add_argument('--queue-size', type=int, default=None,
+                            help='jobs claimed at once, twice the processes by default')
+        parser.add_argument('--once', action='store_true', help='exit when there are no jobs ready to run')
+
+    def handle(self, *args, **options):
+        worker = PreviewWorker(processes=options['processes'], queue_size=options['queue_size'])
+        try:
+            worker.run(once=options['once'])
+        except KeyboardInterrupt:
+            pass
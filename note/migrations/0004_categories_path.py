@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 04:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    categories = apps.get_model("note", "Categories")
+    children = {}
+    for category in categories.objects.all():
+        children.setdefault(category.parent_id, []).append(category)
+    level = [(i, '') for i in children.get(None, [])]
+    while level:
+        next_level = []
+        for category, parent_path in level:
+            category.path = parent_path + '%010d/' % category.pk
+            category.save(update_fields=['path'])
+            next_level.extend((i, category.path) for i in children.get(category.pk, []))
+        level = next_level
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0003_auto_20160425_0842'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categories',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 04:29
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0004_categories_path'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='attachments',
+            index_together=set([('owner', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='note',
+            index_together=set([('owner', 'date_editing', 'id'), ('date_editing', 'id')]),
+        ),
+    ]
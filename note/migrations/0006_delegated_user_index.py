@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0005_keyset_indexes'),
+    ]
+
+    operations = [
+        # covering index for delegated note ids of a user, Note.objects.visible_to()
+        migrations.RunSQL(
+            ['CREATE INDEX notes_delegated_user_id_note_id ON notes_delegated (user_id, note_id)'],
+            ['DROP INDEX notes_delegated_user_id_note_id'],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from note.search import get_backend
+
+
+def create_search_index(apps, schema_editor):
+    backend = get_backend(schema_editor.connection.alias)
+    backend.create()
+    backend.rebuild(batch_size=10000)
+
+
+def drop_search_index(apps, schema_editor):
+    get_backend(schema_editor.connection.alias).drop()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0006_delegated_user_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 04:34
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('note', '0007_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('note_id', models.IntegerField()),
+                ('reason', models.CharField(choices=[('deleted', 'Deleted'), ('revoked', 'Delegation revoked')], max_length=10)),
+                ('date_deleted', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'note_tombstones',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='notetombstone',
+            index_together=set([('user', 'date_deleted')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 04:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import note.models
+import note.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0009_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentBlob',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'content_blobs',
+            },
+        ),
+        migrations.AlterField(
+            model_name='attachments',
+            name='file',
+            field=models.FileField(storage=note.storage.ContentAddressedStorage(), upload_to=note.models.content_file_name),
+        ),
+        migrations.AlterField(
+            model_name='attachments',
+            name='preview',
+            field=models.ImageField(blank=True, null=True, storage=note.storage.ContentAddressedStorage(), upload_to=note.models.preview_file_name),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 04:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import note.models
+import note.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0010_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentPreview',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveSmallIntegerField()),
+                ('file', models.ImageField(storage=note.storage.ContentAddressedStorage(), upload_to=note.models.attachment_preview_file_name)),
+            ],
+            options={
+                'db_table': 'attachment_previews',
+                'ordering': ('size',),
+            },
+        ),
+        migrations.CreateModel(
+            name='PreviewJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=8)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'db_table': 'preview_jobs',
+            },
+        ),
+        migrations.AddField(
+            model_name='attachments',
+            name='preview_status',
+            field=models.CharField(choices=[('none', 'No preview'), ('pending', 'Preview is being generated'), ('done', 'Preview is ready'), ('failed', 'Preview generation failed'), ('unsupported', 'File type has no preview')], default='none', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='previewjob',
+            name='attachment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='preview_jobs', to='note.Attachments'),
+        ),
+        migrations.AddField(
+            model_name='attachmentpreview',
+            name='attachment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='previews', to='note.Attachments'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='previewjob',
+            unique_together=set([('attachment', 'source')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='previewjob',
+            index_together=set([('status', 'run_after')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 04:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0011_preview_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='contentblob',
+            name='refcount',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 04:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('note', '0012_content_blob_refcount_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteProjection',
+            fields=[
+                ('note', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='projection', serialize=False, to='note.Note')),
+                ('data', models.TextField()),
+            ],
+            options={
+                'db_table': 'note_projections',
+            },
+        ),
+    ]
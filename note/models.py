@@ -1,5 +1,25 @@
+import uuid
+
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.utils import timezone
 from django.contrib.auth.models import User
+from note.storage import content_storage
+
+
+class NoteQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Notes owned by the user or delegated to the user.
+        Ids are collected by a UNION of two index scans by user id instead of OR over a join with auth_user.
+        """
+        return self.extra(
+            where=['notes.id IN (SELECT id FROM notes WHERE owner_id = %s '
+                   'UNION SELECT note_id FROM notes_delegated WHERE user_id = %s)'],
+            params=[user.pk, user.pk]
+        )
 
 
 class Note(models.Model):
@@ -19,6 +39,8 @@ class Note(models.Model):
     file = models.ManyToManyField('Attachments', blank=True,
                                   related_name='attach')
 
+    objects = NoteQuerySet.as_manager()
+
     def __str__(self):
         if not self.title:
             return 'Untitled'
@@ -28,6 +50,20 @@ class Note(models.Model):
         db_table = 'notes'
         verbose_name = 'Note'
         verbose_name_plural = 'Notes'
+        # keyset pagination of public and users lists
+        index_together = [('date_editing', 'id'), ('owner', 'date_editing', 'id')]
+
+
+class NoteProjection(models.Model):
+    """
+    The list representation of a note as JSON, maintained by signals when NOTES_LIST_PROJECTION is on,
+    so a page of the users list is one query.
+    """
+    note = models.OneToOneField(Note, primary_key=True, related_name='projection')
+    data = models.TextField()
+
+    class Meta:
+        db_table = 'note_projections'
 
 
 class Colors(models.Model):
@@ -47,10 +83,57 @@ class Categories(models.Model):
     title = models.CharField(max_length=200)
     parent = models.ForeignKey('self', blank=True, null=True,
                                related_name='sub_category', on_delete=models.SET_NULL)
+    # materialized path: zero padded ids of all ancestors and the category itself, "0000000001/0000000004/"
+    path = models.CharField(max_length=255, db_index=True, editable=False, default='')
 
     def __str__(self):
         return self.title
 
+    @staticmethod
+    def path_segment(pk):
+        return '%010d/' % pk
+
+    def save(self, *args, **kwargs):
+        """
+        Keep the path of the category and all its descendants consistent with the parent.
+        """
+        old_path = ''
+        if self.pk:
+            old_path = Categories.objects.filter(pk=self.pk).values_list('path', flat=True).first() or ''
+        parent_path = ''
+        if self.parent_id:
+            parent_path = Categories.objects.values_list('path', flat=True).get(pk=self.parent_id)
+            if old_path and parent_path.startswith(old_path):
+                raise ValueError('A category cannot be moved into its own subtree')
+        self.path = old_path
+        super(Categories, self).save(*args, **kwargs)
+        self.path = parent_path + self.path_segment(self.pk)
+        if not old_path:
+            Categories.objects.filter(pk=self.pk).update(path=self.path)
+        elif old_path != self.path:
+            Categories.rebase(old_path, self.path)
+
+    @staticmethod
+    def rebase(old_path, new_path):
+        """
+        Move a subtree with one UPDATE replacing the path prefix
+        """
+        Categories.objects.filter(path__startswith=old_path).update(
+            path=Concat(Value(new_path), Substr('path', len(old_path) + 1))
+        )
+
+    def get_descendants(self, include_self=False):
+        queryset = Categories.objects.filter(path__startswith=self.path)
+        if not include_self:
+            queryset = queryset.exclude(pk=self.pk)
+        return queryset
+
+    def get_notes(self):
+        """
+        returns notes of the category and all its descendants
+        """
+        return Note.objects.filter(category__path__startswith=self.path).distinct()
+
     class Meta:
         db_table = 'categories'
         verbose_name = 'Category'
@@ -77,37 +160,132 @@ def preview_file_name(instance, filename):
     return '/'.join(['attachments', instance.owner.username, 'preview', filename])
 
 
+def attachment_preview_file_name(instance, filename):
+    return preview_file_name(instance.attachment, filename)
+
+
+PREVIEW_NONE = 'none'
+PREVIEW_PENDING = 'pending'
+PREVIEW_DONE = 'done'
+PREVIEW_FAILED = 'failed'
+PREVIEW_UNSUPPORTED = 'unsupported'
+PREVIEW_STATUSES = (
+    (PREVIEW_NONE, 'No preview'),
+    (PREVIEW_PENDING, 'Preview is being generated'),
+    (PREVIEW_DONE, 'Preview is ready'),
+    (PREVIEW_FAILED, 'Preview generation failed'),
+    (PREVIEW_UNSUPPORTED, 'File type has no preview'),
+)
+
+
+class ContentBlob(models.Model):
+    """
+    A file of the content-addressed storage and the count of Attachments files and previews referencing it.
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+    size = models.BigIntegerField()
+    # blobs without references are found by the reaper
+    refcount = models.PositiveIntegerField(default=0, db_index=True)
+
+    class Meta:
+        db_table = 'content_blobs'
+
+
 class Attachments(models.Model):
     title = models.CharField(max_length=200, default='No name')
-    file = models.FileField(upload_to=content_file_name)
-    preview = models.ImageField(upload_to=preview_file_name, blank=True, null=True)
+    # names are only used for the extension, content_storage stores files by SHA-256 of the content
+    file = models.FileField(upload_to=content_file_name, storage=content_storage)
+    preview = models.ImageField(upload_to=preview_file_name, storage=content_storage, blank=True, null=True)
     owner = models.ForeignKey(User)
+    preview_status = models.CharField(max_length=12, choices=PREVIEW_STATUSES, default=PREVIEW_NONE)
 
     def delete_images(self):
         """
-        Delete files from file system when it delete from db.
-        """
-        import os
-        links = []
-        if self.file:
-            links.append(self.file.path)
-        if self.preview:
-            links.append(self.preview.path)
-        for i in links:
-            try:
-                os.remove(i)
-            except FileNotFoundError:
-                pass
-
-    def delete(self, *args, **kwargs):
-        """
-        We must delete all old images from server.
-        :param args:
-        :param kwargs:
-        :return:
+        Release files of the attachment, a file is deleted from file system after the commit of its last reference.
+        It is called by post_delete, so deletes of querysets release files too.
         """
-        self.delete_images()
-        super(Attachments, self).delete(*args, **kwargs)
+        for i in (self.file, self.preview):
+            if i:
+                i.storage.release(i.name)
 
     def __str__(self):
         return self.title
+
+    class Meta:
+        # keyset pagination of users attachments
+        index_together = [('owner', 'id')]
+
+
+class NoteTombstone(models.Model):
+    """
+    A note which disappeared for the user since a sync watermark: deleted or delegation revoked.
+    """
+    DELETED = 'deleted'
+    REVOKED = 'revoked'
+    REASONS = ((DELETED, 'Deleted'), (REVOKED, 'Delegation revoked'))
+
+    note_id = models.IntegerField()
+    user = models.ForeignKey(User, related_name='tombstones')
+    reason = models.CharField(max_length=10, choices=REASONS)
+    date_deleted = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'note_tombstones'
+        index_together = [('user', 'date_deleted')]
+
+
+class UploadSession(models.Model):
+    """
+    Resumable upload of an attachment: the client sends byte ranges of the file,
+    they are written to the final location of the file and the session is finalized into Attachments.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, related_name='upload_sessions')
+    title = models.CharField(max_length=200, default='No name')
+    # storage name of the file being written
+    file = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    date_create = models.DateTimeField(auto_now_add=True)
+    date_editing = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'upload_sessions'
+
+
+class AttachmentPreview(models.Model):
+    """
+    A preview of the attachment scaled to fit a square of the size
+    """
+    attachment = models.ForeignKey(Attachments, related_name='previews')
+    size = models.PositiveSmallIntegerField()
+    file = models.ImageField(upload_to=attachment_preview_file_name, storage=content_storage)
+
+    class Meta:
+        db_table = 'attachment_previews'
+        ordering = ('size',)
+
+
+class PreviewJob(models.Model):
+    """
+    A job of the preview worker, one per file of an attachment, so a job is never repeated for the same file
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    attachment = models.ForeignKey(Attachments, related_name='preview_jobs')
+    source = models.CharField(max_length=255)
+    status = models.CharField(max_length=8, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    # a running job of a crashed worker is taken again after this time
+    locked_until = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        db_table = 'preview_jobs'
+        unique_together = [('attachment', 'source')]
+        index_together = [('status', 'run_after')]
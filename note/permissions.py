@@ -1,4 +1,8 @@
+import hmac
+
 from rest_framework import permissions
+from note import instrumentation
+from note.models import Note
 
 
 class IsOwnerOrDelegated(permissions.BasePermission):
@@ -19,6 +23,76 @@ class IsOwnerOrDelegated(permissions.BasePermission):
 DELEGATED_METHODS_EXCLUDE = ['DELETE']
 
 
+class NoteAccess(object):
+    """
+    Resolves whether the user can perform an HTTP method on notes: the owner can do everything,
+    delegated users everything except DELEGATED_METHODS_EXCLUDE.
+    Owners and delegations are memoized, so one instance answers repeated checks of a request without queries.
+    """
+
+    def __init__(self, user, using='default'):
+        self.user = user
+        self.using = using
+        # note id -> owner id
+        self.owners = {}
+        # note id -> the note is delegated to the user
+        self.delegated = {}
+
+    def is_delegated(self, note_id):
+        if note_id not in self.delegated:
+            self.delegated[note_id] = bool(self.user.pk) and Note.delegated.through.objects.using(self.using).filter(
+                note_id=note_id, user_id=self.user.pk
+            ).exists()
+        return self.delegated[note_id]
+
+    def has_permission(self, note_id, owner_id, method):
+        self.owners[note_id] = owner_id
+        if owner_id == self.user.pk:
+            return True
+        if method in DELEGATED_METHODS_EXCLUDE:
+            return False
+        return self.is_delegated(note_id)
+
+    def load(self, note_ids):
+        """
+        owners and delegations of not memoized notes by two queries, returns {note id: owner id} of existing notes
+        """
+        note_ids = set(note_ids)
+        unknown = note_ids.difference(self.owners)
+        if unknown:
+            self.owners.update(Note.objects.using(self.using).filter(pk__in=unknown).values_list('id', 'owner_id'))
+        # notes of the user and missing notes do not need delegations
+        unknown = set(i for i in note_ids.difference(self.delegated)
+                      if self.owners.get(i, self.user.pk) != self.user.pk)
+        if unknown:
+            delegated = set(Note.delegated.through.objects.using(self.using).filter(
+                note_id__in=unknown, user_id=self.user.pk
+            ).values_list('note_id', flat=True))
+            self.delegated.update((i, i in delegated) for i in unknown)
+        return {i: self.owners[i] for i in note_ids if i in self.owners}
+
+    def filter_permitted(self, method, note_ids):
+        """
+        ids of existing notes the method is permitted on, in the passed order
+        """
+        owners = self.load(note_ids)
+        return [i for i in note_ids if i in owners and self.has_permission(i, owners[i], method)]
+
+
+def filter_permitted(user, method, note_ids, using='default'):
+    return NoteAccess(user, using).filter_permitted(method, note_ids)
+
+
+def note_access(request):
+    """
+    NoteAccess of the request user memoized on the request
+    """
+    access = getattr(request, '_note_access', None)
+    if access is None or access.user != request.user:
+        access = request._note_access = NoteAccess(request.user)
+    return access
+
+
 class CustomNotesPermissions(permissions.BasePermission):
     """
     Custom permissions for access to a note
@@ -26,11 +100,7 @@ class CustomNotesPermissions(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj):
         # if current user has permission but he is not owner of the note he can't remove it
-        if request.user == obj.owner:
-            return True
-        if request.user in obj.delegated.all() and request.method not in DELEGATED_METHODS_EXCLUDE:
-            return True
-        return False
+        return note_access(request).has_permission(obj.pk, obj.owner_id, request.method)
 
 
 class OwnerPermissions(permissions.BasePermission):
@@ -43,3 +113,30 @@ class OwnerPermissions(permissions.BasePermission):
         if request.user == obj.owner:
             return True
         return False
+
+
+class AttachmentAccessPermissions(permissions.BasePermission):
+    """
+    Custom permissions for reading an attachment: the owner or a user who can see a note with it
+    """
+
+    def has_object_permission(self, request, view, obj):
+        if request.user == obj.owner:
+            return True
+        return Note.objects.visible_to(request.user).filter(file=obj).exists()
+
+
+class MetricsPermissions(permissions.BasePermission):
+    """
+    Permissions for staff users, a metrics collector with METRICS_TOKEN or one of METRICS_ADDRESSES
+    """
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        token = instrumentation.METRICS_TOKEN
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if token and authorization.startswith('Bearer ') and hmac.compare_digest(
+                authorization[len('Bearer '):].encode('utf-8'), token.encode('utf-8')):
+            return True
+        return request.META.get('REMOTE_ADDR') in instrumentation.METRICS_ADDRESSES
@@ -0,0 +1,210 @@
+"""
+Background generation of attachment previews.
+
+Saving an attachment with a new file creates a PreviewJob. The run_preview_worker command claims
+pending jobs from the table (no broker is needed), renders previews of all PREVIEW_SIZES
+in a local process pool and stores them. The worker claims only as many jobs as it has free
+slots, failed jobs are retried with an exponential delay, and a job of a file is created once,
+so repeated saves and restarts of workers do not render the same previews twice.
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from note.models import (Attachments, AttachmentPreview, PreviewJob, PREVIEW_PENDING, PREVIEW_DONE, PREVIEW_FAILED,
+                         PREVIEW_UNSUPPORTED)
+
+PREVIEW_SIZES = (128, 512)
+PREVIEW_MAX_ATTEMPTS = 5
+PREVIEW_RETRY_DELAY = timedelta(seconds=30)
+PREVIEW_JOB_TIMEOUT = timedelta(minutes=5)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+
+class UnsupportedPreview(Exception):
+    pass
+
+
+def render_previews(path, sizes):
+    """
+    returns {size: JPEG bytes}, runs in a worker process without database access
+    """
+    from PIL import Image
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.pdf':
+        image = Image.open(io.BytesIO(render_pdf_page(path)))
+    elif extension in IMAGE_EXTENSIONS:
+        image = Image.open(path)
+    else:
+        raise UnsupportedPreview(extension)
+    image = image.convert('RGB')
+    previews = {}
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=85)
+        previews[size] = output.getvalue()
+    return previews
+
+
+def render_pdf_page(path):
+    """
+    PNG of the first page of a PDF by pdftoppm of poppler
+    """
+    if shutil.which('pdftoppm') is None:
+        raise UnsupportedPreview('.pdf')
+    directory = tempfile.mkdtemp()
+    try:
+        subprocess.check_call(['pdftoppm', '-f', '1', '-l', '1', '-png', '-r', '72', '-singlefile', path,
+                               os.path.join(directory, 'page')], timeout=60)
+        with open(os.path.join(directory, 'page.png'), 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(directory)
+
+
+def enqueue(attachment):
+    """
+    creates a job for the current file of the attachment once
+    """
+    if not attachment.file:
+        return
+    job, created = PreviewJob.objects.get_or_create(attachment=attachment, source=attachment.file.name)
+    if created:
+        Attachments.objects.filter(pk=attachment.pk).update(preview_status=PREVIEW_PENDING)
+        attachment.preview_status = PREVIEW_PENDING
+
+
+def claim_jobs(limit):
+    """
+    takes up to limit jobs which are pending or abandoned by a crashed worker
+    """
+    if limit <= 0:
+        return []
+    now = timezone.now()
+    candidates = PreviewJob.objects.filter(
+        status=PreviewJob.PENDING, run_after__lte=now
+    ) | PreviewJob.objects.filter(status=PreviewJob.RUNNING, locked_until__lt=now)
+    claimed = []
+    for job in candidates.select_related('attachment').order_by('run_after')[:limit]:
+        # the conditional update lets only one worker take the job
+        taken = PreviewJob.objects.filter(pk=job.pk, status=job.status, attempts=job.attempts).update(
+            status=PreviewJob.RUNNING, attempts=job.attempts + 1, locked_until=now + PREVIEW_JOB_TIMEOUT
+        )
+        if taken:
+            job.attempts += 1
+            claimed.append(job)
+    return claimed
+
+
+def complete_job(job, previews):
+    with transaction.atomic():
+        # the file may be replaced while the job was running, its own job renders the new previews
+        attachment = Attachments.objects.select_for_update().filter(pk=job.attachment_id, file=job.source).first()
+        if attachment is not None:
+            store_previews(attachment, previews)
+        PreviewJob.objects.filter(pk=job.pk).update(status=PreviewJob.DONE, locked_until=None, error='')
+
+
+def store_previews(attachment, previews):
+    """
+    replaces previews of the attachment, Attachments.preview is the largest one
+    """
+    old_previews = list(attachment.previews.values_list('pk', flat=True))
+    old_preview = attachment.preview.name if attachment.preview else None
+    name = os.path.splitext(os.path.basename(attachment.file.name))[0]
+    for size, data in sorted(previews.items()):
+        preview = AttachmentPreview(attachment=attachment, size=size)
+        preview.file.save('%s_%s.jpg' % (name, size), ContentFile(data), save=False)
+        preview.save()
+    largest = max(previews)
+    attachment.preview.save('%s.jpg' % name, ContentFile(previews[largest]), save=False)
+    # update() does not send post_save, which would enqueue the attachment again
+    Attachments.objects.filter(pk=attachment.pk).update(preview=attachment.preview.name, preview_status=PREVIEW_DONE)
+    # new files are stored first, so equal contents keep their blobs; old files are released by post_delete
+    AttachmentPreview.objects.filter(pk__in=old_previews).delete()
+    if old_preview:
+        attachment.preview.storage.release(old_preview)
+
+
+def fail_job(job, error):
+    if isinstance(error, UnsupportedPreview):
+        PreviewJob.objects.filter(pk=job.pk).update(status=PreviewJob.DONE, locked_until=None, error=repr(error))
+        Attachments.objects.filter(pk=job.attachment_id, file=job.source).update(preview_status=PREVIEW_UNSUPPORTED)
+    elif job.attempts < PREVIEW_MAX_ATTEMPTS:
+        delay = PREVIEW_RETRY_DELAY * 2 ** (job.attempts - 1)
+        PreviewJob.objects.filter(pk=job.pk).update(
+            status=PreviewJob.PENDING, run_after=timezone.now() + delay, locked_until=None, error=repr(error)
+        )
+    else:
+        PreviewJob.objects.filter(pk=job.pk).update(status=PreviewJob.FAILED, locked_until=None, error=repr(error))
+        Attachments.objects.filter(pk=job.attachment_id, file=job.source).update(preview_status=PREVIEW_FAILED)
+
+
+class InlineExecutor(object):
+    """
+    runs jobs in the worker process, for tests and small installations
+    """
+
+    def submit(self, func, *args):
+        from concurrent.futures import Future
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class PreviewWorker(object):
+
+    def __init__(self, processes=2, queue_size=None, poll_interval=1.0):
+        self.processes = processes
+        # jobs submitted to the pool at once, the rest stays pending in the table for other workers
+        self.queue_size = queue_size or max(processes, 1) * 2
+        self.poll_interval = poll_interval
+
+    def executor(self):
+        if self.processes == 0:
+            return InlineExecutor()
+        return ProcessPoolExecutor(self.processes)
+
+    def run(self, once=False):
+        """
+        processes jobs until interrupted, with once=True until there are no jobs ready to run
+        """
+        running = {}
+        with self.executor() as pool:
+            while True:
+                jobs = claim_jobs(self.queue_size - len(running))
+                for job in jobs:
+                    path = job.attachment.file.storage.path(job.source)
+                    running[pool.submit(render_previews, path, PREVIEW_SIZES)] = job
+                if not running:
+                    if once:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+                done, pending = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        previews = future.result()
+                    except Exception as e:
+                        fail_job(job, e)
+                    else:
+                        complete_job(job, previews)
@@ -0,0 +1,79 @@
+"""
+Denormalized list representation of notes.
+
+With NOTES_LIST_PROJECTION on, NoteProjection keeps the NoteUserListSerializer output of every note,
+signals of notes, their relations and of the related rows rendered in the list keep it up to date
+in the transaction of the change, and the users list reads a page by one query.
+Turning it on needs the rebuild_note_projections command, check_note_projections reports stale rows.
+"""
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from note.models import Note, NoteProjection, Colors, Categories, Labels
+from note.serializers import NoteUserListSerializer
+
+PROJECTION_ENABLED = getattr(settings, 'NOTES_LIST_PROJECTION', False)
+PROJECTION_BATCH_SIZE = 500
+
+
+def render(note_ids, using='default'):
+    """
+    returns {note id: JSON of the list representation} of existing notes
+    """
+    queryset = NoteUserListSerializer.setup_eager_loading(Note.objects.using(using).filter(pk__in=note_ids))
+    return {note.pk: json.dumps(NoteUserListSerializer(note).data, separators=(',', ':')) for note in queryset}
+
+
+def project(note_ids, using='default'):
+    """
+    writes projections of the notes, a few queries per PROJECTION_BATCH_SIZE notes
+    """
+    if not PROJECTION_ENABLED:
+        return
+    note_ids = sorted(set(note_ids))
+    for start in range(0, len(note_ids), PROJECTION_BATCH_SIZE):
+        batch = note_ids[start:start + PROJECTION_BATCH_SIZE]
+        rendered = render(batch, using)
+        NoteProjection.objects.using(using).filter(note_id__in=batch).delete()
+        NoteProjection.objects.using(using).bulk_create(
+            [NoteProjection(note_id=note_id, data=data) for note_id, data in rendered.items()]
+        )
+
+
+def related_note_ids(model, pk):
+    """
+    ids of notes rendering the row of a related model
+    """
+    field = Note._meta.get_field(RELATED_FIELDS[model])
+    if not field.many_to_many:
+        return list(Note.objects.filter(**{field.attname: pk}).values_list('id', flat=True))
+    column = field.m2m_reverse_field_name() + '_id'
+    return list(field.remote_field.through.objects.filter(**{column: pk}).values_list('note_id', flat=True))
+
+
+def compare(batch_size=None):
+    """
+    yields (note id, stored JSON or None, expected JSON) of notes by batches of ids
+    """
+    batch_size = batch_size or PROJECTION_BATCH_SIZE
+    last_id = 0
+    while True:
+        note_ids = list(Note.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not note_ids:
+            return
+        stored = dict(NoteProjection.objects.filter(note_id__in=note_ids).values_list('note_id', 'data'))
+        expected = render(note_ids)
+        for note_id in note_ids:
+            if note_id in expected:
+                yield note_id, stored.get(note_id), expected[note_id]
+        last_id = note_ids[-1]
+
+
+# models rendered in the list and the fields of notes referencing them
+RELATED_FIELDS = {
+    Colors: 'color',
+    Categories: 'category',
+    Labels: 'label',
+    User: 'delegated',
+}
@@ -0,0 +1,82 @@
+"""
+Small reference tables kept in the memory of the process.
+
+A ReferenceCache loads all rows of its table once and reloads them when the generation of the table,
+bumped by signals of any worker, changes. The generation is checked at most every REFERENCE_CHECK_INTERVAL
+seconds; the process which changed a row reloads it at once and after the commit, and an id which is not cached
+is looked up in the database, so rows created by other workers are found immediately.
+Generations are read from the default cache, so other workers see the bumps only with a cache shared
+by the processes, see note/cache.py and the note.W001 system check.
+"""
+import copy
+import threading
+import time
+
+from note.cache import get_generations
+from note.models import Colors, Labels
+
+REFERENCE_CHECK_INTERVAL = 1.0
+
+
+class ReferenceCache(object):
+
+    def __init__(self, model, generation):
+        self.model = model
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.rows = None
+        self.version = None
+        self.checked = 0
+
+    def load(self):
+        version = get_generations([self.generation])[0]
+        rows = {row.pk: row for row in self.model.objects.all()}
+        with self.lock:
+            self.rows, self.version, self.checked = rows, version, time.time()
+        return rows
+
+    def get_rows(self):
+        rows = self.rows
+        if rows is None:
+            return self.load()
+        if time.time() - self.checked > REFERENCE_CHECK_INTERVAL:
+            if get_generations([self.generation])[0] != self.version:
+                return self.load()
+            self.checked = time.time()
+        return rows
+
+    def clear(self):
+        with self.lock:
+            self.rows = None
+
+    def get(self, pk):
+        """
+        a copy of the row or None, the cached rows are shared by threads
+        """
+        row = self.get_rows().get(pk)
+        if row is None and self.model.objects.filter(pk=pk).exists():
+            row = self.load().get(pk)
+        return copy.copy(row) if row is not None else None
+
+    def existing(self, pks):
+        """
+        the subset of pks which exist
+        """
+        pks = set(pks)
+        rows = self.get_rows()
+        missing = pks.difference(rows)
+        if missing and self.model.objects.filter(pk__in=missing).exists():
+            rows = self.load()
+        return pks.intersection(rows)
+
+    def all(self):
+        return sorted(self.get_rows().values(), key=lambda row: row.pk)
+
+    def __deepcopy__(self, memo):
+        # serializer fields are deep copied with their arguments, the cache is shared
+        return self
+
+
+colors = ReferenceCache(Colors, 'colors')
+labels = ReferenceCache(Labels, 'labels')
+REFERENCES = {Colors: colors, Labels: labels}
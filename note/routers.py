@@ -0,0 +1,102 @@
+"""
+Routing of reads to database replicas.
+
+ReplicaMiddleware marks safe requests to views with replica_reads = True, ReplicaRouter sends their reads
+to one of NOTES_DATABASE_REPLICAS chosen for the request. Everything else uses the primary "default".
+A client which sent an unsafe request is pinned to the primary for REPLICA_PIN_SECONDS, by a cookie
+and by its Authorization header or session in the cache, so it reads its own writes while replicas catch up.
+A write during a request pins the rest of the request.
+
+Locally two databases can be configured, e.g. two SQLite files where the replica is a copy of the primary,
+or a PostgreSQL streaming replica:
+
+    DATABASES['replica'] = {'ENGINE': ..., 'NAME': ..., 'TEST': {'MIRROR': 'default'}}
+"""
+import hashlib
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+PRIMARY = 'default'
+REPLICAS = getattr(settings, 'NOTES_DATABASE_REPLICAS', [i for i in settings.DATABASES if i != PRIMARY])
+# also the longest expected replication lag
+REPLICA_PIN_SECONDS = getattr(settings, 'NOTES_REPLICA_PIN_SECONDS', 10)
+PIN_COOKIE = 'primary_pin'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = threading.local()
+
+
+def use_replica(alias):
+    """
+    alias of the replica for reads of the current request, None for the primary
+    """
+    _state.replica = alias
+
+
+def reading_from_replica():
+    return getattr(_state, 'replica', None) is not None
+
+
+def replica_may_be_stale(since):
+    """
+    reads of the request may miss changes made at the unix time since
+    """
+    return reading_from_replica() and time.time() - since < REPLICA_PIN_SECONDS
+
+
+def pin_key(request):
+    identity = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if identity:
+        return 'note:primary-pin:%s' % hashlib.md5(identity.encode('utf-8')).hexdigest()
+
+
+def is_pinned(request):
+    if request.COOKIES.get(PIN_COOKIE):
+        return True
+    key = pin_key(request)
+    return key is not None and cache.get(key) is not None
+
+
+def pin(request, response):
+    response.set_cookie(PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS, httponly=True)
+    # API clients may not keep cookies
+    key = pin_key(request)
+    if key is not None:
+        cache.set(key, 1, REPLICA_PIN_SECONDS)
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'replica', None) or PRIMARY
+
+    def db_for_write(self, model, **hints):
+        # also select_for_update() querysets, so reads after a write or a lock use the primary
+        use_replica(None)
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+
+class ReplicaMiddleware(object):
+
+    def process_request(self, request):
+        use_replica(None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None)
+        if (REPLICAS and request.method in SAFE_METHODS and getattr(view_class, 'replica_reads', False) and
+                not is_pinned(request)):
+            use_replica(random.choice(REPLICAS))
+
+    def process_response(self, request, response):
+        use_replica(None)
+        if request.method not in SAFE_METHODS:
+            pin(request, response)
+        return response
@@ -0,0 +1,146 @@
+"""
+Full-text search over notes title and content.
+
+PostgreSQL keeps a weighted tsvector in notes.search_vector with a GIN index,
+other databases (SQLite for local development) use the FTS5 table notes_fts.
+Both are updated by Note signals and rebuilt by the rebuild_search_index command.
+Snippets are HTML escaped notes content with matches in <b> tags, see highlight().
+"""
+from django.db import connections
+from django.utils.html import escape
+
+# markers of matches in snippets of the databases, the content is escaped before they become tags
+SNIPPET_START = '\x02'
+SNIPPET_STOP = '\x03'
+HIGHLIGHT_START = '<b>'
+HIGHLIGHT_STOP = '</b>'
+
+
+def placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+class PostgresSearchBackend(object):
+    vector = ("setweight(to_tsvector('english', coalesce(notes.title, '')), 'A') || "
+              "setweight(to_tsvector('english', notes.content), 'B')")
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def create(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE notes ADD COLUMN search_vector tsvector')
+            cursor.execute('CREATE INDEX notes_search_vector ON notes USING gin (search_vector)')
+
+    def drop(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE notes DROP COLUMN search_vector')
+
+    def index(self, note_ids):
+        with self.connection.cursor() as cursor:
+            sql = 'UPDATE notes SET search_vector = %s WHERE id IN (%s)' % (self.vector, placeholders(note_ids))
+            cursor.execute(sql, list(note_ids))
+
+    def remove(self, note_ids):
+        # the vector is removed with the row
+        pass
+
+    def rebuild(self, batch_size):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT coalesce(max(id), 0) FROM notes')
+            last_id = cursor.fetchone()[0]
+            for start in range(0, last_id, batch_size):
+                cursor.execute('UPDATE notes SET search_vector = %s WHERE id > %%s AND id <= %%s' % self.vector,
+                               [start, start + batch_size])
+
+    def search(self, queryset, query):
+        return queryset.extra(
+            select={
+                'rank': "ts_rank(notes.search_vector, plainto_tsquery('english', %s))",
+                'snippet': "ts_headline('english', notes.content, plainto_tsquery('english', %s), %s)",
+            },
+            select_params=[query, query, 'StartSel=%s, StopSel=%s' % (SNIPPET_START, SNIPPET_STOP)],
+            where=["notes.search_vector @@ plainto_tsquery('english', %s)"],
+            params=[query],
+            order_by=['-rank'],
+        )
+
+
+class SqliteSearchBackend(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def create(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('CREATE VIRTUAL TABLE notes_fts USING fts5(title, content)')
+
+    def drop(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DROP TABLE notes_fts')
+
+    def index(self, note_ids):
+        self.remove(note_ids)
+        with self.connection.cursor() as cursor:
+            sql = ('INSERT INTO notes_fts (rowid, title, content) '
+                   "SELECT id, coalesce(title, ''), content FROM notes WHERE id IN (%s)" % placeholders(note_ids))
+            cursor.execute(sql, list(note_ids))
+
+    def remove(self, note_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM notes_fts WHERE rowid IN (%s)' % placeholders(note_ids), list(note_ids))
+
+    def rebuild(self, batch_size):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM notes_fts')
+            cursor.execute('SELECT coalesce(max(id), 0) FROM notes')
+            last_id = cursor.fetchone()[0]
+            for start in range(0, last_id, batch_size):
+                cursor.execute('INSERT INTO notes_fts (rowid, title, content) '
+                               "SELECT id, coalesce(title, ''), content FROM notes WHERE id > %s AND id <= %s",
+                               [start, start + batch_size])
+
+    @staticmethod
+    def match_expression(query):
+        # every word is a quoted phrase, so the user input is never parsed as FTS5 syntax
+        return ' '.join('"%s"' % i.replace('"', '""') for i in query.split())
+
+    def search(self, queryset, query):
+        match = self.match_expression(query)
+        return queryset.extra(
+            select={
+                'rank': 'SELECT -bm25(notes_fts) FROM notes_fts WHERE notes_fts MATCH %s AND rowid = notes.id',
+                'snippet': "SELECT snippet(notes_fts, 1, %s, %s, '...', 16) FROM notes_fts "
+                           'WHERE notes_fts MATCH %s AND rowid = notes.id',
+            },
+            select_params=[match, SNIPPET_START, SNIPPET_STOP, match],
+            where=['notes.id IN (SELECT rowid FROM notes_fts WHERE notes_fts MATCH %s)'],
+            params=[match],
+            order_by=['-rank'],
+        )
+
+
+def get_backend(using='default'):
+    """
+    returns the search backend for the database alias
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend(connection)
+    return SqliteSearchBackend(connection)
+
+
+def search_notes(queryset, query):
+    """
+    Filters the queryset by the query, adds "rank" and highlighted "snippet" and orders by rank
+    """
+    return get_backend(queryset.db).search(queryset, query)
+
+
+def highlight(snippet):
+    """
+    HTML of a snippet of the database: the content is escaped, so only the <b> tags of matches are markup
+    """
+    if snippet is None:
+        return None
+    return escape(snippet).replace(SNIPPET_START, HIGHLIGHT_START).replace(SNIPPET_STOP, HIGHLIGHT_STOP)
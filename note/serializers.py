@@ -1,8 +1,86 @@
+import json
+from collections import OrderedDict
+
+from django.db.models import Prefetch
 from rest_framework import serializers
-from note.models import Note, Labels, Categories, Attachments, Colors
+from note.cache import get_or_build
+from note.models import Note, NoteProjection, Labels, Categories, Attachments, AttachmentPreview, UploadSession
+from note import reference
+from note.compiled import CompiledSerializer
+from note.search import highlight
 from django.contrib.auth.models import User
 
 
+class EagerLoadingMixin(object):
+    """
+    Builds select_related/prefetch_related for a queryset from the serializer Meta:
+    select_related - tuple of foreign keys rendered by the serializer
+    prefetch_related - dict {many to many field: tuple of columns needed by the serializer}
+    """
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        select_related = getattr(cls.Meta, 'select_related', ())
+        prefetch_related = getattr(cls.Meta, 'prefetch_related', {})
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        lookups = []
+        for field_name, columns in sorted(prefetch_related.items()):
+            related_model = queryset.model._meta.get_field(field_name).related_model
+            # ordered, so lists of related rows are the same in every representation, see note.compiled
+            lookups.append(Prefetch(field_name, queryset=related_model.objects.only(*columns).order_by('pk')))
+        if lookups:
+            queryset = queryset.prefetch_related(*lookups)
+        return queryset
+
+
+class ReferenceStringField(serializers.ReadOnlyField):
+    """
+    Renders a foreign key id of a reference table as str() of the cached row
+    """
+
+    def __init__(self, reference, **kwargs):
+        self.reference = reference
+        super(ReferenceStringField, self).__init__(**kwargs)
+
+    def to_representation(self, value):
+        row = self.reference.get(value) if value is not None else None
+        return str(row) if row is not None else None
+
+
+class ReferencePrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """
+    Validates ids of a reference table by the cached rows
+    """
+
+    def __init__(self, reference, **kwargs):
+        self.reference = reference
+        if not kwargs.get('read_only'):
+            kwargs['queryset'] = reference.model.objects.all()
+        super(ReferencePrimaryKeyField, self).__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        row = self.reference.get(pk)
+        if row is None:
+            self.fail('does_not_exist', pk_value=data)
+        return row
+
+
+class SnippetField(serializers.CharField):
+    """
+    Renders a search snippet as escaped HTML with highlighted matches
+    """
+
+    def to_representation(self, value):
+        return highlight(value)
+
+
 class UserCreateSerializer(serializers.ModelSerializer):
     """
     Serializer only for POST request to create a new user
@@ -53,24 +131,25 @@ class AttachmentPublicSerilizer(serializers.ModelSerializer):
         fields = ('file', 'title')
 
 
-class NotePublicListSerializer(serializers.ModelSerializer):
+class NotePublicListSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     """
     Serializer for public list access to notes.
     """
-    color = serializers.StringRelatedField()
+    color = ReferenceStringField(reference.colors, source='color_id')
     category = CategoriesForNoteSerializer(many=True)
     label = LabelsSerializer(many=True)
 
     class Meta:
         model = Note
         fields = ('id', 'title', 'color', 'category', 'label')
+        prefetch_related = {'category': ('id', 'title'), 'label': ('id', 'title')}
 
 
-class NotePublicSingleSerializer(serializers.ModelSerializer):
+class NotePublicSingleSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     """
     Serializer for public access to a single note
     """
-    color = serializers.StringRelatedField(allow_null=True, required=False)
+    color = ReferenceStringField(reference.colors, source='color_id')
     category = CategoriesForNoteSerializer(many=True)
     label = LabelsSerializer(many=True)
     owner = serializers.StringRelatedField()
@@ -79,13 +158,15 @@ class NotePublicSingleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Note
         fields = ('id', 'title', 'content', 'color', 'category', 'label', 'owner', 'file')
+        select_related = ('owner',)
+        prefetch_related = {'category': ('id', 'title'), 'label': ('id', 'title'), 'file': ('id', 'title', 'file')}
 
 
-class NoteUserListSerializer(serializers.ModelSerializer):
+class NoteUserListSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     """
     Serializer for user list access.
     """
-    color = serializers.StringRelatedField()
+    color = ReferenceStringField(reference.colors, source='color_id')
     category = CategoriesForNoteSerializer(many=True)
     label = LabelsSerializer(many=True)
     delegated = UserSerializer(many=True)
@@ -93,6 +174,43 @@ class NoteUserListSerializer(serializers.ModelSerializer):
     class Meta:
         model = Note
         fields = ('id', 'title', 'color', 'category', 'label', 'delegated')
+        prefetch_related = {
+            'category': ('id', 'title'),
+            'label': ('id', 'title'),
+            'delegated': ('id', 'username', 'email', 'first_name', 'last_name'),
+        }
+
+
+class NotePublicSearchSerializer(NotePublicListSerializer):
+    """
+    Serializer for public search results
+    """
+    rank = serializers.FloatField(read_only=True)
+    snippet = SnippetField(read_only=True)
+
+    class Meta(NotePublicListSerializer.Meta):
+        fields = NotePublicListSerializer.Meta.fields + ('rank', 'snippet')
+
+
+class NoteUserSearchSerializer(NoteUserListSerializer):
+    """
+    Serializer for user search results
+    """
+    rank = serializers.FloatField(read_only=True)
+    snippet = SnippetField(read_only=True)
+
+    class Meta(NoteUserListSerializer.Meta):
+        fields = NoteUserListSerializer.Meta.fields + ('rank', 'snippet')
+
+
+class NoteSyncSerializer(NoteUserListSerializer):
+    """
+    Serializer for changed notes of the delta sync
+    """
+
+    class Meta(NoteUserListSerializer.Meta):
+        fields = NoteUserListSerializer.Meta.fields + ('content', 'owner', 'file', 'date_editing')
+        prefetch_related = dict(NoteUserListSerializer.Meta.prefetch_related, file=('id',))
 
 
 class NotesUserSingleSerializer(serializers.ModelSerializer):
@@ -100,10 +218,10 @@ class NotesUserSingleSerializer(serializers.ModelSerializer):
     Basic serializer for create a note
     """
     owner = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
-    color = serializers.PrimaryKeyRelatedField(allow_null=True, queryset=Colors.objects.all(), required=False)
+    color = ReferencePrimaryKeyField(reference.colors, allow_null=True, required=False)
     category = serializers.PrimaryKeyRelatedField(many=True, queryset=Categories.objects.all(), required=False)
     delegated = serializers.PrimaryKeyRelatedField(many=True, queryset=User.objects.all(), required=False)
-    label = serializers.PrimaryKeyRelatedField(many=True, queryset=Labels.objects.all(), required=False)
+    label = ReferencePrimaryKeyField(reference.labels, many=True, required=False)
     file = serializers.PrimaryKeyRelatedField(many=True, queryset=Attachments.objects.all(), required=False)
 
     class Meta:
@@ -111,7 +229,48 @@ class NotesUserSingleSerializer(serializers.ModelSerializer):
         fields = ('id', 'title', 'content', 'color', 'category', 'label', 'owner', 'delegated', 'file')
 
 
-class NotesEditSerializer(serializers.ModelSerializer):
+class NoteProjectionSerializer(serializers.BaseSerializer):
+    """
+    Serializer for user list access from the denormalized projection, the same output as NoteUserListSerializer
+    """
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        return queryset.select_related('projection').only('id', 'date_editing', 'projection__data')
+
+    def to_representation(self, instance):
+        try:
+            data = instance.projection.data
+        except NoteProjection.DoesNotExist:
+            # not projected yet, e.g. before rebuild_note_projections
+            return NoteUserListSerializer(instance).data
+        return json.loads(data, object_pairs_hook=OrderedDict)
+
+
+class NotePublicListCompiledSerializer(CompiledSerializer):
+    """
+    Compiled NotePublicListSerializer for public list access
+    """
+    serializer_class = NotePublicListSerializer
+    load_fields = ('id', 'date_editing')
+
+
+class NotePublicSingleCompiledSerializer(CompiledSerializer):
+    """
+    Compiled NotePublicSingleSerializer for public access to a single note
+    """
+    serializer_class = NotePublicSingleSerializer
+
+
+class NoteUserListCompiledSerializer(CompiledSerializer):
+    """
+    Compiled NoteUserListSerializer for user list access
+    """
+    serializer_class = NoteUserListSerializer
+    load_fields = ('id', 'date_editing')
+
+
+class NotesEditSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     """
     This serializer returns 3 edition parameters:
     labels - list of available labels
@@ -119,10 +278,10 @@ class NotesEditSerializer(serializers.ModelSerializer):
     users - list of available users for delegate them permission to edit the note
     """
     owner = serializers.PrimaryKeyRelatedField(read_only=True)
-    color = serializers.PrimaryKeyRelatedField(allow_null=True, queryset=Colors.objects.all(), required=False)
+    color = ReferencePrimaryKeyField(reference.colors, allow_null=True, required=False)
     category = serializers.PrimaryKeyRelatedField(many=True, queryset=Categories.objects.all(), required=False)
     delegated = serializers.PrimaryKeyRelatedField(many=True, queryset=User.objects.all(), required=False)
-    label = serializers.PrimaryKeyRelatedField(many=True, queryset=Labels.objects.all(), required=False)
+    label = ReferencePrimaryKeyField(reference.labels, many=True, required=False)
     file = serializers.PrimaryKeyRelatedField(many=True, queryset=Attachments.objects.all(), required=False)
     labels = serializers.SerializerMethodField()
     files = serializers.SerializerMethodField()
@@ -132,49 +291,88 @@ class NotesEditSerializer(serializers.ModelSerializer):
         model = Note
         fields = ('id', 'title', 'content', 'color', 'category', 'label', 'owner', 'delegated', 'file', 'labels',
                   'files', 'users')
+        prefetch_related = {'category': ('id',), 'label': ('id',), 'delegated': ('id',), 'file': ('id',)}
+
+    def get_edit_option(self, name, generations, builder):
+        """
+        returns an edition option once per response, cached between requests by generations
+        """
+        memo = self.context.setdefault('edit_options', {})
+        if name not in memo:
+            memo[name] = get_or_build(name, generations, builder)
+        return memo[name]
 
     def get_labels(self, obj):
         """
         returns a list of available labels
         """
-        return LabelsSerializer(Labels.objects.all(), many=True).data
+        return self.get_edit_option(
+                'labels', ['labels'], lambda: list(LabelsSerializer(Labels.objects.all(), many=True).data)
+        )
 
     def get_files(self, obj):
         """
         returns a list of downloaded attachments of the authenticated user
         """
-        attachments = Attachments.objects.filter(
-                owner=self.context['request'].user
-        ).only('id', 'title', 'file').order_by('title')
-        return [{'id': i.id, 'title': i.title, 'file': i.file.url} for i in attachments]
+        user_id = self.context['request'].user.id
+
+        def build():
+            attachments = Attachments.objects.filter(owner_id=user_id).only('id', 'title', 'file').order_by('title')
+            return [{'id': i.id, 'title': i.title, 'file': i.file.url} for i in attachments]
+        return self.get_edit_option('files:%s' % user_id, ['attachments:%s' % user_id], build)
 
     def get_users(self, obj):
         """
         returns a list of users for delegate permissions to a note
         """
-        users = User.objects.only('id', 'username').order_by('username').exclude(username=obj.owner.username)
-        return [{'id': i.id, 'username': i.username} for i in users]
+        def build():
+            users = User.objects.only('id', 'username').order_by('username')
+            return [{'id': i.id, 'username': i.username} for i in users]
+        users = self.get_edit_option('users', ['users'], build)
+        return [i for i in users if i['id'] != obj.owner_id]
 
 
-class RecursiveSerializer(serializers.RelatedField):
+class NoteBatchOperationSerializer(serializers.Serializer):
     """
-    serializer for getting hierarchic structure of the categories
+    Serializer for one operation of the notes batch, related objects are passed as ids
+    and checked by one query per relation for the whole batch
     """
-    def to_representation(self, value):
-        serializer = self.parent.parent.__class__(value, context=self.context)
-        return serializer.data
+    op = serializers.ChoiceField(choices=('create', 'update', 'delete', 'relabel'))
+    id = serializers.IntegerField(required=False)
+    title = serializers.CharField(max_length=200, allow_null=True, allow_blank=True, required=False)
+    content = serializers.CharField(required=False)
+    color = serializers.IntegerField(allow_null=True, required=False)
+    category = serializers.ListField(child=serializers.IntegerField(), required=False)
+    label = serializers.ListField(child=serializers.IntegerField(), required=False)
+    delegated = serializers.ListField(child=serializers.IntegerField(), required=False)
+    file = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    def validate(self, attrs):
+        if attrs['op'] == 'create':
+            if not attrs.get('content'):
+                raise serializers.ValidationError({'content': ['This field is required.']})
+        elif 'id' not in attrs:
+            raise serializers.ValidationError({'id': ['This field is required.']})
+        if attrs['op'] == 'relabel' and 'label' not in attrs:
+            raise serializers.ValidationError({'label': ['This field is required.']})
+        return attrs
 
 
 class CategoriesHierarchySerializer(serializers.ModelSerializer):
     """
-    Serializer only for categories list
+    Serializer only for categories list,
+    context['children'] - dict {parent id: list of categories} loaded by one query
     """
-    sub_category = RecursiveSerializer(many=True, read_only=True)
+    sub_category = serializers.SerializerMethodField()
 
     class Meta:
         model = Categories
         fields = ('id', 'title', 'parent', 'sub_category')
 
+    def get_sub_category(self, obj):
+        children = self.context['children'].get(obj.id, [])
+        return CategoriesHierarchySerializer(children, many=True, context=self.context).data
+
 
 class CategoriesSerializer(serializers.ModelSerializer):
     """
@@ -185,16 +383,34 @@ class CategoriesSerializer(serializers.ModelSerializer):
         model = Categories
         fields = ('id', 'title', 'parent')
 
+    def validate_parent(self, value):
+        if value is not None and self.instance is not None and value.path.startswith(self.instance.path):
+            raise serializers.ValidationError('A category cannot be moved into its own subtree.')
+        return value
+
+
+class AttachmentPreviewSerializer(serializers.ModelSerializer):
+    """
+    Serializer for previews of an attachment
+    """
+
+    class Meta:
+        model = AttachmentPreview
+        fields = ('size', 'file')
+
 
 class AttachmentsSerializer(serializers.ModelSerializer):
     """
     Serializer for retrieving and create files
     """
     owner = serializers.PrimaryKeyRelatedField(read_only=True)
+    preview = serializers.ImageField(read_only=True)
+    previews = AttachmentPreviewSerializer(many=True, read_only=True)
 
     class Meta:
         model = Attachments
-        fields = ('id', 'title', 'file', 'owner')
+        fields = ('id', 'title', 'file', 'owner', 'preview', 'preview_status', 'previews')
+        read_only_fields = ('preview_status',)
 
 
 class AttachmentEditSerializer(serializers.ModelSerializer):
@@ -205,3 +421,15 @@ class AttachmentEditSerializer(serializers.ModelSerializer):
     class Meta:
         model = Attachments
         fields = ('id', 'title')
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Serializer for opening and checking a resumable upload
+    """
+    filename = serializers.CharField(write_only=True, max_length=100)
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'title', 'filename', 'size', 'received')
+        read_only_fields = ('received',)
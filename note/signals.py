@@ -0,0 +1,181 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver, Signal
+from note.cache import bump_generation
+from note.models import Colors, Labels, Attachments, AttachmentPreview, Categories, Note, NoteTombstone
+from note.search import get_backend
+from note import previews, projection, reference, sync
+
+# sent by bulk writes of notes which do not send post_save, e.g. the batch endpoint
+notes_bulk_saved = Signal(providing_args=['note_ids', 'using'])
+
+
+def invalidate(name):
+    """
+    Bump the generation now for the current transaction and after commit for the other connections
+    """
+    bump_generation(name)
+    transaction.on_commit(lambda: bump_generation(name))
+
+
+@receiver(post_save, sender=Labels)
+@receiver(post_delete, sender=Labels)
+def labels_changed(sender, instance, **kwargs):
+    invalidate('labels')
+    reference.labels.clear()
+    transaction.on_commit(reference.labels.clear)
+
+
+@receiver(post_save, sender=Colors)
+@receiver(post_delete, sender=Colors)
+def colors_changed(sender, instance, **kwargs):
+    invalidate('colors')
+    reference.colors.clear()
+    transaction.on_commit(reference.colors.clear)
+
+
+@receiver(post_save, sender=Attachments)
+@receiver(post_delete, sender=Attachments)
+def attachments_changed(sender, instance, **kwargs):
+    invalidate('attachments:%s' % instance.owner_id)
+    # public notes show titles and files of all users
+    invalidate('attachments')
+
+
+@receiver(post_save, sender=Attachments)
+def attachment_saved(sender, instance, raw=False, **kwargs):
+    # a job is created once per file, so saves of the title do not render previews again
+    if not raw:
+        previews.enqueue(instance)
+
+
+@receiver(post_delete, sender=Attachments)
+def attachment_deleted(sender, instance, **kwargs):
+    instance.delete_images()
+
+
+@receiver(post_delete, sender=AttachmentPreview)
+def attachment_preview_deleted(sender, instance, **kwargs):
+    if instance.file:
+        instance.file.storage.release(instance.file.name)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def users_changed(sender, instance, update_fields=None, **kwargs):
+    # login updates only last_login, which is not cached
+    if update_fields and 'username' not in update_fields:
+        return
+    invalidate('users')
+
+
+@receiver(post_save, sender=Categories)
+def categories_changed(sender, instance, **kwargs):
+    invalidate('categories')
+
+
+@receiver(post_delete, sender=Categories)
+def categories_deleted(sender, instance, **kwargs):
+    # sub categories were detached by SET_NULL, so they become root categories
+    if instance.path:
+        Categories.rebase(instance.path, '')
+    invalidate('categories')
+
+
+@receiver(post_save, sender=Note)
+def note_saved(sender, instance, using, **kwargs):
+    get_backend(using).index([instance.pk])
+    projection.project([instance.pk], using)
+    invalidate('notes')
+
+
+@receiver(notes_bulk_saved)
+def notes_saved(sender, note_ids, using, **kwargs):
+    get_backend(using).index(note_ids)
+    projection.project(note_ids, using)
+    invalidate('notes')
+
+
+@receiver(post_delete, sender=Note)
+def note_deleted(sender, instance, using, **kwargs):
+    get_backend(using).remove([instance.pk])
+    invalidate('notes')
+
+
+@receiver(pre_delete, sender=Note)
+def note_buried(sender, instance, **kwargs):
+    user_ids = [instance.owner_id]
+    user_ids += Note.delegated.through.objects.filter(note_id=instance.pk).values_list('user_id', flat=True)
+    sync.bury([(instance.pk, i) for i in user_ids], NoteTombstone.DELETED)
+
+
+@receiver(m2m_changed, sender=Note.category.through)
+@receiver(m2m_changed, sender=Note.label.through)
+@receiver(m2m_changed, sender=Note.file.through)
+@receiver(m2m_changed, sender=Note.delegated.through)
+def note_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # a reverse clear does not pass the notes, it is not synced
+    if action in ('post_add', 'post_remove', 'post_clear') and (pk_set or not reverse):
+        sync.touch_notes(pk_set if reverse else [instance.pk])
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate('notes')
+
+
+@receiver(m2m_changed, sender=Note.delegated.through)
+def note_delegation_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and not reverse:
+        pk_set = set(sender.objects.filter(note_id=instance.pk).values_list('user_id', flat=True))
+    if action not in ('post_add', 'post_remove', 'pre_clear') or not pk_set:
+        return
+    pairs = [(i, instance.pk) if reverse else (instance.pk, i) for i in pk_set]
+    if action == 'post_add':
+        sync.resurrect(pairs)
+    else:
+        sync.bury(pairs, NoteTombstone.REVOKED)
+
+
+@receiver(m2m_changed, sender=Note.category.through)
+@receiver(m2m_changed, sender=Note.label.through)
+@receiver(m2m_changed, sender=Note.delegated.through)
+def note_projection_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not projection.PROJECTION_ENABLED:
+        return
+    if action == 'pre_clear' and reverse:
+        # the notes of a reverse clear are not passed to post_clear
+        instance._projected_note_ids = projection.related_note_ids(type(instance), instance.pk)
+    elif action in ('post_add', 'post_remove'):
+        projection.project(pk_set if reverse else [instance.pk])
+    elif action == 'post_clear':
+        projection.project(getattr(instance, '_projected_note_ids', []) if reverse else [instance.pk])
+
+
+@receiver(post_save, sender=Colors)
+@receiver(post_save, sender=Categories)
+@receiver(post_save, sender=Labels)
+@receiver(post_save, sender=User)
+def projected_row_saved(sender, instance, created, update_fields=None, **kwargs):
+    if not projection.PROJECTION_ENABLED or created:
+        return
+    # e.g. the login updates only last_login, which is not in the list
+    if sender is User and update_fields and not set(update_fields) & {'username', 'email', 'first_name', 'last_name'}:
+        return
+    projection.project(projection.related_note_ids(sender, instance.pk))
+
+
+@receiver(pre_delete, sender=Colors)
+@receiver(pre_delete, sender=Categories)
+@receiver(pre_delete, sender=Labels)
+@receiver(pre_delete, sender=User)
+def projected_row_deleting(sender, instance, **kwargs):
+    if projection.PROJECTION_ENABLED:
+        instance._projected_note_ids = projection.related_note_ids(sender, instance.pk)
+
+
+@receiver(post_delete, sender=Colors)
+@receiver(post_delete, sender=Categories)
+@receiver(post_delete, sender=Labels)
+@receiver(post_delete, sender=User)
+def projected_row_deleted(sender, instance, **kwargs):
+    if projection.PROJECTION_ENABLED:
+        projection.project(getattr(instance, '_projected_note_ids', []))
@@ -0,0 +1,171 @@
+"""
+Content-addressed storage of attachment files.
+
+A file is stored once under blobs/<aa>/<bb>/<sha256><ext> whatever its name and owner,
+ContentBlob counts the references to it. Changes of a blob are serialized by a row lock of its ContentBlob.
+
+Releasing the last reference only sets the count to zero in the transaction of the caller,
+files of such blobs are removed in batches by reap() after the commit, so a rolled back delete keeps its file.
+A blob referenced again before the reaper locks it is kept.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from django.core.files.storage import FileSystemStorage
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import F
+
+HASH_BLOCK_SIZE = 64 * 1024
+REAP_BATCH_SIZE = 500
+# seconds the reaper thread waits after a commit, so deletions of several transactions are batched
+REAP_DELAY = 1.0
+REAPER_THREAD = getattr(settings, 'NOTES_FILE_REAPER_THREAD', True)
+
+logger = logging.getLogger(__name__)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    @staticmethod
+    def blob_name(sha256, name):
+        extension = os.path.splitext(name)[1].lower()[:16]
+        return 'blobs/%s/%s/%s%s' % (sha256[:2], sha256[2:4], sha256, extension)
+
+    def get_available_name(self, name, max_length=None):
+        # equal names are equal contents
+        return name
+
+    def _save(self, name, content):
+        hasher = hashlib.sha256()
+        for chunk in content.chunks():
+            hasher.update(chunk)
+        content.seek(0)
+        blob_name = self.blob_name(hasher.hexdigest(), name)
+        with transaction.atomic():
+            blob = self.lock_blob(blob_name, content.size)
+            if not self.exists(blob_name):
+                super(ContentAddressedStorage, self)._save(blob_name, content)
+            self.retain(blob)
+        return blob_name
+
+    def ingest(self, path, sha256, name, keep=False):
+        """
+        moves a local file of the same file system into the storage without copying,
+        the file is removed if the blob exists, returns the blob name;
+        with keep the file is linked to the blob and left for the caller to remove after its commit
+        """
+        blob_name = self.blob_name(sha256, name)
+        with transaction.atomic():
+            blob = self.lock_blob(blob_name, os.path.getsize(path))
+            if self.exists(blob_name):
+                if not keep:
+                    os.remove(path)
+            else:
+                blob_path = self.path(blob_name)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                if keep:
+                    # a blob of a rolled back transaction is an orphan removed by gc_media
+                    os.link(path, blob_path)
+                else:
+                    os.rename(path, blob_path)
+            self.retain(blob)
+        return blob_name
+
+    def release(self, name):
+        """
+        removes a reference to the blob, the file is removed by the reaper after the commit,
+        files stored before the content addressing have a single reference
+        """
+        from note.models import ContentBlob
+        with transaction.atomic():
+            blob = ContentBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                ContentBlob.objects.create(name=name, size=0, refcount=0)
+            elif blob.refcount > 0:
+                ContentBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+            if blob is None or blob.refcount <= 1:
+                transaction.on_commit(reaper.wake)
+
+    def reap(self, batch_size=None):
+        """
+        removes files of blobs without references, returns the number of removed blobs
+        """
+        from note.models import ContentBlob
+        batch_size = batch_size or REAP_BATCH_SIZE
+        count = 0
+        while True:
+            with transaction.atomic():
+                names = list(ContentBlob.objects.select_for_update().filter(refcount=0).order_by('name').values_list(
+                    'name', flat=True
+                )[:batch_size])
+                for name in names:
+                    try:
+                        os.remove(self.path(name))
+                    except FileNotFoundError:
+                        pass
+                ContentBlob.objects.filter(name__in=names, refcount=0).delete()
+            count += len(names)
+            if len(names) < batch_size:
+                return count
+
+    @staticmethod
+    def lock_blob(blob_name, size):
+        from note.models import ContentBlob
+        blob, created = ContentBlob.objects.select_for_update().get_or_create(name=blob_name, defaults={'size': size})
+        return blob
+
+    @staticmethod
+    def retain(blob):
+        from note.models import ContentBlob
+        ContentBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+
+
+class FileReaper(object):
+    """
+    a daemon thread running content_storage.reap() after commits which released blobs,
+    blobs left by a stopped process are removed by the next reap or the reap_files command
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def wake(self):
+        if not REAPER_THREAD:
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='file-reaper')
+                self.thread.daemon = True
+                self.thread.start()
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait()
+            time.sleep(REAP_DELAY)
+            self.event.clear()
+            try:
+                self.storage.reap()
+            except Exception:
+                logger.exception('removing of released files failed')
+            finally:
+                connection.close()
+
+
+content_storage = ContentAddressedStorage()
+reaper = FileReaper(content_storage)
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
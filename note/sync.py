@@ -0,0 +1,113 @@
+"""
+Delta sync of notes by a watermark.
+
+A client sends the watermark of the previous response and receives notes visible to the user
+with date_editing after it, tombstones of notes which were deleted or whose delegation was revoked,
+and the next watermark. Relation changes bump date_editing of the note, so they are synced too.
+"""
+import operator
+from datetime import timedelta
+from functools import reduce
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from note.models import Note, NoteTombstone
+
+SYNC_LIMIT = 500
+# rows saved before the response may be committed a bit later, so the watermark lags behind the clock
+SYNC_WATERMARK_LAG = timedelta(seconds=5)
+TOMBSTONE_RETENTION = timedelta(days=getattr(settings, 'NOTES_TOMBSTONE_RETENTION_DAYS', 30))
+
+
+class WatermarkExpired(Exception):
+    pass
+
+
+def format_watermark(watermark):
+    # UTC with "Z", so the watermark does not need escaping of "+" in a query string
+    return watermark.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def parse_watermark(value):
+    """
+    returns an aware datetime or None for the first sync, raises ValueError for a malformed value
+    """
+    if not value:
+        return None
+    watermark = parse_datetime(value)
+    if watermark is None:
+        raise ValueError(value)
+    if timezone.is_naive(watermark):
+        watermark = timezone.make_aware(watermark, timezone.utc)
+    return watermark
+
+
+def get_changes(queryset, user, since, limit=None):
+    """
+    returns (notes, tombstones, watermark, more) for notes of the queryset visible to the user
+    """
+    limit = limit or SYNC_LIMIT
+    now = timezone.now()
+    if since is not None and since < now - TOMBSTONE_RETENTION:
+        raise WatermarkExpired
+    queryset = queryset.visible_to(user).order_by('date_editing', 'id')
+    if since is not None:
+        queryset = queryset.filter(date_editing__gt=since)
+    notes = list(queryset[:limit + 1])
+    more = len(notes) > limit
+    if more:
+        notes = notes[:limit]
+        last = notes[-1]
+        # the next page starts after the watermark, so the rest of the last timestamp belongs to this one
+        notes += list(queryset.filter(date_editing=last.date_editing, id__gt=last.id))
+        watermark = last.date_editing
+    else:
+        watermark = now - SYNC_WATERMARK_LAG
+        if since is not None:
+            watermark = max(watermark, since)
+
+    tombstones = NoteTombstone.objects.filter(user=user)
+    if since is not None:
+        tombstones = tombstones.filter(date_deleted__gt=since)
+    if more:
+        tombstones = tombstones.filter(date_deleted__lte=watermark)
+    tombstones = list(tombstones.order_by('date_deleted').values('note_id', 'reason'))
+    return notes, tombstones, watermark, more
+
+
+def touch_notes(note_ids):
+    """
+    relations of notes changed, the notes must be synced again
+    """
+    Note.objects.filter(pk__in=note_ids).update(date_editing=timezone.now())
+
+
+def bury(pairs, reason):
+    """
+    pairs - iterable of (note id, user id) which are not visible to the user anymore
+    """
+    NoteTombstone.objects.bulk_create(
+        [NoteTombstone(note_id=note_id, user_id=user_id, reason=reason) for note_id, user_id in pairs]
+    )
+
+
+def resurrect(pairs):
+    """
+    pairs - iterable of (note id, user id) which are delegated again
+    """
+    users = {}
+    for note_id, user_id in pairs:
+        users.setdefault(note_id, []).append(user_id)
+    if users:
+        NoteTombstone.objects.filter(
+            reduce(operator.or_, (Q(note_id=note_id, user_id__in=user_ids) for note_id, user_ids in users.items()))
+        ).delete()
+
+
+def purge_tombstones():
+    """
+    removes tombstones older than the retention, returns the number of removed rows
+    """
+    return NoteTombstone.objects.filter(date_deleted__lt=timezone.now() - TOMBSTONE_RETENTION).delete()[0]
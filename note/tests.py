@@ -1,6 +1,45 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase, force_authenticate
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from note.cache import check_shared_cache, get_generations, get_or_build
+from note.db.pool import ConnectionPool, PoolTimeout
+from note.models import (Note, NoteProjection, Labels, Categories, Colors, Attachments, UploadSession, ContentBlob,
+                         PreviewJob)
+from note import benchmark, instrumentation, projection, reference, uploads
+from note.permissions import NoteAccess, filter_permitted
+from note.compiled import NotCompilable, compile_serializer
+from note.serializers import (NotesEditSerializer, NotePublicListSerializer, NotePublicSingleSerializer,
+                              NoteUserListSerializer, NotePublicSearchSerializer)
+from note.asgi import AsgiHandler, build_environ
+from note.views import NotePublicViewSet
+from note.previews import InlineExecutor, PreviewWorker
+from note.routers import ReplicaRouter, PIN_COOKIE, use_replica, reading_from_replica
+from note.search import PostgresSearchBackend
+from note.storage import content_storage
 
 
 class UserTests(APITestCase):
@@ -75,6 +114,1346 @@ class NoteTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
 
+class EagerLoadingTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+        self.color = Colors.objects.create(color='#FFFFFF')
+        self.labels = [Labels.objects.create(title='label %s' % i) for i in range(3)]
+        self.categories = [Categories.objects.create(title='category %s' % i) for i in range(3)]
+        # reference tables are loaded once per process
+        reference.colors.load()
+
+    def create_notes(self, count):
+        for i in range(count):
+            note = Note.objects.create(title='note %s' % i, content='content', owner=self.user, color=self.color)
+            note.label.add(*self.labels)
+            note.category.add(*self.categories)
+            note.delegated.add(self.friend)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context)
+
+    def test_public_list_queries_do_not_grow(self):
+        """
+        Public notes list runs the same number of queries for any page size
+        """
+        self.create_notes(2)
+        small = self.count_queries('/notes/')
+        self.create_notes(8)
+        self.assertEqual(self.count_queries('/notes/'), small)
+
+    def test_user_list_queries_do_not_grow(self):
+        """
+        Users notes list runs the same number of queries for any page size
+        """
+        self.client.force_authenticate(user=self.user)
+        self.create_notes(2)
+        small = self.count_queries('/my_notes/')
+        self.create_notes(8)
+        self.assertEqual(self.count_queries('/my_notes/'), small)
+
+    def test_public_single_note(self):
+        """
+        Public detail view renders prefetched relations
+        """
+        self.create_notes(1)
+        note = Note.objects.get()
+        response = self.client.get('/notes/%s/' % note.id, format='json')
+        self.assertEqual(response.data['color'], '#FFFFFF')
+        self.assertEqual(response.data['owner'], 'mike')
+        self.assertEqual(len(response.data['label']), 3)
+
+
+class EditOptionsCacheTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='mike', password='secret')
+        User.objects.create_user(username='second', password='secret')
+        self.note = Note.objects.create(content='content', owner=self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def test_options_are_cached(self):
+        """
+        Edition options are not queried again until labels, attachments or users change
+        """
+        url = '/my_notes/%s/' % self.note.id
+        with CaptureQueriesContext(connection) as cold:
+            self.client.get(url, format='json')
+        with CaptureQueriesContext(connection) as warm:
+            response = self.client.get(url, format='json')
+        # labels, files and users lookups
+        self.assertEqual(len(cold) - len(warm), 3)
+        self.assertEqual([i['username'] for i in response.data['users']], ['second'])
+
+    def test_options_are_invalidated(self):
+        """
+        Saving a label or a user shows up in the next response
+        """
+        url = '/my_notes/%s/' % self.note.id
+        self.client.get(url, format='json')
+        Labels.objects.create(title='fresh')
+        User.objects.create_user(username='third', password='secret')
+        response = self.client.get(url, format='json')
+        self.assertIn('fresh', [i['title'] for i in response.data['labels']])
+        self.assertEqual([i['username'] for i in response.data['users']], ['second', 'third'])
+
+
+class CategoryTreeTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.client.force_authenticate(user=self.user)
+        self.root = Categories.objects.create(title='root')
+        self.child = Categories.objects.create(title='child', parent=self.root)
+        self.leaf = Categories.objects.create(title='leaf', parent=self.child)
+        self.other = Categories.objects.create(title='other')
+
+    def test_paths(self):
+        """
+        Materialized path contains all ancestors
+        """
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.path, '%010d/%010d/%010d/' % (self.root.id, self.child.id, self.leaf.id))
+        self.assertEqual(set(self.root.get_descendants()), {self.child, self.leaf})
+
+    def test_reparent(self):
+        """
+        Moving a category moves its subtree
+        """
+        response = self.client.put('/categories/%s/' % self.child.id,
+                                   {'title': 'child', 'parent': self.other.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.leaf.refresh_from_db()
+        self.assertTrue(self.leaf.path.startswith(self.other.path))
+        response = self.client.put('/categories/%s/' % self.root.id,
+                                   {'title': 'root', 'parent': self.root.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_parent(self):
+        """
+        Sub categories of a removed category become root categories
+        """
+        self.root.delete()
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.path, '%010d/%010d/' % (self.child.id, self.leaf.id))
+
+    def test_tree(self):
+        """
+        The tree is built by one query and cached until the next category write
+        """
+        with self.assertNumQueries(1):
+            response = self.client.get('/categories/', format='json')
+        self.assertEqual([i['title'] for i in response.data], ['root', 'other'])
+        self.assertEqual(response.data[0]['sub_category'][0]['sub_category'][0]['title'], 'leaf')
+        # the rendered JSON is served again
+        with self.assertNumQueries(0), mock.patch.object(JSONRenderer, 'render') as render:
+            self.assertEqual(self.client.get('/categories/', format='json').content, response.content)
+        self.assertFalse(render.called)
+        Categories.objects.create(title='fresh', parent=self.other)
+        response = self.client.get('/categories/', format='json')
+        self.assertEqual(response.data[1]['sub_category'][0]['title'], 'fresh')
+
+    def test_category_notes(self):
+        """
+        Notes of a subtree are selected by the path prefix
+        """
+        note = Note.objects.create(content='content', owner=self.user)
+        note.category.add(self.leaf, self.child)
+        self.assertEqual(list(self.root.get_notes()), [note])
+        self.assertEqual(list(self.other.get_notes()), [])
+
+
+class KeysetPaginationTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        for i in range(5):
+            Note.objects.create(title='note %s' % i, content='content', owner=self.user)
+
+    def test_walk_pages(self):
+        """
+        Cursor pages cover all notes once and do not count rows
+        """
+        ids = []
+        url = '/notes/?paginate=cursor&page_size=2'
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, format='json')
+            self.assertNotIn('COUNT', ' '.join(i['sql'] for i in context.captured_queries))
+            self.assertNotIn('count', response.data)
+            ids.extend(i['id'] for i in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(sorted(ids), sorted(Note.objects.values_list('id', flat=True)))
+
+    def test_page_number_by_default(self):
+        """
+        Without the cursor parameter the list keeps page numbers
+        """
+        response = self.client.get('/notes/', format='json')
+        self.assertEqual(response.data['count'], 5)
+
+
+class VisibleNotesTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+        self.stranger = User.objects.create_user(username='third', password='secret')
+        self.own = Note.objects.create(content='own', owner=self.user)
+        self.own.delegated.add(self.friend, self.stranger)
+        self.delegated = Note.objects.create(content='delegated', owner=self.friend)
+        self.delegated.delegated.add(self.user, self.stranger)
+        self.hidden = Note.objects.create(content='hidden', owner=self.stranger)
+
+    def test_visible_to(self):
+        """
+        Owned and delegated notes are listed once, notes of other users are not
+        """
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get('/my_notes/', format='json')
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(sorted(i['id'] for i in response.data['results']), [self.own.id, self.delegated.id])
+
+
+class SearchTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.stranger = User.objects.create_user(username='second', password='secret')
+        self.match = Note.objects.create(title='Shopping', content='buy fresh apples and milk', owner=self.user)
+        self.other = Note.objects.create(title='Work', content='finish the report', owner=self.user)
+        self.foreign = Note.objects.create(title='Apples', content='apples pie', owner=self.stranger)
+
+    def test_public_search(self):
+        """
+        Public search finds notes by title and content with a highlighted snippet
+        """
+        response = self.client.get('/notes/search/?q=apples', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(i['id'] for i in response.data['results']), [self.match.id, self.foreign.id])
+        self.assertIn('<b>apples</b>', response.data['results'][0]['snippet'])
+
+    def test_user_search(self):
+        """
+        Users search is limited to visible notes and follows edits and deletes
+        """
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get('/my_notes/search/?q=apples', format='json')
+        self.assertEqual([i['id'] for i in response.data['results']], [self.match.id])
+        self.other.content = 'apples for the report'
+        self.other.save()
+        self.match.delete()
+        response = self.client.get('/my_notes/search/?q=apples', format='json')
+        self.assertEqual([i['id'] for i in response.data['results']], [self.other.id])
+
+    def test_snippet_escaped(self):
+        """
+        Markup of notes content is escaped in snippets, only matches are highlighted
+        """
+        Note.objects.create(title='Script', content='<script>alert(1)</script> bananas', owner=self.user)
+        response = self.client.get('/notes/search/?q=bananas', format='json')
+        snippet = response.data['results'][0]['snippet']
+        self.assertNotIn('<script>', snippet)
+        self.assertIn('&lt;script&gt;', snippet)
+        self.assertIn('<b>bananas</b>', snippet)
+
+    def test_postgres_query(self):
+        """
+        The PostgreSQL search query has a parameter for every placeholder
+        """
+        queryset = PostgresSearchBackend(connection).search(Note.objects.all(), 'apples')
+        sql, params = queryset.query.sql_with_params()
+        self.assertEqual(sql.count('%s'), len(params))
+        self.assertIn("ts_headline('english', notes.content, plainto_tsquery('english', apples), StartSel=",
+                      str(queryset.query))
+
+    def test_empty_query(self):
+        """
+        Search requires a query
+        """
+        response = self.client.get('/notes/search/?q=', format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BatchTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+        self.labels = [Labels.objects.create(title='label %s' % i) for i in range(2)]
+        self.own = Note.objects.create(title='own', content='content', owner=self.user)
+        self.delegated = Note.objects.create(title='delegated', content='content', owner=self.friend)
+        self.delegated.delegated.add(self.user)
+        self.foreign = Note.objects.create(title='foreign', content='content', owner=self.friend)
+        self.client.force_authenticate(user=self.user)
+
+    def test_batch(self):
+        """
+        Operations are applied with per-item results and CustomNotesPermissions rules
+        """
+        operations = [
+            {'op': 'create', 'title': 'new', 'content': 'new content', 'label': [self.labels[0].id],
+             'delegated': [self.friend.id]},
+            {'op': 'update', 'id': self.own.id, 'title': 'renamed'},
+            {'op': 'delete', 'id': self.delegated.id},
+            {'op': 'relabel', 'id': self.delegated.id, 'label': [i.id for i in self.labels]},
+            {'op': 'update', 'id': self.foreign.id, 'title': 'stolen'},
+            {'op': 'create', 'content': 'bad label', 'label': [0]},
+            {'op': 'create'},
+        ]
+        response = self.client.post('/my_notes/batch/', {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        statuses = [i['status'] for i in response.data['results']]
+        self.assertEqual(statuses, [201, 200, 403, 200, 403, 400, 400])
+        created = Note.objects.get(pk=response.data['results'][0]['id'])
+        self.assertEqual(created.owner, self.user)
+        self.assertEqual(list(created.label.all()), [self.labels[0]])
+        self.assertEqual(list(created.delegated.all()), [self.friend])
+        self.assertEqual(Note.objects.get(pk=self.own.id).title, 'renamed')
+        self.assertEqual(Note.objects.get(pk=self.own.id).content, 'content')
+        self.assertEqual(self.delegated.label.count(), 2)
+        self.assertEqual(Note.objects.get(pk=self.foreign.id).title, 'foreign')
+
+    def test_invalid_items(self):
+        """
+        Items which are not objects are rejected one by one
+        """
+        operations = [None, 'x', 1, [], {'op': 'update', 'id': self.own.id, 'title': 'renamed'}]
+        response = self.client.post('/my_notes/batch/', {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([i['status'] for i in response.data['results']], [400, 400, 400, 400, 200])
+        self.assertEqual(response.data['results'][0]['errors'], {'non_field_errors': ['Expected an object.']})
+
+    def test_delete_own(self):
+        """
+        The owner can delete notes by a batch
+        """
+        response = self.client.post('/my_notes/batch/', {'operations': [{'op': 'delete', 'id': self.own.id}]},
+                                    format='json')
+        self.assertEqual(response.data['results'][0]['status'], status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Note.objects.filter(pk=self.own.id).exists())
+
+
+@mock.patch('note.sync.SYNC_WATERMARK_LAG', timedelta(0))
+class SyncTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+        self.label = Labels.objects.create(title='work')
+        self.own = Note.objects.create(title='own', content='content', owner=self.user)
+        self.delegated = Note.objects.create(title='delegated', content='content', owner=self.friend)
+        self.delegated.delegated.add(self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def sync(self, since=None):
+        params = {'since': since} if since else {}
+        response = self.client.get('/my_notes/sync/', params, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_changes(self):
+        """
+        Only changed notes and tombstones after the watermark are returned
+        """
+        data = self.sync()
+        self.assertEqual(sorted(i['id'] for i in data['notes']), [self.own.id, self.delegated.id])
+        data = self.sync(data['watermark'])
+        self.assertEqual((data['notes'], data['deleted']), ([], []))
+
+        self.own.label.add(self.label)
+        data = self.sync(data['watermark'])
+        self.assertEqual([i['id'] for i in data['notes']], [self.own.id])
+
+        own_id = self.own.id
+        self.delegated.delegated.remove(self.user)
+        self.own.delete()
+        data = self.sync(data['watermark'])
+        self.assertEqual(data['notes'], [])
+        self.assertEqual(data['deleted'], [{'note_id': self.delegated.id, 'reason': 'revoked'},
+                                           {'note_id': own_id, 'reason': 'deleted'}])
+
+    def test_more(self):
+        """
+        Large changes are returned in several responses
+        """
+        with mock.patch('note.sync.SYNC_LIMIT', 1):
+            data = self.sync()
+            self.assertTrue(data['more'])
+            self.assertEqual([i['id'] for i in data['notes']], [self.own.id])
+            data = self.sync(data['watermark'])
+        self.assertFalse(data['more'])
+        self.assertEqual([i['id'] for i in data['notes']], [self.delegated.id])
+
+    def test_expired(self):
+        """
+        A watermark older than the tombstones retention requires a full sync
+        """
+        response = self.client.get('/my_notes/sync/', {'since': '2000-01-01T00:00:00Z'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+
+class ConditionalGetTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.note = Note.objects.create(title='note', content='content', owner=self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def assertNotModified(self, url, modified):
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        modified()
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_note(self):
+        """
+        A single note is not modified until it or its edition options change
+        """
+        url = '/my_notes/%s/' % self.note.id
+        self.assertNotModified(url, lambda: self.note.save())
+        self.assertNotModified(url, lambda: Labels.objects.create(title='fresh'))
+
+    def test_notes_list(self):
+        """
+        The notes list is not modified until a visible note is added or changed
+        """
+        self.assertNotModified('/my_notes/', lambda: Note.objects.create(content='content', owner=self.user))
+
+    def test_notes_list_removed(self):
+        """
+        The notes list is modified since a date by a deleted note which is not the last one or a revoked delegation
+        """
+        friend = User.objects.create_user(username='second', password='secret')
+        older = Note.objects.create(content='older', owner=self.user)
+        delegated = Note.objects.create(content='delegated', owner=friend)
+        delegated.delegated.add(self.user)
+        Note.objects.filter(pk__in=[older.pk, delegated.pk]).update(date_editing=timezone.now() - timedelta(days=1))
+        later = timezone.now() + timedelta(seconds=10)
+        for remove in (older.delete, lambda: delegated.delegated.remove(self.user)):
+            last_modified = self.client.get('/my_notes/', format='json')['Last-Modified']
+            response = self.client.get('/my_notes/', format='json', HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            later += timedelta(seconds=10)
+            with mock.patch('django.utils.timezone.now', return_value=later):
+                remove()
+            response = self.client.get('/my_notes/', format='json', HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_notes_list_colors(self):
+        """
+        The notes list is modified by a change of a rendered color
+        """
+        color = Colors.objects.create(color='#000000')
+        self.note.color = color
+        self.note.save()
+
+        def modified():
+            color.color = '#111111'
+            color.save()
+        self.assertNotModified('/my_notes/', modified)
+
+    def test_labels_and_categories(self):
+        """
+        Labels and categories are not modified until a write to their table
+        """
+        self.assertNotModified('/labels/', lambda: Labels.objects.create(title='fresh'))
+        self.assertNotModified('/categories/', lambda: Categories.objects.create(title='fresh'))
+
+    def test_forbidden_note(self):
+        """
+        Conditional requests still check permissions
+        """
+        stranger = User.objects.create_user(username='second', password='secret')
+        self.client.force_authenticate(user=stranger)
+        response = self.client.get('/my_notes/%s/' % self.note.id, format='json', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ExportTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.label = Labels.objects.create(title='work')
+        for i in range(5):
+            Note.objects.create(title='note %s' % i, content='content', owner=self.user).label.add(self.label)
+        Note.objects.create(content='hidden', owner=User.objects.create_user(username='second', password='secret'))
+        self.client.force_authenticate(user=self.user)
+
+    def export(self, output):
+        with mock.patch('note.export.EXPORT_CHUNK_SIZE', 2):
+            response = self.client.get('/my_notes/export/', {'output': output})
+            return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson(self):
+        """
+        Notes are streamed as one JSON object per line in chunks
+        """
+        lines = [json.loads(i) for i in self.export('ndjson').splitlines()]
+        self.assertEqual([i['title'] for i in lines], ['note %s' % i for i in range(5)])
+        self.assertEqual(lines[0]['label'], [{'id': self.label.id, 'title': 'work'}])
+
+    def test_json(self):
+        """
+        Notes are streamed as a JSON array
+        """
+        self.assertEqual(len(json.loads(self.export('json'))), 5)
+
+
+def use_temporary_media(test):
+    """
+    points the storages to a temporary MEDIA_ROOT for the test
+    """
+    media = tempfile.mkdtemp()
+    for storage in (default_storage, content_storage):
+        patcher = mock.patch.object(storage, 'location', media)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    test.addCleanup(shutil.rmtree, media)
+    return media
+
+
+def run_on_commit():
+    """
+    TestCase never commits, callbacks of transaction.on_commit run when they are registered
+    """
+    return mock.patch('django.db.transaction.on_commit', lambda func, using=None: func())
+
+
+class UploadTest(APITestCase):
+
+    def setUp(self):
+        self.media = use_temporary_media(self)
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.client.force_authenticate(user=self.user)
+        self.content = b'0123456789abcdef'
+
+    def put(self, session_id, first, last):
+        return self.client.put('/uploads/%s/' % session_id, self.content[first:last + 1],
+                               content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE='bytes %s-%s/%s' % (first, last, len(self.content)))
+
+    def test_resumable_upload(self):
+        """
+        Chunks are appended in order, a wrong offset returns the offset to resume from
+        """
+        response = self.client.post('/uploads/', {'title': 'doc', 'filename': 'doc.txt', 'size': len(self.content)},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        session_id = response.data['id']
+        self.assertEqual(self.put(session_id, 0, 5).data['received'], 6)
+        response = self.put(session_id, 10, 15)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['received'], 6)
+        response = self.client.post('/uploads/%s/finalize/' % session_id)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.put(session_id, 6, 15).data['received'], 16)
+        response = self.client.post('/uploads/%s/finalize/' % session_id)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['sha256'], hashlib.sha256(self.content).hexdigest())
+        attachment = Attachments.objects.get()
+        self.assertEqual(attachment.title, 'doc')
+        with open(attachment.file.path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_truncated_chunk(self):
+        """
+        The bytes of a short body are kept and the upload resumes after them
+        """
+        session = uploads.open_session(self.user, 'doc', 'doc.txt', len(self.content))
+        with self.assertRaises(uploads.RangeMismatch) as context:
+            uploads.write_chunk(session.pk, BytesIO(self.content[:4]), 0, 9, len(self.content))
+        self.assertEqual(context.exception.args[0], 4)
+        self.assertEqual(UploadSession.objects.get(pk=session.pk).received, 4)
+        self.assertEqual(self.put(session.pk, 4, 15).data['received'], 16)
+        response = self.client.post('/uploads/%s/finalize/' % session.pk)
+        self.assertEqual(response.data['sha256'], hashlib.sha256(self.content).hexdigest())
+
+    def test_rolled_back_chunk(self):
+        """
+        A rolled back chunk does not advance the cached hash of the upload
+        """
+        session = uploads.open_session(self.user, 'doc', 'doc.txt', len(self.content))
+        session.received = 6
+        session.save()
+        uploads.set_hasher(session, hashlib.sha256(self.content[:6]))
+        self.addCleanup(uploads.forget_hasher, session)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                uploads.write_chunk(session.pk, BytesIO(self.content[6:]), 6, 15, len(self.content))
+                raise RuntimeError
+        self.assertEqual(uploads.get_hasher(session).hexdigest(), hashlib.sha256(self.content[:6]).hexdigest())
+
+    def test_abort(self):
+        """
+        An aborted upload removes the partial file
+        """
+        response = self.client.post('/uploads/', {'filename': 'doc.txt', 'size': len(self.content)}, format='json')
+        self.put(response.data['id'], 0, 5)
+        path = default_storage.path(UploadSession.objects.get().file)
+        self.assertTrue(os.path.exists(path))
+        self.client.delete('/uploads/%s/' % response.data['id'])
+        self.assertFalse(os.path.exists(path))
+
+
+class ContentAddressedStorageTest(APITestCase):
+
+    def setUp(self):
+        use_temporary_media(self)
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+
+    def upload(self, user, name, content):
+        self.client.force_authenticate(user=user)
+        response = self.client.post('/attachments/', {'title': name, 'file': SimpleUploadedFile(name, content)},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return Attachments.objects.get(pk=response.data['id'])
+
+    def test_deduplication(self):
+        """
+        Equal files are stored once and removed with the last reference
+        """
+        first = self.upload(self.user, 'a.txt', b'same content')
+        second = self.upload(self.friend, 'b.txt', b'same content')
+        other = self.upload(self.user, 'c.txt', b'other content')
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertNotEqual(first.file.name, other.file.name)
+        path = first.file.path
+        first.delete()
+        self.assertTrue(os.path.exists(path))
+        second.delete()
+        # the file is removed by the reaper after the commit
+        self.assertTrue(os.path.exists(path))
+        content_storage.reap()
+        self.assertFalse(os.path.exists(path))
+
+    def test_deferred_deletion(self):
+        """
+        A rolled back delete keeps the file, a queryset delete releases files
+        """
+        attachment = self.upload(self.user, 'a.txt', b'kept')
+        path = attachment.file.path
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Attachments.objects.filter(pk=attachment.pk).delete()
+                raise RuntimeError
+        content_storage.reap()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(ContentBlob.objects.get(name=attachment.file.name).refcount, 1)
+        Attachments.objects.filter(pk=attachment.pk).delete()
+        self.assertEqual(content_storage.reap(), 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_gc_media(self):
+        """
+        Old files without rows are removed, referenced ones are kept
+        """
+        attachment = self.upload(self.user, 'a.txt', b'referenced')
+        orphan = content_storage.blob_name('0' * 64, 'orphan.txt')
+        default_storage.save(orphan, ContentFile(b'orphan'))
+        legacy = default_storage.save('attachments/mike/legacy.txt', ContentFile(b'legacy'))
+        call_command('gc_media', min_age=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(attachment.file.path))
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertFalse(default_storage.exists(legacy))
+
+    def test_dedupe_command(self):
+        """
+        Files stored by name are moved to blobs, duplicates are removed
+        """
+        names = []
+        for i in range(2):
+            name = 'attachments/mike/legacy%s.txt' % i
+            default_storage.save(name, ContentFile(b'legacy'))
+            names.append(name)
+            Attachments.objects.create(owner=self.user, title='legacy', file=name)
+        with run_on_commit():
+            call_command('dedupe_attachments', stdout=StringIO())
+        blob_names = set(Attachments.objects.values_list('file', flat=True))
+        self.assertEqual(len(blob_names), 1)
+        self.assertEqual(ContentBlob.objects.get().refcount, 2)
+        self.assertFalse(any(default_storage.exists(i) for i in names))
+
+    def test_dedupe_command_interrupted(self):
+        """
+        A failed update keeps the row with its legacy file, the command is run again
+        """
+        name = default_storage.save('attachments/mike/legacy.txt', ContentFile(b'legacy'))
+        attachment = Attachments.objects.create(owner=self.user, title='legacy', file=name)
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                call_command('dedupe_attachments', stdout=StringIO())
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.file.name, name)
+        self.assertTrue(default_storage.exists(name))
+        with run_on_commit():
+            call_command('dedupe_attachments', stdout=StringIO())
+            call_command('dedupe_attachments', stdout=StringIO())
+        attachment.refresh_from_db()
+        self.assertTrue(attachment.file.name.startswith('blobs/'))
+        with open(attachment.file.path, 'rb') as f:
+            self.assertEqual(f.read(), b'legacy')
+        self.assertFalse(default_storage.exists(name))
+        self.assertEqual(ContentBlob.objects.get().refcount, 1)
+
+
+class PreviewTest(APITestCase):
+
+    def setUp(self):
+        use_temporary_media(self)
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self, name, content):
+        response = self.client.post('/attachments/', {'title': name, 'file': SimpleUploadedFile(name, content)},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['preview_status'], 'pending')
+        return response.data['id']
+
+    def image(self):
+        from PIL import Image
+        output = BytesIO()
+        Image.new('RGB', (1024, 768), (200, 10, 10)).save(output, 'PNG')
+        return output.getvalue()
+
+    def test_previews_generated(self):
+        """
+        The worker renders previews of every size once per file
+        """
+        attachment_id = self.upload('photo.png', self.image())
+        PreviewWorker(processes=0).run(once=True)
+        response = self.client.get('/attachments/%s/' % attachment_id)
+        self.assertEqual(response.data['preview_status'], 'done')
+        self.assertEqual([i['size'] for i in response.data['previews']], [128, 512])
+        self.assertTrue(response.data['preview'])
+        self.client.put('/attachments/%s/' % attachment_id, {'title': 'renamed'})
+        self.assertEqual(PreviewJob.objects.count(), 1)
+
+    def test_failed_previews_retried(self):
+        """
+        A broken image is retried with a delay and fails after the last attempt
+        """
+        attachment_id = self.upload('broken.png', b'not an image')
+        with mock.patch('note.previews.PREVIEW_RETRY_DELAY', timedelta(0)), \
+                mock.patch('note.previews.PREVIEW_MAX_ATTEMPTS', 3):
+            PreviewWorker(processes=0).run(once=True)
+        job = PreviewJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (PreviewJob.FAILED, 3))
+        self.assertEqual(Attachments.objects.get(pk=attachment_id).preview_status, 'failed')
+
+    def test_unsupported_file(self):
+        attachment_id = self.upload('notes.txt', b'plain text')
+        PreviewWorker(processes=0).run(once=True)
+        self.assertEqual(Attachments.objects.get(pk=attachment_id).preview_status, 'unsupported')
+        self.assertEqual(PreviewJob.objects.get().attempts, 1)
+
+
+class DownloadTest(APITestCase):
+
+    def setUp(self):
+        use_temporary_media(self)
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+        self.content = b'0123456789abcdef'
+        self.attachment = Attachments(owner=self.user, title='data')
+        self.attachment.file.save('data.bin', ContentFile(self.content))
+        self.url = '/attachments/%s/download/' % self.attachment.pk
+
+    def read(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_download(self):
+        """
+        The owner downloads the file, conditional requests and ranges are supported
+        """
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.read(response), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(self.read(response), b'2345')
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/16')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(self.read(response), b'def')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+    def test_access(self):
+        """
+        Other users download the file only through a note delegated to them
+        """
+        self.client.force_authenticate(user=self.friend)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+        note = Note.objects.create(owner=self.user, content='with file')
+        note.file.add(self.attachment)
+        note.delegated.add(self.friend)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+    def test_sendfile_backend(self):
+        """
+        With a sendfile backend the front-end server sends the file
+        """
+        self.client.force_authenticate(user=self.user)
+        with mock.patch('note.downloads.SENDFILE_BACKEND', 'x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.attachment.file.name)
+        self.assertEqual(response.content, b'')
+
+
+class NoteAccessTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+        others = [User.objects.create_user(username='other%s' % i, password='secret') for i in range(20)]
+        self.own = Note.objects.create(content='own', owner=self.user)
+        self.delegated = Note.objects.create(content='delegated', owner=self.friend)
+        self.delegated.delegated.add(*others + [self.user])
+        self.foreign = Note.objects.create(content='foreign', owner=self.friend)
+
+    def test_has_permission(self):
+        """
+        A check is one EXISTS query whatever the number of delegates, repeated checks are memoized
+        """
+        access = NoteAccess(self.user)
+        with self.assertNumQueries(1):
+            self.assertTrue(access.has_permission(self.delegated.pk, self.friend.pk, 'PUT'))
+            self.assertTrue(access.has_permission(self.delegated.pk, self.friend.pk, 'GET'))
+        with self.assertNumQueries(0):
+            self.assertFalse(access.has_permission(self.delegated.pk, self.friend.pk, 'DELETE'))
+            self.assertTrue(access.has_permission(self.own.pk, self.user.pk, 'DELETE'))
+
+    def test_filter_permitted(self):
+        note_ids = [self.foreign.pk, self.delegated.pk, self.own.pk, 0]
+        with self.assertNumQueries(2):
+            self.assertEqual(filter_permitted(self.user, 'PUT', note_ids), [self.delegated.pk, self.own.pk])
+        self.assertEqual(filter_permitted(self.user, 'DELETE', note_ids), [self.own.pk])
+
+    def test_endpoint(self):
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get('/my_notes/%s/' % self.delegated.pk).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.delete('/my_notes/%s/' % self.delegated.pk).status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+
+class ReplicaRoutingTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.client.force_authenticate(user=self.user)
+        self.router = ReplicaRouter()
+        self.routed = []
+        db_for_read = self.router.db_for_read
+        patcher = mock.patch.object(ReplicaRouter, 'db_for_read',
+                                    lambda router, model, **hints: self.routed.append(db_for_read(model)) or 'default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_safe_requests_read_replica(self):
+        """
+        Reads of replica_reads views go to the replica, a client which wrote reads the primary
+        """
+        with mock.patch('note.routers.REPLICAS', ['replica']):
+            self.client.get('/labels/')
+            self.assertEqual(set(self.routed), {'replica'})
+            response = self.client.post('/labels/', {'title': 'new'})
+            self.assertIn(PIN_COOKIE, response.cookies)
+            del self.routed[:]
+            self.client.get('/labels/')
+            self.assertEqual(set(self.routed), {'default'})
+            self.client.cookies.clear()
+            del self.routed[:]
+            self.client.get('/labels/')
+            self.assertEqual(set(self.routed), {'replica'})
+
+    def test_other_views_read_primary(self):
+        with mock.patch('note.routers.REPLICAS', ['replica']):
+            self.client.get('/my_notes/')
+        self.assertEqual(set(self.routed), {'default'})
+
+    def test_writes_pin_request(self):
+        use_replica('replica')
+        self.addCleanup(use_replica, None)
+        self.assertEqual(self.router.db_for_write(Labels), 'default')
+        self.assertFalse(reading_from_replica())
+
+
+class ConnectionPoolTest(APITestCase):
+
+    def setUp(self):
+        self.opened = []
+        self.healthy = True
+
+    def pool(self, **options):
+        def connect():
+            self.opened.append(object())
+            return self.opened[-1]
+        defaults = dict(max_size=2, timeout=0.01, max_lifetime=60, health_check_interval=0)
+        defaults.update(options)
+        return ConnectionPool(connect, lambda connection: self.healthy, lambda connection: True,
+                              lambda connection: None, **defaults)
+
+    def test_reuse(self):
+        """
+        Returned connections are reused, checked out ones are bounded by the size
+        """
+        pool = self.pool()
+        first = pool.checkout()
+        pool.checkin(first)
+        self.assertIs(pool.checkout(), first)
+        pool.checkout()
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+        stats = pool.get_stats()
+        self.assertEqual((stats['checkouts'], stats['hits'], stats['misses'], stats['waits'], stats['timeouts']),
+                         (4, 1, 2, 1, 1))
+        self.assertEqual(stats['in_use'], 2)
+
+    def test_health_and_lifetime(self):
+        pool = self.pool()
+        connection = pool.checkout()
+        pool.checkin(connection)
+        self.healthy = False
+        self.assertIsNot(pool.checkout(), connection)
+        pool = self.pool(max_lifetime=0)
+        connection = pool.checkout()
+        pool.checkin(connection)
+        self.assertEqual(pool.get_stats()['idle'], 0)
+
+    def test_fork(self):
+        """
+        A forked process does not reuse connections of the parent
+        """
+        pool = self.pool()
+        connection = pool.checkout()
+        pool.checkin(connection)
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(pool.checkout(), connection)
+            self.assertEqual(pool.get_stats()['discarded'], 0)
+
+
+class PublicSnapshotTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.label = Labels.objects.create(title='label')
+        self.note = Note.objects.create(title='public', content='content', owner=self.user)
+        self.note.label.add(self.label)
+
+    def test_snapshot(self):
+        """
+        Public pages are rendered once and invalidated by changes of notes and their relations
+        """
+        self.client.get('/notes/', format='json')
+        self.client.get('/notes/%s/' % self.note.pk, format='json')
+        with self.assertNumQueries(0):
+            response = self.client.get('/notes/', format='json')
+            self.client.get('/notes/%s/' % self.note.pk, format='json')
+        self.assertEqual(json.loads(response.content.decode())['results'][0]['title'], 'public')
+        self.label.title = 'renamed'
+        self.label.save()
+        Note.objects.create(title='second', content='content', owner=self.user)
+        response = self.client.get('/notes/', format='json')
+        self.assertEqual(json.loads(response.content.decode())['count'], 2)
+        response = self.client.get('/notes/%s/' % self.note.pk, format='json')
+        self.assertEqual(json.loads(response.content.decode())['label'][0]['title'], 'renamed')
+
+    def test_missing_note(self):
+        self.assertEqual(self.client.get('/notes/0/', format='json').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_coalescing(self):
+        """
+        A miss which is being built by another request waits for its value
+        """
+        generations = get_generations(['notes'])
+        key = 'note:coalesced:%s' % generations[0]
+        cache.add(key + ':building', 1)
+        builder = mock.Mock(return_value='built')
+        with mock.patch('note.cache.time.sleep', lambda seconds: cache.set(key, 'shared')):
+            self.assertEqual(get_or_build('coalesced', ['notes'], builder), 'shared')
+        self.assertFalse(builder.called)
+
+
+class ReferenceCacheTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.color = Colors.objects.create(color='#000000')
+        self.labels = [Labels.objects.create(title='label %s' % i) for i in range(3)]
+        self.client.force_authenticate(user=self.user)
+
+    def test_validation_without_queries(self):
+        """
+        Colors and labels of a note are validated by the cached rows
+        """
+        reference.colors.load()
+        reference.labels.load()
+        data = {'color': self.color.pk, 'label': [i.pk for i in self.labels]}
+        with self.assertNumQueries(0):
+            serializer = NotesEditSerializer(data=dict(data, content='content'))
+            self.assertTrue(serializer.is_valid())
+        self.assertEqual([i.title for i in serializer.validated_data['label']], ['label 0', 'label 1', 'label 2'])
+        serializer = NotesEditSerializer(data={'content': 'content', 'label': [0]})
+        self.assertFalse(serializer.is_valid())
+
+    def test_invalidation(self):
+        """
+        Changed rows are reloaded, rows created by other processes are found
+        """
+        reference.colors.load()
+        self.color.color = '#111111'
+        self.color.save()
+        self.assertEqual(str(reference.colors.get(self.color.pk)), '#111111')
+        reference.colors.load()
+        Colors.objects.bulk_create([Colors(color='#222222')])
+        created = Colors.objects.get(color='#222222')
+        self.assertEqual(str(reference.colors.get(created.pk)), '#222222')
+
+    def test_invalidation_across_processes(self):
+        """
+        A row changed by a process is reloaded by another process connected to the same cache
+        """
+        # two connections of processes to one cache server
+        first = LocMemCache('shared', {})
+        second = LocMemCache('shared', {})
+        worker = reference.ReferenceCache(Colors, 'colors')
+        with mock.patch('note.cache.cache', second):
+            self.assertEqual(str(worker.get(self.color.pk)), '#000000')
+        with mock.patch('note.cache.cache', first):
+            self.color.color = '#111111'
+            self.color.save()
+        with mock.patch('note.cache.cache', second), mock.patch('note.reference.REFERENCE_CHECK_INTERVAL', 0):
+            self.assertEqual(str(worker.get(self.color.pk)), '#111111')
+
+    def test_shared_cache_check(self):
+        """
+        A cache in the memory of the process is reported by the system check
+        """
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([i.id for i in check_shared_cache(None)], ['note.W001'])
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+                                               'LOCATION': '127.0.0.1:11211'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class NoteProjectionTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', password='secret')
+        self.color = Colors.objects.create(color='#FFFFFF')
+        self.labels = [Labels.objects.create(title='label %s' % i) for i in range(3)]
+        self.client.force_authenticate(user=self.user)
+        reference.colors.load()
+        patcher = mock.patch('note.projection.PROJECTION_ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_note(self, title='note'):
+        note = Note.objects.create(title=title, content='content', owner=self.user, color=self.color)
+        note.label.add(*self.labels)
+        note.delegated.add(self.friend)
+        return note
+
+    def assertProjected(self, note):
+        self.assertEqual(NoteProjection.objects.get(note=note).data, projection.render([note.pk])[note.pk])
+
+    def test_projection_follows_changes(self):
+        """
+        Changes of the note, its relations and the related rows rewrite the projection
+        """
+        note = self.create_note()
+        self.assertProjected(note)
+        self.labels[0].title = 'renamed'
+        self.labels[0].save()
+        self.assertIn('renamed', NoteProjection.objects.get(note=note).data)
+        self.assertProjected(note)
+        self.labels[1].delete()
+        self.friend.users_allow.clear()
+        self.assertProjected(note)
+        self.assertNotIn('second', NoteProjection.objects.get(note=note).data)
+
+    def test_list_output(self):
+        """
+        The list from the projection is the same as the serialized list, in fewer queries
+        """
+        for i in range(5):
+            self.create_note('note %s' % i)
+        with CaptureQueriesContext(connection) as projected_queries:
+            projected = self.client.get('/my_notes/', format='json')
+        with mock.patch('note.projection.PROJECTION_ENABLED', False):
+            with CaptureQueriesContext(connection) as serialized_queries:
+                serialized = self.client.get('/my_notes/', format='json')
+        self.assertEqual(json.loads(projected.content.decode()), json.loads(serialized.content.decode()))
+        self.assertLess(len(projected_queries), len(serialized_queries))
+
+    def test_check_and_rebuild(self):
+        """
+        The checker reports stale and missing projections, rebuild writes all of them
+        """
+        note = self.create_note()
+        other = self.create_note('other')
+        NoteProjection.objects.filter(note=note).update(data='{}')
+        NoteProjection.objects.filter(note=other).delete()
+        out = StringIO()
+        call_command('check_note_projections', stdout=out)
+        self.assertIn('1 missing, 1 stale', out.getvalue())
+        call_command('rebuild_note_projections', stdout=StringIO())
+        out = StringIO()
+        call_command('check_note_projections', stdout=out)
+        self.assertIn('0 missing, 0 stale', out.getvalue())
+
+
+class InstrumentationTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.client.force_authenticate(user=self.user)
+        instrumentation.reset()
+        patcher = mock.patch('note.instrumentation.INSTRUMENTATION_ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_actions_recorded(self):
+        """
+        Requests are recorded per view action with their queries and timings
+        """
+        for i in range(3):
+            Note.objects.create(title='note %s' % i, content='content', owner=self.user)
+        response = self.client.get('/my_notes/', format='json')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.client.get('/categories/', format='json')
+        self.client.get('/categories/', format='json')
+        metrics = instrumentation.get_metrics()
+        self.assertEqual(metrics['NoteViewSet.list']['requests'], 1)
+        self.assertGreater(metrics['NoteViewSet.list']['queries']['sum'], 0)
+        self.assertEqual(metrics['CategoryViewSet.list']['requests'], 2)
+        self.assertEqual(metrics['CategoryViewSet.list']['render']['count'], 2)
+        self.assertEqual(metrics['NoteViewSet.list']['nplusone'], 0)
+
+    def test_nplusone_detected(self):
+        """
+        The same statement repeated with other parameters is counted as N+1
+        """
+        for i in range(4):
+            Note.objects.create(title='note %s' % i, content='content', owner=self.user)
+        middleware = instrumentation.InstrumentationMiddleware()
+        request = RequestFactory().get('/')
+        with mock.patch('note.instrumentation.NPLUSONE_THRESHOLD', 4):
+            middleware.process_request(request)
+            owners = [note.owner.username for note in Note.objects.all()]
+            with self.assertLogs('note.instrumentation', 'WARNING'):
+                middleware.process_response(request, HttpResponse())
+        self.assertEqual(owners, ['mike'] * 4)
+        metrics = instrumentation.get_metrics()['unresolved']
+        self.assertEqual(metrics['nplusone'], 1)
+        self.assertEqual(list(metrics['nplusone_statements'].values()), [4])
+
+    def test_normalize(self):
+        """
+        Literals and IN lists of any length are normalized
+        """
+        self.assertEqual(instrumentation.normalize('SELECT a FROM t WHERE id IN (%s, %s) LIMIT 21'),
+                         instrumentation.normalize('SELECT a FROM t WHERE id IN (%s, %s, %s) LIMIT 5'))
+
+    def test_metrics_endpoint(self):
+        """
+        Metrics are served to staff users only, also from a local address
+        """
+        self.client.get('/labels/', format='json')
+        response = self.client.get('/metrics/', format='json', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/metrics/', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('LabelViewSet.list', response.data['views'])
+        self.assertIn('pools', response.data)
+
+    def test_metrics_token(self):
+        """
+        A collector authenticates by the configured token
+        """
+        self.client.force_authenticate(user=None)
+        with mock.patch('note.instrumentation.METRICS_TOKEN', 'secret-token'):
+            response = self.client.get('/metrics/', format='json', HTTP_AUTHORIZATION='Bearer secret-token')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get('/metrics/', format='json', HTTP_AUTHORIZATION='Bearer other')
+            self.assertIn(response.status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+        response = self.client.get('/metrics/', format='json', HTTP_AUTHORIZATION='Bearer secret-token')
+        self.assertIn(response.status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+
+
+class BenchmarkTest(APITestCase):
+
+    def test_endpoints_queries_do_not_grow(self):
+        """
+        Every endpoint responds on a seeded dataset and queries of lists do not grow with the page size
+        """
+        scale = {'users': 22, 'notes': 50, 'labels': 22, 'category_depth': 2, 'delegations': 30, 'attachments': 45}
+        results = benchmark.run(benchmark.seed(scale), repeat=1)
+        self.assertEqual(sorted(results['endpoints']), sorted(name for name, path, paged in benchmark.ENDPOINTS))
+        self.assertEqual(benchmark.compare(results), [])
+
+    def test_compare_with_baseline(self):
+        """
+        More queries, growing queries and latency above the threshold are regressions
+        """
+        baseline = {'endpoints': {'labels.list': {'cold_queries': 3, 'queries': 3, 'p50_ms': 10.0}}}
+        results = {'endpoints': {'labels.list': {'cold_queries': 3, 'queries': 3, 'p50_ms': 12.0}},
+                   'growth': {'labels.list': [3, 3]}}
+        self.assertEqual(benchmark.compare(results, baseline, threshold=0.25), [])
+        results['endpoints']['labels.list'].update(queries=4, p50_ms=20.0)
+        results['growth']['labels.list'] = [3, 21]
+        self.assertEqual(len(benchmark.compare(results, baseline, threshold=0.25)), 3)
+
+
+class CompiledSerializerTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        self.friend = User.objects.create_user(username='second', email='second@example.com', password='secret')
+        color = Colors.objects.create(color='#FFFFFF')
+        labels = [Labels.objects.create(title='label %s' % i) for i in range(3)]
+        category = Categories.objects.create(title='category')
+        attachment = Attachments.objects.create(title='file', file='attachments/file.txt', owner=self.user)
+        for i in range(3):
+            note = Note.objects.create(title='note %s' % i, content='content', owner=self.user,
+                                       color=color if i else None)
+            note.label.add(*labels[i:])
+            note.category.add(category)
+            note.delegated.add(self.friend)
+            note.file.add(attachment)
+        self.client.force_authenticate(user=self.user)
+
+    def test_same_output(self):
+        """
+        Compiled serializers render the same data as the serializers
+        """
+        note_ids = list(Note.objects.order_by('id').values_list('id', flat=True))
+        for serializer_class in (NotePublicListSerializer, NotePublicSingleSerializer, NoteUserListSerializer):
+            notes = serializer_class.setup_eager_loading(Note.objects.order_by('id'))
+            data = serializer_class(notes, many=True).data
+            rendered = compile_serializer(serializer_class).render(note_ids)
+            self.assertEqual(rendered, json.loads(json.dumps(data)))
+            # keys are ordered without relying on the order of dicts
+            self.assertIsInstance(rendered[0], OrderedDict)
+            self.assertEqual(list(rendered[0]), list(data[0]))
+        with self.assertRaises(NotCompilable):
+            compile_serializer(NotePublicSearchSerializer)
+
+    def test_endpoints(self):
+        """
+        Views render the same responses with compiled serializers
+        """
+        note = Note.objects.order_by('id').first()
+        for url in ('/my_notes/', '/notes/', '/notes/%s/' % note.id):
+            cache.clear()
+            expected = self.client.get(url, format='json').content
+            cache.clear()
+            with mock.patch('note.compiled.COMPILED_ENABLED', True):
+                self.assertEqual(self.client.get(url, format='json').content, expected)
+
+
+class AsgiTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mike', password='secret')
+        Note.objects.create(title='note', content='content', owner=self.user)
+        self.handler = AsgiHandler(WSGIHandler(), executor=InlineExecutor(), read_executor=InlineExecutor())
+
+    def request(self, method, path, chunks=(b'',), headers=()):
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'http_version': '1.1',
+                 'headers': [(b'host', b'localhost')] + list(headers), 'client': ('127.0.0.1', 5000),
+                 'server': ('localhost', 80)}
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.handler(scope, receive, send))
+        finally:
+            loop.close()
+        return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+    def test_read_endpoint(self):
+        """
+        Notes are served through ASGI with the same content as through WSGI
+        """
+        code, content = self.request('GET', '/notes/', headers=[(b'accept', b'application/json')])
+        self.assertEqual(code, 200)
+        expected = self.client.get('/notes/', format='json').content
+        self.assertEqual(json.loads(content.decode()), json.loads(expected.decode()))
+
+    def test_chunked_body(self):
+        """
+        A body received in chunks without Content-Length is passed to the view
+        """
+        body = json.dumps({'username': 'second', 'password': 'secret'}).encode()
+        code, content = self.request('POST', '/user_registration/', chunks=(body[:10], body[10:]),
+                                     headers=[(b'content-type', b'application/json')])
+        self.assertEqual(code, 201)
+        self.assertTrue(User.objects.filter(username='second').exists())
+
+    def test_failing_view(self):
+        """
+        A view raising before or while its body is streamed is answered with status 500
+        """
+        def broken_body():
+            yield b'['
+            raise RuntimeError('broken')
+
+        views = (mock.Mock(side_effect=RuntimeError('broken')),
+                 mock.Mock(return_value=StreamingHttpResponse(broken_body())))
+        for view in views:
+            with mock.patch.object(NotePublicViewSet, 'list', view), \
+                    mock.patch('note.asgi.logger'), mock.patch('django.core.handlers.base.logger'):
+                code, content = self.request('GET', '/notes/', headers=[(b'accept', b'application/json')])
+            self.assertEqual(code, 500)
+            self.assertTrue(view.called)
+
+    def test_environ(self):
+        """
+        Repeated headers are joined, content headers have no HTTP_ prefix
+        """
+        environ = build_environ({'method': 'GET', 'path': '/caf\xe9/', 'query_string': b'a=1',
+                                 'headers': [(b'x-a', b'1'), (b'x-a', b'2'), (b'content-type', b'text/plain')]},
+                                BytesIO())
+        self.assertEqual(environ['HTTP_X_A'], '1,2')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['PATH_INFO'], '/caf\xc3\xa9/')
+
+
 class NoteDelegatedTest(APITestCase):
     pass
     # def test_delegate_note(self):
@@ -0,0 +1,145 @@
+"""
+Resumable chunked uploads of attachments.
+
+A session reserves the storage name of the file, every PUT appends the next byte range
+straight into that file while it is hashed, and finalize moves the file to its content-addressed blob
+and turns the session into Attachments without copying the file.
+Chunks are read from the request stream in blocks, so the memory of a worker does not depend on the chunk size.
+"""
+import hashlib
+import os
+import re
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from note.models import Attachments, UploadSession, content_file_name
+from note.storage import content_storage, hash_file
+
+UPLOAD_MAX_SIZE = getattr(settings, 'NOTES_UPLOAD_MAX_SIZE', 1024 * 1024 * 1024)
+UPLOAD_BLOCK_SIZE = 64 * 1024
+# running hashes of sessions uploaded through this process, others are hashed again on finalize
+HASHERS_LIMIT = 1000
+_hashers = OrderedDict()
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadError(Exception):
+    pass
+
+
+class RangeMismatch(UploadError):
+    """
+    the chunk does not start at the received offset, the client has to resume from it
+    """
+
+
+def parse_content_range(value):
+    """
+    returns (first byte, last byte, total size) of "bytes first-last/total"
+    """
+    match = CONTENT_RANGE.match(value or '')
+    if not match:
+        raise UploadError('Content-Range "bytes first-last/total" is required.')
+    first, last, total = (int(i) for i in match.groups())
+    if first > last:
+        raise UploadError('Invalid Content-Range.')
+    return first, last, total
+
+
+def open_session(user, title, filename, size):
+    if size > UPLOAD_MAX_SIZE:
+        raise UploadError('Ensure the file size is not greater than %s bytes.' % UPLOAD_MAX_SIZE)
+    instance = Attachments(owner=user)
+    name = default_storage.get_available_name(content_file_name(instance, os.path.basename(filename)))
+    # reserve the name, so concurrent sessions do not write the same file
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return UploadSession.objects.create(owner=user, title=title, file=name, size=size)
+
+
+def write_chunk(session_id, stream, first, last, total):
+    """
+    writes bytes first..last from the stream at their offset, returns the session
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session_id)
+        if total != session.size or last >= session.size:
+            raise UploadError('The range does not match the size of the upload.')
+        if first != session.received:
+            raise RangeMismatch(session.received)
+        hasher = get_hasher(session)
+        if hasher is not None:
+            # the cached hash moves to the new offset only when the offset is committed
+            hasher = hasher.copy()
+        remaining = last - first + 1
+        with open(default_storage.path(session.file), 'r+b') as f:
+            f.seek(first)
+            while remaining:
+                block = stream.read(min(UPLOAD_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                f.write(block)
+                if hasher is not None:
+                    hasher.update(block)
+                remaining -= len(block)
+            # a short body keeps only the bytes which were written
+            f.truncate(last + 1 - remaining)
+        session.received = last + 1 - remaining
+        session.save(update_fields=['received', 'date_editing'])
+        transaction.on_commit(lambda: set_hasher(session, hasher))
+    # raised after the commit, so the bytes of a short body are kept for the resume
+    if remaining:
+        raise RangeMismatch(session.received)
+    return session
+
+
+def finalize(session_id):
+    """
+    returns (attachment, sha256 hex digest)
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session_id)
+        if session.received != session.size:
+            raise RangeMismatch(session.received)
+        hasher = get_hasher(session)
+        sha256 = hasher.hexdigest() if hasher is not None else hash_file(default_storage.path(session.file))
+        attachment = Attachments(owner_id=session.owner_id, title=session.title)
+        # the received file is moved to its blob, an equal blob makes it a duplicate to drop
+        attachment.file.name = content_storage.ingest(default_storage.path(session.file), sha256, session.file)
+        attachment.save()
+        forget_hasher(session)
+        session.delete()
+        return attachment, sha256
+
+
+def abort(session):
+    forget_hasher(session)
+    default_storage.delete(session.file)
+    session.delete()
+
+
+def get_hasher(session):
+    """
+    the running hash of the received bytes or None if it was not computed by this process
+    """
+    if session.received == 0:
+        return hashlib.sha256()
+    offset, hasher = _hashers.get(session.pk, (None, None))
+    return hasher if offset == session.received else None
+
+
+def set_hasher(session, hasher):
+    if hasher is None:
+        return
+    _hashers.pop(session.pk, None)
+    _hashers[session.pk] = (session.received, hasher)
+    while len(_hashers) > HASHERS_LIMIT:
+        _hashers.popitem(last=False)
+
+
+def forget_hasher(session):
+    _hashers.pop(session.pk, None)
@@ -9,7 +9,9 @@ router.register(r'users', views.UserViewSet, base_name='users')
 router.register(r'notes', views.NotePublicViewSet, base_name='notes')
 router.register(r'my_notes', views.NoteViewSet, base_name='my_notes')
 router.register(r'attachments', views.AttachmentsViewSet, base_name='attachments')
+router.register(r'uploads', views.UploadSessionViewSet, base_name='uploads')
 router.register(r'user_registration', views.UserRegistration, base_name='user_registration')
+router.register(r'metrics', views.MetricsViewSet, base_name='metrics')
 
 urlpatterns = [
     url(r'^', include(router.urls)),
@@ -1,11 +1,30 @@
+import calendar
+import hashlib
+import json
+import os
+from collections import defaultdict
+
 from django.contrib.auth.models import User
-from django.db.models import Q
-from rest_framework import viewsets, mixins, permissions
-from rest_framework.pagination import PageNumberPagination
+from django.db.models import Max, Count
+from django.http import StreamingHttpResponse
+from rest_framework import viewsets, mixins, permissions, status
+from rest_framework.decorators import list_route, detail_route
+from rest_framework.generics import get_object_or_404
+from rest_framework.pagination import PageNumberPagination, CursorPagination, _positive_int
 from rest_framework.response import Response
 from note import serializers
-from note.models import Colors, Labels, Categories, Note, Attachments
-from note.permissions import CustomNotesPermissions, OwnerPermissions
+from note.batch import NoteBatch, BATCH_MAX_OPERATIONS
+from note.cache import get_or_build, get_generations, get_generations_time
+from note.conditional import conditional, generations_state, make_etag
+from note.downloads import serve_file
+from note.models import Colors, Labels, Categories, Note, NoteTombstone, Attachments, UploadSession
+from note.export import iterate_notes, ndjson_lines, json_array
+from note.search import search_notes
+from note import compiled, instrumentation, projection, uploads
+from note.sync import get_changes, parse_watermark, format_watermark, WatermarkExpired
+from note.db.pool import pool_stats
+from note.permissions import (CustomNotesPermissions, OwnerPermissions, AttachmentAccessPermissions,
+                              MetricsPermissions)
 
 
 class LargeResultsSetPagination(PageNumberPagination):
@@ -17,6 +36,150 @@ class LargeResultsSetPagination(PageNumberPagination):
     max_page_size = 10000
 
 
+def timestamp(value):
+    return calendar.timegm(value.utctimetuple())
+
+
+def note_state(view, request, *args, **kwargs):
+    """
+    a note with edition options is changed by date_editing of the note and generations of the options
+    """
+    lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+    note = get_object_or_404(Note.objects.only('id', 'owner', 'date_editing'),
+                             **{view.lookup_field: kwargs[lookup_url_kwarg]})
+    view.check_object_permissions(request, note)
+    names = ['labels', 'users', 'attachments:%s' % request.user.pk]
+    etag = make_etag(request.accepted_media_type, note.pk, note.date_editing.isoformat(), request.user.pk,
+                     *get_generations(names))
+    return etag, max(timestamp(note.date_editing), get_generations_time(names))
+
+
+def notes_list_state(view, request, *args, **kwargs):
+    """
+    the list of visible notes is changed by the last date_editing, the count, the last tombstone of the user
+    (a deleted note or a revoked delegation) and generations of rendered relations
+    """
+    aggregate = Note.objects.visible_to(request.user).aggregate(last=Max('date_editing'), count=Count('id'))
+    removed = NoteTombstone.objects.filter(user=request.user).aggregate(last=Max('date_deleted'))['last']
+    names = ['labels', 'categories', 'users', 'colors']
+    etag = make_etag(request.accepted_media_type, request.get_full_path(), request.user.pk, aggregate['count'],
+                     aggregate['last'] and aggregate['last'].isoformat(), removed and removed.isoformat(),
+                     *get_generations(names))
+    last_modified = get_generations_time(names)
+    for date in (aggregate['last'], removed):
+        if date:
+            last_modified = max(last_modified, timestamp(date))
+    return etag, last_modified
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Opaque cursor pagination without COUNT(*) and OFFSET scans.
+    The cursor positions on the first ordering field, ties are resolved by the following ones.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 10000
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param],
+                                 strict=True, cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+
+class NoteKeysetPagination(KeysetPagination):
+    ordering = ('-date_editing', '-id')
+
+
+class AttachmentKeysetPagination(KeysetPagination):
+    ordering = ('-id',)
+
+
+class KeysetPaginationMixin(object):
+    """
+    Switches the view to keyset pagination by ?paginate=cursor, next and previous links keep the cursor.
+    """
+    keyset_pagination_class = None
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and self.keyset_pagination_class is not None:
+            params = self.request.query_params
+            if self.action == 'list' and (
+                    KeysetPagination.cursor_query_param in params or params.get('paginate') == 'cursor'):
+                self._paginator = self.keyset_pagination_class()
+        return super(KeysetPaginationMixin, self).paginator
+
+
+class EagerLoadingMixin(object):
+    """
+    Loads the relations declared by the serializer of the current action in a constant number of queries.
+    """
+    eager_loading_actions = ('list', 'retrieve', 'search', 'sync')
+
+    def get_queryset(self):
+        queryset = super(EagerLoadingMixin, self).get_queryset()
+        serializer_class = self.get_serializer_class()
+        if self.action in self.eager_loading_actions and hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        return queryset
+
+
+class SnapshotMixin(object):
+    """
+    Serves JSON responses of actions wrapped by snapshot() from bytes rendered once per URL and generations.
+    The responses must not depend on the user.
+    """
+    snapshot_generations = ()
+
+    def snapshot(self, method, request, *args, **kwargs):
+        if request.accepted_renderer.format != 'json':
+            return method(request, *args, **kwargs)
+
+        def build():
+            response = method(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                raise SnapshotSkipped(response)
+            content = request.accepted_renderer.render(response.data, request.accepted_media_type,
+                                                       self.get_renderer_context())
+            return response.status_code, content
+
+        # absolute links of pages depend on the host
+        url = '%s %s' % (request.accepted_media_type, request.build_absolute_uri())
+        name = 'snapshot:%s' % hashlib.md5(url.encode('utf-8')).hexdigest()
+        try:
+            code, content = get_or_build(name, self.snapshot_generations, build)
+        except SnapshotSkipped as e:
+            return e.response
+        return SnapshotResponse(content, status=code, content_type=request.accepted_media_type)
+
+
+class SnapshotSkipped(Exception):
+
+    def __init__(self, response):
+        self.response = response
+
+
+class SnapshotResponse(Response):
+    """
+    Response with JSON content rendered before, data is decoded from the content only when it is accessed
+    """
+
+    def __init__(self, content, status, content_type):
+        super(SnapshotResponse, self).__init__(status=status, content_type=content_type)
+        # setting the content marks the response as rendered
+        self.content = content
+
+    @property
+    def data(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    @data.setter
+    def data(self, value):
+        pass
+
+
 class UserViewSet(mixins.RetrieveModelMixin,
                   mixins.ListModelMixin,
                   viewsets.GenericViewSet):
@@ -26,6 +189,7 @@ class UserViewSet(mixins.RetrieveModelMixin,
     permission_classes = [permissions.IsAuthenticated]
     queryset = User.objects.all()
     serializer_class = serializers.UserSerializer
+    replica_reads = True
 
 
 class UserRegistration(mixins.CreateModelMixin, viewsets.GenericViewSet):
@@ -41,7 +205,7 @@ class UserRegistration(mixins.CreateModelMixin, viewsets.GenericViewSet):
     serializer_class = serializers.UserCreateSerializer
 
 
-class NotePublicViewSet(viewsets.ReadOnlyModelViewSet):
+class NotePublicViewSet(SnapshotMixin, KeysetPaginationMixin, EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
     """
     Endpoint for public access to list of notes and single note.
 
@@ -58,12 +222,54 @@ class NotePublicViewSet(viewsets.ReadOnlyModelViewSet):
         base_host/notes/{id}/?format=json
 
     single note, methods 'GET', 'HEAD', 'OPTIONS'.
+
+    3.
+
+        base_host/notes/search/?q=words
+
+    full-text search by title and content, ordered by "rank", with a highlighted "snippet" of the content.
+
+    base_host/notes/?paginate=cursor switches the list to keyset pagination,
+    pages are ordered by "date_editing" and "id" and linked by opaque "next" and "previous" cursors without "count".
+
+    JSON of list pages and single notes is rendered once and cached until notes or their relations change,
+    with NOTES_COMPILED_SERIALIZERS by compiled serializers.
     """
     queryset = Note.objects.all()
     serializer_class = serializers.NotePublicListSerializer
+    keyset_pagination_class = NoteKeysetPagination
+    replica_reads = True
+    # everything rendered by the public serializers
+    snapshot_generations = ('notes', 'labels', 'categories', 'colors', 'users', 'attachments')
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            if compiled.COMPILED_ENABLED:
+                return serializers.NotePublicSingleCompiledSerializer
+            return serializers.NotePublicSingleSerializer
+        if self.action == 'search':
+            return serializers.NotePublicSearchSerializer
+        if compiled.COMPILED_ENABLED:
+            return serializers.NotePublicListCompiledSerializer
+        return serializers.NotePublicListSerializer
 
     def list(self, request, *args, **kwargs):
-        queryset = Note.objects.only('id', 'title', 'color', 'category', 'owner')
+        return self.snapshot(super(NotePublicViewSet, self).list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.snapshot(self.retrieve_note, request, *args, **kwargs)
+
+    def retrieve_note(self, request, *args, **kwargs):
+        instance = self.get_object()
+        serializer = self.get_serializer_class()(instance)
+        return Response(serializer.data)
+
+    @list_route()
+    def search(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'q': ['This parameter is required.']}, status=status.HTTP_400_BAD_REQUEST)
+        queryset = search_notes(self.filter_queryset(self.get_queryset()), query)
 
         page = self.paginate_queryset(queryset)
         if page is not None:
@@ -73,13 +279,8 @@ class NotePublicViewSet(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
-    def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        serializer = serializers.NotePublicSingleSerializer(instance)
-        return Response(serializer.data)
 
-
-class NoteViewSet(viewsets.ModelViewSet):
+class NoteViewSet(KeysetPaginationMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     Endpoints for authenticated users to manage their notes:
 
@@ -125,25 +326,145 @@ class NoteViewSet(viewsets.ModelViewSet):
     only "content" - is required field
 
     method DELETE allows to delete the users notes, not delegated notes.
+
+    3.
+
+        base_host/my_notes/search/?q=words
+
+    full-text search in the users notes including delegated notes, results as in the list with "rank" and "snippet".
+
+    4.
+
+        base_host/my_notes/batch/
+
+    method POST applies up to 500 operations in one transaction:
+
+        {"operations": [{"op": "create", "title", "content", "color", "category", "label", "delegated", "file"},
+                        {"op": "update", "id", ...the same fields, only passed fields are changed},
+                        {"op": "relabel", "id", "label"},
+                        {"op": "delete", "id"}, ...]}
+
+    Returns results in the order of operations:
+
+        {"results": [{"status": 201, "id": "value"}, {"status": 403, "errors": {...}}, ...]}
+
+    5.
+
+        base_host/my_notes/sync/?since=watermark
+
+    method GET returns notes changed after the watermark of the previous response (without "since" - all notes):
+
+        {"watermark": "value for the next request", "more": "true if the next request returns more changes",
+         "notes": [{ "id", "title", "color", "category", "label", "delegated", "content", "owner", "file",
+                     "date_editing"}, ...],
+         "deleted": [{"note_id": "value", "reason": "deleted" or "revoked"}, ...]}
+
+    Returns status 410 when the watermark is older than the tombstones retention, all notes must be fetched again.
+
+    base_host/my_notes/?paginate=cursor switches the list to keyset pagination as for public notes.
+
+    6.
+
+        base_host/my_notes/export/
+        base_host/my_notes/export/?output=json
+
+    method GET streams all notes of the user including delegated notes, the same fields as in sync,
+    as newline delimited JSON (application/x-ndjson) or as one JSON array with "output=json".
+
+    GET of the list and a single note returns weak "ETag" and "Last-Modified",
+    requests with "If-None-Match" or "If-Modified-Since" of an unchanged resource return status 304.
+
+    With NOTES_LIST_PROJECTION the list is read from the denormalized projection of notes, the same output.
+    With NOTES_COMPILED_SERIALIZERS the list is rendered by the compiled serializer, the same output too.
     """
     queryset = Note.objects.all()
     serializer_class = serializers.NotesEditSerializer
+    keyset_pagination_class = NoteKeysetPagination
     permission_classes = (permissions.IsAuthenticated, CustomNotesPermissions)
 
+    def get_serializer_class(self):
+        if self.action == 'list':
+            if projection.PROJECTION_ENABLED:
+                return serializers.NoteProjectionSerializer
+            if compiled.COMPILED_ENABLED:
+                return serializers.NoteUserListCompiledSerializer
+            return serializers.NoteUserListSerializer
+        if self.action == 'search':
+            return serializers.NoteUserSearchSerializer
+        if self.action == 'sync':
+            return serializers.NoteSyncSerializer
+        return serializers.NotesEditSerializer
+
+    @conditional(notes_list_state)
     def list(self, request, *args, **kwargs):
         # show the notes where user is owner and has delegated permissions
-        queryset = self.filter_queryset(self.get_queryset()).filter(
-                Q(owner=request.user) | Q(delegated__username__exact=request.user.get_username())
-        )
+        queryset = self.filter_queryset(self.get_queryset()).visible_to(request.user)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
+    @conditional(note_state)
+    def retrieve(self, request, *args, **kwargs):
+        return super(NoteViewSet, self).retrieve(request, *args, **kwargs)
+
+    @list_route()
+    def search(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'q': ['This parameter is required.']}, status=status.HTTP_400_BAD_REQUEST)
+        queryset = search_notes(self.filter_queryset(self.get_queryset()).visible_to(request.user), query)
 
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = serializers.NoteUserListSerializer(page, many=True)
+            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
 
-        serializer = serializers.NoteUserListSerializer(queryset, many=True)
+        serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    @list_route()
+    def sync(self, request, *args, **kwargs):
+        try:
+            since = parse_watermark(request.query_params.get('since'))
+        except ValueError:
+            return Response({'since': ['Invalid watermark.']}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            notes, tombstones, watermark, more = get_changes(self.get_queryset(), request.user, since)
+        except WatermarkExpired:
+            return Response({'detail': 'The watermark has expired, fetch all notes.'}, status=status.HTTP_410_GONE)
+        serializer = self.get_serializer(notes, many=True)
+        return Response({
+            'watermark': format_watermark(watermark),
+            'more': more,
+            'notes': serializer.data,
+            'deleted': tombstones,
+        })
+
+    @list_route()
+    def export(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in ('ndjson', 'json'):
+            return Response({'output': ['Expected "ndjson" or "json".']}, status=status.HTTP_400_BAD_REQUEST)
+        notes = iterate_notes(Note.objects.visible_to(request.user), serializers.NoteSyncSerializer)
+        if output == 'json':
+            return StreamingHttpResponse(json_array(notes), content_type='application/json')
+        return StreamingHttpResponse(ndjson_lines(notes), content_type='application/x-ndjson')
+
+    @list_route(methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        operations = request.data.get('operations')
+        if not isinstance(operations, list):
+            return Response({'operations': ['Expected a list of operations.']}, status=status.HTTP_400_BAD_REQUEST)
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            return Response({'operations': ['Ensure this list has no more than %s operations.' % BATCH_MAX_OPERATIONS]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': NoteBatch(request.user, operations).run()})
+
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
@@ -174,13 +495,25 @@ class LabelViewSet(mixins.CreateModelMixin,
 
     GET method returns label ... "results": { "id": "id", "title": "value"}.
     PUT method for creating accepts the same parameters as GET.
+
+    GET supports "ETag" and "Last-Modified", unchanged labels return status 304.
     """
     queryset = Labels.objects.all()
     serializer_class = serializers.LabelsSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    replica_reads = True
+
+    @conditional(generations_state('labels'))
+    def list(self, request, *args, **kwargs):
+        return super(LabelViewSet, self).list(request, *args, **kwargs)
+
+    @conditional(generations_state('labels'))
+    def retrieve(self, request, *args, **kwargs):
+        return super(LabelViewSet, self).retrieve(request, *args, **kwargs)
 
 
-class CategoryViewSet(mixins.CreateModelMixin,
+class CategoryViewSet(SnapshotMixin,
+                      mixins.CreateModelMixin,
                       mixins.RetrieveModelMixin,
                       mixins.UpdateModelMixin,
                       mixins.ListModelMixin,
@@ -208,21 +541,43 @@ class CategoryViewSet(mixins.CreateModelMixin,
     PUT method for creating accepts the same parameters as GET.
     # DELETE method will remove all sub_categories too.
 
+    GET supports "ETag" and "Last-Modified", unchanged categories return status 304.
     """
     queryset = Categories.objects.all()  # .filter(parent=None).order_by('id')
     serializer_class = serializers.CategoriesSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    replica_reads = True
+    # the JSON of the tree is rendered once per category write
+    snapshot_generations = ('categories',)
 
+    @conditional(generations_state('categories'))
     def list(self, request, *args, **kwargs):
         """
         Overriding list method for displaying hierarchical data
         """
-        queryset = Categories.objects.filter(parent=None).order_by('id')
-        serializer = serializers.CategoriesHierarchySerializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.snapshot(self.list_tree, request, *args, **kwargs)
 
+    def list_tree(self, request, *args, **kwargs):
+        return Response(get_or_build('categories:tree', ['categories'], self.build_tree))
 
-class AttachmentsViewSet(viewsets.ModelViewSet):
+    @staticmethod
+    def build_tree():
+        """
+        Builds the whole tree from one query ordered by the materialized path
+        """
+        children = defaultdict(list)
+        for category in Categories.objects.order_by('path'):
+            children[category.parent_id].append(category)
+        serializer = serializers.CategoriesHierarchySerializer(children[None], many=True,
+                                                               context={'children': children})
+        return serializer.data
+
+    @conditional(generations_state('categories'))
+    def retrieve(self, request, *args, **kwargs):
+        return super(CategoryViewSet, self).retrieve(request, *args, **kwargs)
+
+
+class AttachmentsViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     """
     Endpoint for all attachments if it need
 
@@ -233,9 +588,11 @@ class AttachmentsViewSet(viewsets.ModelViewSet):
 
     method GET returns a list of users items
 
-        {"id": "value", "title": "title", "file": "path to file without domain", "owner": id}
+        {"id": "value", "title": "title", "file": "path to file without domain", "owner": id,
+         "preview": "path to the largest preview", "preview_status": "none|pending|done|failed|unsupported",
+         "previews": [{"size": 128, "file": "path to preview"}, ...]}
 
-    method POST - create an attachment
+    method POST - create an attachment, previews are generated in background by run_preview_worker
 
         {"title", "file"}
 
@@ -248,9 +605,20 @@ class AttachmentsViewSet(viewsets.ModelViewSet):
     Method PUT allows to edit only "title".
     Method DELETE removes the attachment.
 
+    /attachments/?paginate=cursor switches the list to keyset pagination ordered by "id".
+
+    3.
+
+        /attachments/{id}/download/
+        /attachments/{id}/download/?preview={size}
+
+    Method GET returns the file or its preview to the owner and to users who can see a note with the attachment.
+    Range, If-Range and If-None-Match are supported, the bytes are sent by the front-end server or by sendfile.
+
     """
     queryset = Attachments.objects.all()
     serializer_class = serializers.AttachmentsSerializer
+    keyset_pagination_class = AttachmentKeysetPagination
     permission_classes = (permissions.IsAuthenticated, OwnerPermissions)
 
     def get_serializer_class(self):
@@ -259,7 +627,7 @@ class AttachmentsViewSet(viewsets.ModelViewSet):
         return serializers.AttachmentsSerializer
 
     def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(Attachments.objects.filter(owner=request.user))
+        queryset = self.filter_queryset(Attachments.objects.filter(owner=request.user).prefetch_related('previews'))
 
         page = self.paginate_queryset(queryset)
         if page is not None:
@@ -271,3 +639,116 @@ class AttachmentsViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
+
+    @detail_route(methods=['get'], permission_classes=(permissions.IsAuthenticated, AttachmentAccessPermissions))
+    def download(self, request, *args, **kwargs):
+        attachment = self.get_object()
+        size = request.query_params.get('preview')
+        if size is not None:
+            preview = attachment.previews.filter(size=size).first() if size.isdigit() else None
+            if preview is None:
+                return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+            return serve_file(request, preview.file.storage, preview.file.name,
+                              '%s_%s.jpg' % (attachment.title, preview.size))
+        extension = os.path.splitext(attachment.file.name)[1]
+        filename = attachment.title
+        if not filename.lower().endswith(extension.lower()):
+            filename += extension
+        return serve_file(request, attachment.file.storage, attachment.file.name, filename)
+
+
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    Endpoint for resumable uploads of attachments
+
+    1.
+
+        /uploads.json
+        /uploads/?format=json
+
+    method POST opens an upload
+
+        {"title", "filename", "size" - size of the file in bytes}
+
+    returns {"id": "upload id", "title", "size", "received": 0}
+
+    2.
+
+        /uploads/{id}/
+
+    method PUT sends the next chunk, the body is raw bytes of the file with header
+
+        Content-Range: bytes first-last/size
+
+    "first" must be equal to "received", otherwise status 409 returns {"received": "offset to resume from"}.
+    method GET returns the upload with "received" to resume an interrupted upload.
+    method DELETE aborts the upload.
+
+    3.
+
+        /uploads/{id}/finalize/
+
+    method POST creates the attachment from the received file, returns the attachment and its "sha256".
+    """
+    serializer_class = serializers.UploadSessionSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            session = uploads.open_session(request.user, data.get('title', 'No name'), data['filename'], data['size'])
+        except uploads.UploadError as e:
+            return Response({'size': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(session).data, status=status.HTTP_201_CREATED)
+
+    def update(self, request, *args, **kwargs):
+        session = self.get_object()
+        try:
+            first, last, total = uploads.parse_content_range(request.META.get('HTTP_CONTENT_RANGE'))
+            session = uploads.write_chunk(session.pk, request.stream, first, last, total)
+        except uploads.RangeMismatch as e:
+            return Response({'received': e.args[0]}, status=status.HTTP_409_CONFLICT)
+        except uploads.UploadError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(session).data)
+
+    @detail_route(methods=['post'])
+    def finalize(self, request, *args, **kwargs):
+        session = self.get_object()
+        try:
+            attachment, sha256 = uploads.finalize(session.pk)
+        except uploads.RangeMismatch as e:
+            return Response({'received': e.args[0]}, status=status.HTTP_409_CONFLICT)
+        data = serializers.AttachmentsSerializer(attachment, context=self.get_serializer_context()).data
+        data['sha256'] = sha256
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    def perform_destroy(self, instance):
+        uploads.abort(instance)
+
+
+class MetricsViewSet(viewsets.ViewSet):
+    """
+    Endpoint for metrics of this worker process, for staff users and collectors with NOTES_METRICS_TOKEN
+    /metrics/
+
+    method GET returns histograms of request, database, serialization and rendering time and of the number of queries
+    per view action, counts of N+1 query patterns when NOTES_INSTRUMENTATION is on,
+    and counters of the connection pools.
+    """
+    permission_classes = (MetricsPermissions,)
+
+    def list(self, request):
+        return Response({
+            'pid': os.getpid(),
+            'views': instrumentation.get_metrics(),
+            'pools': pool_stats(),
+        })
@@ -0,0 +1,22 @@
+"""
+ASGI config for notes project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+served by any ASGI 3 server, e.g.:
+
+    uvicorn notes.asgi:application
+
+Views run in the thread pools of note.asgi.AsgiHandler, see NOTES_ASGI_THREADS and NOTES_ASGI_READ_THREADS.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "notes.settings")
+
+wsgi_application = get_wsgi_application()
+
+from note.asgi import AsgiHandler  # noqa: E402, settings are configured above
+
+application = AsgiHandler(wsgi_application)
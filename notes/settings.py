@@ -43,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    # records query and latency metrics of view actions with NOTES_INSTRUMENTATION = True, see /metrics/
+    'note.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -51,6 +53,7 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'note.routers.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'notes.urls'
@@ -86,6 +89,23 @@ DATABASES = {
         'HOST': 'localhost'
     }
 }
+# connections pooled per process: 'ENGINE': 'note.db.pooled_postgresql' with 'POOL': {'MAX_SIZE': 10, ...}
+# safe requests of views with replica_reads go to NOTES_DATABASE_REPLICAS, all other aliases of DATABASES by default
+DATABASE_ROUTERS = ['note.routers.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+
+# generations of cached responses and reference tables have to be seen by all processes, see note/cache.py:
+# the default works for one process only (system check note.W001), deployments with several workers configure
+# a shared cache, e.g. 'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+# 'LOCATION': '127.0.0.1:11211' with python-memcached installed
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 
 
 # Password validation